@@ -0,0 +1,49 @@
+"""
+Compare the single pass decoding of RS512 tokens with pyjwt
+
+    python benchmarks/decode_token.py [rounds]
+"""
+import sys
+import time
+
+import jwt
+
+from thunderstorm_auth import utils
+from thunderstorm_auth.decoder import decode_token, get_kid_and_alg_headers_from_token
+from thunderstorm_auth.jwks import get_key_registry
+
+
+def _time_per_call(function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds
+
+
+def main(rounds=2000):
+    private_key = utils.generate_private_key()
+    jwk = utils.generate_jwk(private_key)
+    registry = get_key_registry({'keys': [jwk]})
+    token = utils.encode_token(private_key, jwk['kid'], {'username': 'benchmark', 'roles': []})
+
+    def _pyjwt_decode():
+        key_id, algorithm = get_kid_and_alg_headers_from_token(token)
+        jwt.decode(token, key=registry.get_key(key_id), algorithms=[algorithm])
+
+    def _single_pass_decode():
+        decode_token(token, registry)
+
+    # warm up the key registry and the imports
+    _pyjwt_decode()
+    _single_pass_decode()
+
+    pyjwt_time = _time_per_call(_pyjwt_decode, rounds)
+    single_pass_time = _time_per_call(_single_pass_decode, rounds)
+
+    print('decode_token x{}: pyjwt {:.1f}us, single pass {:.1f}us'.format(
+        rounds, pyjwt_time * 1e6, single_pass_time * 1e6
+    ))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -9,7 +9,7 @@ def _read_requirements(requirements_filename):
 
 
 REQUIREMENTS = _read_requirements('requirements.txt')
-EXTRA_REQS = {'flask': ['flask>=0.12,<2'], 'falcon': ['falcon>=1.3,<1.4']}
+EXTRA_REQS = {'flask': ['flask>=0.12,<2'], 'falcon': ['falcon>=1.3,<1.4'], 'redis': ['redis>=3,<4']}
 
 setup(
     name=thunderstorm_auth.__title__,
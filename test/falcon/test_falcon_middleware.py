@@ -1,5 +1,8 @@
+import json
 from unittest.mock import patch, ANY
 
+from thunderstorm_auth.cache import RejectedTokenCache, TokenCache
+from thunderstorm_auth.jwks import JWKSFileProvider
 from thunderstorm_auth.user import User
 
 
@@ -160,3 +163,38 @@ def test_endpoint_returns_401_with_incorrectly_signed_token_and_auditing(token_s
 
     assert response.status_code == 401
     assert not mock_send_ts_task.called
+
+
+def test_endpoint_uses_token_cache(client, middleware, access_token_with_permissions):
+    middleware.token_cache = TokenCache()
+    headers = {'X-Thunderstorm-Key': access_token_with_permissions}
+
+    for _ in range(3):
+        response = client.simulate_get('/', headers=headers)
+        assert response.status_code == 200, response.json
+
+    assert (middleware.token_cache.hits, middleware.token_cache.misses) == (2, 1)
+
+
+def test_endpoint_returns_200_with_jwks_provider(client, middleware, access_token_with_permissions, jwk_set, tmpdir):
+    jwks_file = tmpdir.join('jwks.json')
+    jwks_file.write(json.dumps(jwk_set))
+    middleware.jwks = JWKSFileProvider(str(jwks_file))
+    headers = {'X-Thunderstorm-Key': access_token_with_permissions}
+
+    response = client.simulate_get('/', headers=headers)
+
+    assert response.status_code == 200, response.json
+
+
+def test_endpoint_rejects_repeated_expired_token_from_rejected_token_cache(
+        client, middleware, access_token_expired_with_permissions
+):
+    middleware.rejected_token_cache = RejectedTokenCache()
+    headers = {'X-Thunderstorm-Key': access_token_expired_with_permissions}
+
+    for _ in range(3):
+        response = client.simulate_get('/', headers=headers)
+        assert response.status_code == 401, response.json
+
+    assert middleware.rejected_token_cache.hits == 2
@@ -1,3 +1,4 @@
+import json
 from unittest.mock import patch, ANY
 
 from flask import g, Flask
@@ -5,6 +6,9 @@ import pytest
 
 from thunderstorm_auth import TOKEN_HEADER, DEFAULT_LEEWAY
 from thunderstorm_auth.auditing import AuditConf
+from thunderstorm_auth.cache import RejectedTokenCache, TokenCache
+from thunderstorm_auth.datastore import InMemoryAuthStore, MmapAuthStore
+from thunderstorm_auth.jwks import JWKSFileProvider
 from thunderstorm_auth.flask.core import init_ts_auth, TsAuthState
 from thunderstorm_auth.flask.decorators import ts_auth_required
 from thunderstorm_auth.exceptions import ThunderstormAuthError
@@ -80,6 +84,32 @@ def test_endpoint_returns_200_when_expired_token_falls_within_leeway(flask_app,
         assert response.status_code == 200
 
 
+def test_endpoint_uses_token_cache(access_token_with_permissions, flask_app):
+    token_cache = TokenCache()
+    flask_app.config['TS_AUTH_TOKEN_CACHE'] = token_cache
+    headers = {'X-Thunderstorm-Key': access_token_with_permissions}
+
+    for _ in range(3):
+        response = flask_app.test_client().get('/', headers=headers)
+        assert response.status_code == 200
+
+    assert (token_cache.hits, token_cache.misses) == (2, 1)
+
+
+def test_endpoint_rejects_repeated_expired_token_from_rejected_token_cache(
+        access_token_expired_with_permissions, flask_app
+):
+    rejected_token_cache = RejectedTokenCache()
+    flask_app.config['TS_AUTH_REJECTED_TOKEN_CACHE'] = rejected_token_cache
+    headers = {'X-Thunderstorm-Key': access_token_expired_with_permissions}
+
+    for _ in range(3):
+        response = flask_app.test_client().get('/', headers=headers)
+        assert response.status_code == 401
+
+    assert rejected_token_cache.hits == 2
+
+
 def test_endpoint_returns_401_with_missing_token(flask_app):
     response = flask_app.test_client().get('/')
 
@@ -109,6 +139,97 @@ def test_ts_auth_extension_has_state(datastore, jwk_set):
     assert app.config['TS_AUTH_TOKEN_HEADER'] == TOKEN_HEADER
     assert app.config['TS_AUTH_JWKS'] == jwk_set
     assert app.config['TS_AUTH_AUDIT_MSG_EXP'] == 3600
+    assert app.config['TS_AUTH_TOKEN_CACHE'] is None
+    assert app.config['TS_AUTH_REJECTED_TOKEN_CACHE'] is None
+
+
+def test_ts_auth_extension_with_mmap_datastore(jwk_set, tmpdir):
+    app = Flask('test')
+    datastore = MmapAuthStore(str(tmpdir.join('auth.index')))
+
+    with patch('thunderstorm_auth.flask.core.load_jwks_from_file', return_value=jwk_set):
+        init_ts_auth(app, datastore)
+
+    assert app.extensions['ts_auth'].datastore is datastore
+    # no permission table to manage from the cli
+    assert 'permissions' not in app.cli.commands
+
+
+def test_ts_auth_extension_with_in_memory_datastore(jwk_set):
+    app = Flask('test')
+    datastore = InMemoryAuthStore(service_name='test')
+
+    with patch('thunderstorm_auth.flask.core.load_jwks_from_file', return_value=jwk_set):
+        init_ts_auth(app, datastore)
+
+    assert app.extensions['ts_auth'].datastore is datastore
+    assert 'permissions' not in app.cli.commands
+
+
+def test_ts_auth_extension_registers_permission_commands(datastore, jwk_set):
+    app = Flask('test')
+
+    with patch('thunderstorm_auth.flask.core.load_jwks_from_file', return_value=jwk_set):
+        init_ts_auth(app, datastore)
+
+    assert set(app.cli.commands['permissions'].commands) == {'list', 'update'}
+
+
+def test_ts_auth_extension_runs_datastore_background_queries_in_app_context(datastore, jwk_set):
+    app = Flask('test')
+
+    with patch('thunderstorm_auth.flask.core.load_jwks_from_file', return_value=jwk_set):
+        init_ts_auth(app, datastore)
+
+    assert datastore.background_context == app.app_context
+
+
+def test_ts_auth_extension_watches_jwks_file_with_reload_interval(datastore, jwk_set, tmpdir):
+    jwks_file = tmpdir.join('jwks.json')
+    jwks_file.write(json.dumps(jwk_set))
+    app = Flask('test')
+    app.config['TS_AUTH_JWKS_RELOAD_INTERVAL'] = 10
+
+    init_ts_auth(app, datastore, jwks_path=str(jwks_file))
+
+    assert isinstance(app.config['TS_AUTH_JWKS'], JWKSFileProvider)
+    assert app.config['TS_AUTH_JWKS'].check_interval == 10
+    assert app.config['TS_AUTH_JWKS'].jwks == jwk_set
+
+
+def test_ts_auth_extension_fetches_jwks_from_url(datastore):
+    app = Flask('test')
+    app.config['TS_AUTH_JWKS_URL'] = 'http://user-service/.well-known/jwks.json'
+
+    with patch('thunderstorm_auth.flask.core.RemoteJWKSProvider') as m_provider:
+        init_ts_auth(app, datastore)
+
+    m_provider.assert_called_once_with('http://user-service/.well-known/jwks.json', ttl=3600)
+    assert app.config['TS_AUTH_JWKS'] == m_provider.return_value
+
+
+def test_ts_auth_extension_keeps_configured_jwks_without_loading_any(datastore, jwk_set):
+    app = Flask('test')
+    app.config['TS_AUTH_JWKS'] = jwk_set
+    app.config['TS_AUTH_JWKS_URL'] = 'http://user-service/.well-known/jwks.json'
+
+    with patch('thunderstorm_auth.flask.core.RemoteJWKSProvider') as m_provider, \
+            patch('thunderstorm_auth.flask.core.load_jwks_from_file') as m_load:
+        init_ts_auth(app, datastore)
+
+    assert not m_provider.called and not m_load.called
+    assert app.config['TS_AUTH_JWKS'] == jwk_set
+
+
+def test_endpoint_returns_200_with_jwks_provider(access_token_with_permissions, flask_app, jwk_set, tmpdir):
+    jwks_file = tmpdir.join('jwks.json')
+    jwks_file.write(json.dumps(jwk_set))
+    flask_app.config['TS_AUTH_JWKS'] = JWKSFileProvider(str(jwks_file))
+    headers = {'X-Thunderstorm-Key': access_token_with_permissions}
+
+    response = flask_app.test_client().get('/', headers=headers)
+
+    assert response.status_code == 200
 
 
 def test_ts_auth_extension_has_auditing(datastore, jwk_set):
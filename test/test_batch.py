@@ -0,0 +1,64 @@
+import time
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+
+from thunderstorm_auth.batch import authorize_many
+from thunderstorm_auth.exceptions import ExpiredTokenError, InsufficientPermissions, BrokenTokenError, TokenDecodeError
+
+
+def test_authorize_many_returns_one_result_per_token_in_order(
+        datastore, jwk_set, access_token_with_permissions, access_token_with_permissions_wrong_service,
+        access_token_expired_with_permissions, malformed_token
+):
+    tokens = [
+        access_token_with_permissions, malformed_token, access_token_with_permissions_wrong_service,
+        access_token_expired_with_permissions, access_token_with_permissions
+    ]
+
+    results = authorize_many(tokens, 'perm-a', jwk_set, datastore)
+
+    assert [r.authorized for r in results] == [True, False, False, False, True]
+    assert results[0].payload['username'] == 'test-user'
+    assert isinstance(results[1].error, BrokenTokenError)
+    assert isinstance(results[2].error, InsufficientPermissions)
+    assert isinstance(results[3].error, ExpiredTokenError)
+
+
+def test_authorize_many_decodes_duplicate_tokens_once(datastore, jwk_set, access_token_with_permissions):
+    with patch('thunderstorm_auth.batch.decode_token', return_value={'roles': []}) as m_decode_token:
+        results = authorize_many([access_token_with_permissions] * 10, 'perm-a', jwk_set, datastore, max_workers=2)
+
+    assert len(results) == 10
+    assert m_decode_token.call_count == 1
+
+
+def test_authorize_many_resolves_roles_with_a_single_datastore_call(
+        datastore, jwk_set, make_token, access_token_payload, role_setup
+):
+    tokens = [make_token(dict(access_token_payload, username=str(i))) for i in range(5)]
+    tokens.append(make_token(dict(access_token_payload, roles=[str(uuid4()), 'not-a-uuid'])))
+
+    with patch.object(datastore, 'get_roles_with_permission', wraps=datastore.get_roles_with_permission) as m_get:
+        results = authorize_many(tokens, 'perm-a', jwk_set, datastore)
+
+    assert m_get.call_count == 1
+    assert [r.authorized for r in results] == [True] * 5 + [False]
+
+
+@pytest.mark.parametrize('claims, error_class', [
+    ({'nbf': int(time.time()) + 3600}, TokenDecodeError),
+    ({'aud': 'someone-else'}, TokenDecodeError),
+    ({'roles': [{'uuid': 'role'}]}, BrokenTokenError),
+    ({'roles': [['role']]}, BrokenTokenError),
+])
+def test_authorize_many_returns_invalid_claims_as_token_errors(
+        claims, error_class, datastore, jwk_set, make_token, access_token_payload, access_token_with_permissions
+):
+    invalid_token = make_token(dict(access_token_payload, **claims))
+
+    results = authorize_many([invalid_token, access_token_with_permissions], 'perm-a', jwk_set, datastore)
+
+    assert isinstance(results[0].error, error_class) and not results[0].authorized
+    assert results[1].authorized
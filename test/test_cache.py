@@ -0,0 +1,288 @@
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from thunderstorm_auth.cache import AuthCache, RejectedTokenCache, TokenCache, token_digest
+from thunderstorm_auth.exceptions import ExpiredTokenError
+
+
+def test_token_digest_is_stable_and_hides_the_token(access_token):
+    assert token_digest(access_token) == token_digest(access_token.encode('utf-8'))
+    assert access_token.encode('utf-8') not in token_digest(access_token)
+
+
+def test_token_cache_returns_payload_until_expiry():
+    cache = TokenCache()
+    cache.set(b'digest', {'username': 'test-user'}, time.time() + 60)
+
+    assert cache.get(b'digest') == {'username': 'test-user'}
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_token_cache_drops_expired_payloads():
+    cache = TokenCache()
+    cache.set(b'digest', {'username': 'test-user'}, time.time() - 1)
+
+    assert cache.get(b'digest') is None
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_token_cache_evicts_least_recently_used_payload():
+    cache = TokenCache(maxsize=2)
+    expires_at = time.time() + 60
+    cache.set(b'a', {'a': 1}, expires_at)
+    cache.set(b'b', {'b': 1}, expires_at)
+    cache.get(b'a')
+    cache.set(b'c', {'c': 1}, expires_at)
+
+    assert len(cache) == 2
+    assert cache.get(b'b') is None
+    assert cache.get(b'a') == {'a': 1}
+    assert cache.get(b'c') == {'c': 1}
+
+
+def test_rejected_token_cache_raises_same_error_type_and_message():
+    cache = RejectedTokenCache()
+    cache.reject(b'digest', ExpiredTokenError('Auth token expired.'))
+
+    with pytest.raises(ExpiredTokenError) as exc_info:
+        cache.raise_if_rejected(b'digest')
+
+    assert str(exc_info.value) == 'Auth token expired.'
+
+
+def test_rejected_token_cache_forgets_tokens_after_ttl():
+    cache = RejectedTokenCache(ttl=0)
+    cache.reject(b'digest', ExpiredTokenError('Auth token expired.'))
+
+    cache.raise_if_rejected(b'digest')
+
+
+def test_rejected_token_cache_is_bounded():
+    cache = RejectedTokenCache(maxsize=10)
+    for i in range(20):
+        cache.reject(str(i).encode(), ExpiredTokenError())
+
+    assert len(cache) == 10
+    cache.raise_if_rejected(b'0')
+    with pytest.raises(ExpiredTokenError):
+        cache.raise_if_rejected(b'19')
+
+
+def test_auth_cache_set_and_get():
+    cache = AuthCache()
+    cache.set('key', {'role'})
+    cache.set_many({'key-a': 'a', 'key-b': set()})
+
+    assert cache.get('key') == {'role'}
+    assert cache.get_many('key-a', 'key-b', 'missing') == ['a', set(), None]
+    assert cache.has('key-a')
+    assert not cache.has('missing')
+
+
+def test_auth_cache_expires_entries():
+    cache = AuthCache(default_timeout=10)
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=100):
+        cache.set('default', 'value')
+        cache.set('short', 'value', timeout=1)
+        cache.set('forever', 'value', timeout=0)
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=105):
+        assert cache.get('default') == 'value'
+        assert cache.get('short') is None
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=10 ** 12):
+        assert cache.get('default') is None
+        assert cache.get('forever') == 'value'
+
+
+def test_auth_cache_is_bounded():
+    cache = AuthCache(maxsize=2)
+
+    for key in 'abc':
+        cache.set(key, key)
+
+    assert len(cache) == 2
+    assert cache.get('a') is None
+
+
+def test_auth_cache_delete():
+    cache = AuthCache()
+    cache.set_many({'a': 1, 'b': 2, 'c': 3})
+
+    assert cache.delete('a')
+    assert not cache.delete('a')
+    cache.delete_many('b', 'missing')
+
+    assert cache.get_many('a', 'b', 'c') == [None, None, 3]
+
+
+def test_auth_cache_get_or_load_caches_loaded_value():
+    cache = AuthCache()
+    calls = []
+
+    def _loader():
+        calls.append(1)
+        return set()
+
+    assert cache.get_or_load('key', _loader) == set()
+    assert cache.get_or_load('key', _loader) == set()
+    assert len(calls) == 1
+    assert cache._key_locks == {}
+
+
+def test_auth_cache_get_or_load_shares_single_load_between_threads():
+    cache = AuthCache()
+    calls = []
+    barrier = threading.Barrier(10)
+
+    def _loader():
+        calls.append(1)
+        time.sleep(0.1)
+        return {'role'}
+
+    def _get():
+        barrier.wait()
+        results.append(cache.get_or_load('key', _loader))
+
+    results = []
+    threads = [threading.Thread(target=_get) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [{'role'}] * 10
+    assert cache._key_locks == {}
+
+
+def test_auth_cache_get_or_load_does_not_cache_failed_loads():
+    cache = AuthCache()
+
+    def _loader():
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_load('key', _loader)
+
+    assert cache.get('key') is None
+    assert cache._loading == {}
+    assert cache.get_or_load('key', lambda: 'value') == 'value'
+
+
+def test_auth_cache_get_or_load_serves_stale_entry_while_refreshing():
+    cache = AuthCache(default_timeout=10, stale_timeout=60)
+    with patch('thunderstorm_auth.cache.time.time', return_value=100):
+        cache.set('key', 'old')
+    refreshed = threading.Event()
+
+    def _refresh():
+        refreshed.wait(5)
+        return 'new'
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=120):
+        assert cache.get('key') is None
+        assert cache.get_or_load('key', Mock(), refresh=_refresh) == 'old'
+        assert cache.get_or_load('key', Mock(), refresh=_refresh) == 'old'
+        assert list(cache._refreshing) == ['key']
+        assert cache.stale_hits == 2
+
+        with patch('thunderstorm_auth.cache.statsd') as m_statsd:
+            refreshed.set()
+            cache._refresh_queue.join()
+
+        assert cache.get('key') == 'new'
+        m_statsd.timing.assert_called_once_with('auth_cache.refresh.lag', 10000)
+    assert cache._refreshing == {}
+
+
+def test_auth_cache_get_or_load_loads_entries_past_stale_timeout():
+    cache = AuthCache(default_timeout=10, stale_timeout=60)
+    refresh = Mock()
+    with patch('thunderstorm_auth.cache.time.time', return_value=100):
+        cache.set('key', 'old')
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=200):
+        assert cache.get_or_load('key', lambda: 'new', refresh=refresh) == 'new'
+
+    assert not refresh.called
+
+
+def test_auth_cache_refresh_does_not_restore_deleted_entry():
+    cache = AuthCache(default_timeout=10, stale_timeout=60)
+    with patch('thunderstorm_auth.cache.time.time', return_value=100):
+        cache.set('key', 'old')
+        token = cache._refreshing['key'] = object()
+        cache.delete('key')
+        cache._refresh('key', token, lambda: 'new', None)
+
+        assert cache.get('key') is None
+
+
+def test_auth_cache_get_or_load_does_not_cache_value_loaded_across_a_delete():
+    cache = AuthCache()
+
+    def _loader():
+        # the key is invalidated by a commit while its pre-commit value is loading
+        cache.delete_many('key')
+        return 'old'
+
+    assert cache.get_or_load('key', _loader) == 'old'
+    assert cache.get('key') is None
+    assert cache._loading == {}
+    assert cache.get_or_load('key', lambda: 'new') == 'new'
+    assert cache.get('key') == 'new'
+
+
+def test_auth_cache_failed_refresh_keeps_stale_entry():
+    cache = AuthCache(default_timeout=10, stale_timeout=60)
+    with patch('thunderstorm_auth.cache.time.time', return_value=100):
+        cache.set('key', 'old')
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=120):
+        cache.get_or_load('key', Mock(), refresh=Mock(side_effect=RuntimeError()))
+        cache._refresh_queue.join()
+
+        assert cache._refreshing == {}
+        assert cache.get_or_load('key', Mock()) == 'old'
+
+
+def test_auth_cache_jitter_spreads_expiry():
+    cache = AuthCache(default_timeout=100, jitter=0.2)
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=0):
+        cache.set_many({key: key for key in range(200)})
+        cache.set('forever', 'value', timeout=0)
+
+    expiries = {expires_at for _, expires_at in cache._entries.values()}
+    assert len(expiries) > 100
+    assert all(80 <= expires_at <= 100 for expires_at in expiries if expires_at != float('inf'))
+    assert float('inf') in expiries
+
+
+def test_auth_cache_rejects_invalid_jitter():
+    with pytest.raises(ValueError):
+        AuthCache(jitter=1)
+
+
+@pytest.mark.parametrize('now,draw,refreshed', [
+    (50, 60, False),   # outside of the refresh window
+    (95, 6, True),     # drawn further from the expiry than the entry is
+    (95, 4, False),
+])
+def test_auth_cache_get_or_load_refreshes_ahead_of_expiry(now, draw, refreshed):
+    cache = AuthCache(default_timeout=100, refresh_ahead=10)
+    with patch('thunderstorm_auth.cache.time.time', return_value=0):
+        cache.set('key', 'value')
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=now), \
+            patch('thunderstorm_auth.cache.random.uniform', return_value=draw), \
+            patch.object(cache, '_schedule_refresh') as m_schedule:
+        assert cache.get_or_load('key', Mock()) == 'value'
+
+    assert m_schedule.called == refreshed
@@ -0,0 +1,48 @@
+from uuid import uuid4
+
+from thunderstorm_auth.coalescing import SyncCoalescer
+
+
+def test_sync_coalescer_digest_ignores_key_order():
+    assert SyncCoalescer.digest({'a': 1, 'b': [1, 2]}) == SyncCoalescer.digest({'b': [1, 2], 'a': 1})
+    assert SyncCoalescer.digest([1, 2]) != SyncCoalescer.digest([2, 1])
+
+
+def test_sync_coalescer_remembers_last_applied_payload():
+    coalescer = SyncCoalescer()
+    key = 'role:{}'.format(uuid4())
+
+    assert not coalescer.is_applied(key, 'first')
+
+    coalescer.mark_applied(key, 'first')
+    assert coalescer.is_applied(key, 'first')
+    assert not coalescer.is_applied(key, 'second')
+
+    coalescer.mark_applied(key, 'second')
+    assert not coalescer.is_applied(key, 'first')
+
+
+def test_sync_coalescer_deferred_payload_is_superseded_by_newer_one():
+    coalescer = SyncCoalescer(debounce=1)
+    key = 'group:{}'.format(uuid4())
+
+    assert coalescer.is_latest(key, 'first')
+
+    coalescer.defer(key, 'first')
+    coalescer.defer(key, 'second')
+
+    assert not coalescer.is_latest(key, 'first')
+    assert coalescer.is_latest(key, 'second')
+
+
+def test_sync_coalescer_claims_payload_not_applied_yet_once():
+    coalescer = SyncCoalescer()
+    key = 'role:{}'.format(uuid4())
+
+    assert coalescer.claim(key, 'first')
+    assert not coalescer.claim(key, 'first')
+    assert coalescer.is_applied(key, 'first')
+
+    coalescer.forget(key)
+    assert not coalescer.is_applied(key, 'first')
+    assert coalescer.claim(key, 'first')
@@ -0,0 +1,229 @@
+import threading
+from unittest.mock import Mock, patch
+from uuid import uuid4
+
+from kombu import Queue
+
+from thunderstorm_auth.coalescing import SyncCoalescer
+from thunderstorm_auth.consumer import SyncBatch, _init_batch_consumer, _task_call
+from thunderstorm_auth.datastore import InMemoryAuthStore
+from thunderstorm_auth.groups import _group_changes as group_changes
+
+
+def _message(task_name, args):
+    message = Mock()
+    message.headers = {'task': task_name}
+    return [list(args), {}, {}], message
+
+
+def _role_message(role_uuid, permissions):
+    return _message('handle_role_data', [{
+        'data': {
+            'uuid': str(role_uuid),
+            'type': 'test',
+            'permissions': [
+                {'uuid': str(permission.uuid), 'service': 'test', 'permission_string': permission.permission}
+                for permission in permissions
+            ],
+        }
+    }])
+
+
+def _group_message(group_uuid, complex_uuids):
+    return _message('ts_auth.group.complex.sync', [str(group_uuid), [str(c) for c in complex_uuids]])
+
+
+def test_task_call_reads_both_message_protocols():
+    body, message = _message('handle_role_data', [{'data': {}}])
+    assert _task_call(body, message) == ('handle_role_data', [{'data': {}}], {})
+
+    message.headers = {}
+    body = {'task': 'handle_role_data', 'args': [{'data': {}}], 'kwargs': {}}
+    assert _task_call(body, message) == ('handle_role_data', [{'data': {}}], {})
+
+
+def test_sync_batch_applies_latest_messages_in_one_transaction(datastore, db_session, fixtures):
+    role_uuid, group_uuid = uuid4(), uuid4()
+    permissions = [fixtures.Permission() for _ in range(2)]
+    complex_uuids = [uuid4() for _ in range(3)]
+    messages = [
+        _role_message(role_uuid, permissions),
+        _group_message(group_uuid, complex_uuids),
+        _role_message(role_uuid, permissions[:1]),
+    ]
+
+    with patch.object(db_session, 'commit', wraps=db_session.commit) as m_commit:
+        SyncBatch(datastore).apply(messages)
+
+    m_commit.assert_called_once_with()
+    assert {p.uuid for p in datastore.get_role_permissions(role_uuid)} == {permissions[0].uuid}
+    assert {a.complex_uuid for a in datastore.get_group_associations([group_uuid])} == set(complex_uuids)
+    assert all(message.ack.called for _, message in messages)
+
+
+def test_sync_batch_reads_role_payload_keyword(datastore, fixtures):
+    role_uuid, permission = uuid4(), fixtures.Permission()
+    (args, _, _), message = _role_message(role_uuid, [permission])
+    body = [[], {'payload': args[0]}, {}]
+
+    SyncBatch(datastore).apply([(body, message)])
+
+    assert message.ack.called
+    assert {p.uuid for p in datastore.get_role_permissions(role_uuid)} == {permission.uuid}
+
+
+def test_sync_batch_rejects_invalid_messages(datastore):
+    group_uuid = uuid4()
+    invalid = [_message('handle_role_data', [{'data': {'uuid': 'not-a-uuid'}}]), _message('other.task', [])]
+    valid = _group_message(group_uuid, [uuid4()])
+
+    SyncBatch(datastore).apply(invalid + [valid])
+
+    assert all(message.reject.called and not message.ack.called for _, message in invalid)
+    assert valid[1].ack.called
+    assert list(datastore.get_group_associations([group_uuid]))
+
+
+def test_sync_batch_applies_messages_one_by_one_when_the_batch_fails(datastore):
+    failing_uuid, group_uuid = uuid4(), uuid4()
+    failing, valid = _group_message(failing_uuid, [uuid4()]), _group_message(group_uuid, [uuid4()])
+
+    def _group_changes(store, group, *args):
+        # fails before reading the group, the rollback would end the transaction of the test
+        if group == str(failing_uuid):
+            raise ValueError('broken')
+        return group_changes(store, group, *args)
+
+    with patch('thunderstorm_auth.consumer._group_changes', side_effect=_group_changes):
+        SyncBatch(datastore).apply([failing, valid])
+
+    assert failing[1].reject.called and not failing[1].ack.called
+    assert valid[1].ack.called
+    assert list(datastore.get_group_associations([group_uuid]))
+    assert not list(datastore.get_group_associations([failing_uuid]))
+
+
+def test_sync_batch_skips_messages_identical_to_last_applied(datastore):
+    group_uuid, complex_uuids = uuid4(), [uuid4()]
+    batch = SyncBatch(datastore, coalescer=SyncCoalescer())
+    batch.apply([_group_message(group_uuid, complex_uuids)])
+    duplicate = _group_message(group_uuid, complex_uuids)
+
+    with patch.object(datastore, 'update_group_associations') as m_update:
+        batch.apply([duplicate])
+
+    assert not m_update.called
+    assert duplicate[1].ack.called
+
+
+def test_sync_batch_flushes_when_full(datastore):
+    batch = SyncBatch(datastore, batch_size=2)
+
+    with patch.object(batch, '_apply') as m_apply:
+        batch.add(*_group_message(uuid4(), []))
+        assert batch.drain(timeout=5)
+        assert not m_apply.called
+
+        batch.add(*_group_message(uuid4(), []))
+        assert batch.drain(timeout=5)
+
+    assert len(m_apply.call_args[0][0]) == 2
+    assert batch.flush() == 0
+
+
+def test_sync_batch_applies_on_its_own_thread_and_settles_on_the_consumer_thread():
+    memory_store = InMemoryAuthStore(service_name='test')
+    group_uuid, complex_uuid = uuid4(), uuid4()
+    body, message = _group_message(group_uuid, [complex_uuid])
+    threads = {}
+    message.ack.side_effect = lambda: threads.setdefault('ack', threading.current_thread())
+    applying, committed = threading.Event(), threading.Event()
+    update_group_associations = memory_store.update_group_associations
+
+    def _update(*args, **kwargs):
+        threads['apply'] = threading.current_thread()
+        applying.set()
+        committed.wait(5)
+        return update_group_associations(*args, **kwargs)
+
+    batch = SyncBatch(memory_store)
+    with patch.object(memory_store, 'update_group_associations', side_effect=_update):
+        batch.add(body, message)
+        assert batch.flush() == 1
+        assert applying.wait(5)
+        batch.settle()
+        assert not message.ack.called
+
+        committed.set()
+        assert batch.drain(timeout=5)
+
+    assert threads['apply'] is not threading.current_thread()
+    assert threads['ack'] is threading.current_thread()
+    assert list(memory_store.iter_group_complex_uuids(group_uuid)) == [complex_uuid]
+
+
+def test_sync_batch_rejects_messages_of_batches_failing_unexpectedly():
+    memory_store = InMemoryAuthStore(service_name='test')
+    batch = SyncBatch(memory_store, coalescer=SyncCoalescer())
+    body, message = _group_message(uuid4(), [uuid4()])
+
+    with patch.object(batch.coalescer, 'is_applied', side_effect=ValueError('broken')):
+        batch.add(body, message)
+        batch.flush()
+        assert batch.drain(timeout=5)
+
+    assert message.reject.called and not message.ack.called
+
+
+def test_sync_batch_settles_messages_once_when_a_batch_fails_after_settling_some():
+    memory_store = InMemoryAuthStore(service_name='test')
+    batch = SyncBatch(memory_store)
+    invalid = _message('other.task', [])
+    valid = _group_message(uuid4(), [uuid4()])
+
+    with patch('thunderstorm_auth.consumer.statsd.incr', side_effect=ValueError('statsd is broken')):
+        batch.add(*invalid)
+        batch.add(*valid)
+        batch.flush()
+        assert batch.drain(timeout=5)
+
+    assert invalid[1].reject.call_count == 1 and not invalid[1].ack.called
+    assert valid[1].ack.call_count == 1 and not valid[1].reject.called
+
+
+def test_sync_batch_drain_times_out_while_a_batch_is_applying():
+    batch = SyncBatch(InMemoryAuthStore(service_name='test'))
+    body, message = _group_message(uuid4(), [uuid4()])
+    release = threading.Event()
+
+    with patch.object(batch, '_apply', side_effect=lambda messages: release.wait(5)):
+        batch.add(body, message)
+        batch.flush()
+        assert not batch.drain(timeout=0.05)
+
+        release.set()
+        assert batch.drain(timeout=5)
+
+
+def test_sync_batch_feeds_in_memory_store():
+    memory_store = InMemoryAuthStore(service_name='test')
+    role_uuid, group_uuid, complex_uuid = uuid4(), uuid4(), uuid4()
+    permission = Mock(uuid=uuid4(), permission='perm-a')
+    messages = [_role_message(role_uuid, [permission]), _group_message(group_uuid, [complex_uuid])]
+
+    SyncBatch(memory_store).apply(messages)
+
+    assert memory_store.is_permission_in_roles(permission_string='perm-a', role_uuids=[role_uuid])
+    assert list(memory_store.iter_group_complex_uuids(group_uuid)) == [complex_uuid]
+    assert all(message.ack.called for _, message in messages)
+
+
+def test_batch_consumer_settles_buffered_messages_when_stopping(celery_app):
+    batch = _init_batch_consumer(celery_app, InMemoryAuthStore(service_name='test'), Queue('test.ts_auth.group'))
+    step_class = next(step for step in celery_app.steps['consumer'] if step.__name__ == 'SyncBatchConsumer')
+    body, message = _group_message(uuid4(), [uuid4()])
+    batch.add(body, message)
+
+    step_class(Mock()).shutdown(Mock())
+
+    assert message.ack.called
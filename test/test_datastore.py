@@ -1,17 +1,42 @@
+from contextlib import contextmanager
 from datetime import datetime
 from random import choice
+import threading
+import time
 from os import environ
+from unittest.mock import MagicMock, Mock, patch
 from uuid import uuid4
 
 import pytest
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.query import Query
 from werkzeug.contrib.cache import BaseCache, SimpleCache, RedisCache, MemcachedCache
 
-from thunderstorm_auth.datastore import SQLAlchemySessionAuthStore
+from thunderstorm_auth.cache import AuthCache
+from thunderstorm_auth.datastore import GroupAssociation, InMemoryAuthStore, SQLAlchemySessionAuthStore, _permission_string_key
+from thunderstorm_auth.invalidation import InvalidationBroadcaster
 from test.models import Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation
 
 
+@contextmanager
+def count_statements(db_session):
+    statements = []
+    thread = threading.current_thread()
+
+    def _before_cursor_execute(conn, cursor, statement, *args):
+        # background loads are not part of the request path being measured
+        if threading.current_thread() is thread:
+            statements.append(statement)
+
+    event.listen(db_session.bind, 'before_cursor_execute', _before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db_session.bind, 'before_cursor_execute', _before_cursor_execute)
+
+
 def test_sqlalchemy_auth_datastore_initialization(db_session):
     datastore = SQLAlchemySessionAuthStore(db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation)
 
@@ -19,7 +44,8 @@ def test_sqlalchemy_auth_datastore_initialization(db_session):
     assert datastore.role_model == Role
     assert datastore.permission_model == Permission
     assert datastore.association_model == RolePermissionAssociation
-    assert isinstance(datastore.cache, SimpleCache)
+    assert isinstance(datastore.cache, AuthCache)
+    assert datastore.cache.jitter == 0.1
 
 
 def test_sqlalchemy_auth_datastore_initialization_with_wrong_cache(db_session):
@@ -46,6 +72,33 @@ def test_sqlalchemy_auth_datastore_initialization_with_basecache(cache, db_sessi
     assert isinstance(datastore.cache, BaseCache)
 
 
+def test_sqlalchemy_auth_datastore_preload_cache_with_single_query(datastore, db_session, fixtures):
+    roles = [fixtures.Role() for _ in range(10)]
+    permissions = [fixtures.Permission(roles=roles[i:]) for i in range(5)]
+    permission_without_roles = fixtures.Permission()
+    db_session.flush()
+
+    with count_statements(db_session) as statements:
+        assert datastore.preload_cache() == 6
+
+    assert len(statements) == 1
+    for i, permission in enumerate(permissions):
+        assert datastore.cache.get(str(permission.uuid)) == {str(r.uuid) for r in roles[i:]}
+        assert datastore.cache.get(_permission_string_key(permission.permission)) == str(permission.uuid)
+    assert datastore.cache.get(str(permission_without_roles.uuid)) == set()
+
+
+def test_sqlalchemy_auth_datastore_bootstrap_preloads_cache(db_session, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+
+    datastore = SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation, bootstrap=True
+    )
+
+    assert datastore.cache.get(str(permission.uuid)) == {str(role.uuid)}
+
+
 def test_sqlalchemy_auth_datastore_get_role(datastore, fixtures):
     role = fixtures.Role()
 
@@ -96,6 +149,137 @@ def test_sqlalchemy_auth_datastore_is_permission_in_roles_finds_permission_by_st
     assert datastore.cache.get(str(permission.uuid)) == {str(r.uuid) for r in roles[50:75]}
 
 
+def test_sqlalchemy_auth_datastore_is_permission_in_roles_by_string_without_queries_when_warm(datastore, db_session, fixtures):
+    roles = [fixtures.Role() for _ in range(10)]
+    permission = fixtures.Permission(roles=roles[:5])
+    db_session.flush()
+
+    assert datastore.is_permission_in_roles(permission_string=permission.permission, role_uuids=[r.uuid for r in roles])
+
+    with count_statements(db_session) as statements:
+        assert datastore.is_permission_in_roles(
+            permission_string=permission.permission, role_uuids=[r.uuid for r in roles]
+        )
+        assert not datastore.is_permission_in_roles(
+            permission_string=permission.permission, role_uuids=[r.uuid for r in roles[5:]]
+        )
+
+    assert statements == []
+
+
+def test_sqlalchemy_auth_datastore_is_permission_in_roles_does_not_requery_empty_role_set(datastore, db_session, fixtures):
+    permission = fixtures.Permission()
+    db_session.flush()
+
+    assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[uuid4()])
+
+    with count_statements(db_session) as statements:
+        assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[uuid4()])
+
+    assert statements == []
+
+
+def test_sqlalchemy_auth_datastore_get_permission_uuid_caches_mapping(datastore, db_session, fixtures):
+    permission = fixtures.Permission()
+    db_session.flush()
+
+    assert datastore.get_permission_uuid(permission.permission) == str(permission.uuid)
+    assert datastore.cache.get(_permission_string_key(permission.permission)) == str(permission.uuid)
+
+    with count_statements(db_session) as statements:
+        assert datastore.get_permission_uuid(permission.permission) == str(permission.uuid)
+
+    assert statements == []
+
+
+def test_sqlalchemy_auth_datastore_get_permission_uuid_caches_missing_permission(db_session):
+    cache = SimpleCache()
+    datastore = SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation, cache=cache,
+        negative_timeout=5
+    )
+
+    with patch.object(cache, 'set', wraps=cache.set) as m_set:
+        assert datastore.get_permission_uuid('missing-permission') is None
+
+    m_set.assert_called_once_with(_permission_string_key('missing-permission'), '', timeout=5)
+
+    with count_statements(db_session) as statements:
+        assert datastore.get_permission_uuid('missing-permission') is None
+        assert not datastore.is_permission_in_roles(permission_string='missing-permission', role_uuids=[uuid4()])
+
+    assert statements == []
+
+
+def test_sqlalchemy_auth_datastore_invalidate_permission_uuids(datastore, db_session, fixtures):
+    permission = fixtures.Permission()
+    db_session.flush()
+
+    assert datastore.get_permission_uuid('not-yet-deployed') is None
+    assert datastore.get_permission_uuid(permission.permission) == str(permission.uuid)
+
+    datastore.invalidate_permission_uuids(['not-yet-deployed', permission.permission])
+
+    assert datastore.cache.get(_permission_string_key('not-yet-deployed')) is None
+    assert datastore.cache.get(_permission_string_key(permission.permission)) is None
+
+
+def test_sqlalchemy_auth_datastore_invalidate_permission_uuids_defaults_to_registered_permissions(datastore):
+    datastore.cache.set(_permission_string_key('registered-permission'), '')
+    datastore.cache.set(_permission_string_key('other-permission'), '')
+
+    with patch('thunderstorm_auth.datastore.get_registered_permissions', return_value={'registered-permission'}):
+        datastore.invalidate_permission_uuids()
+
+    assert datastore.cache.get(_permission_string_key('registered-permission')) is None
+    assert datastore.cache.get(_permission_string_key('other-permission')) == ''
+
+
+def test_sqlalchemy_auth_datastore_is_permission_in_roles_shares_query_between_concurrent_misses(datastore):
+    permission_uuid, role_uuid = uuid4(), uuid4()
+    barrier = threading.Barrier(8)
+    results = []
+
+    def _query_permission_roles(permission_uuid):
+        time.sleep(0.1)
+        return {str(role_uuid)}
+
+    def _check():
+        barrier.wait()
+        results.append(datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[role_uuid]))
+
+    with patch.object(datastore, '_query_permission_roles', side_effect=_query_permission_roles) as m_query:
+        threads = [threading.Thread(target=_check) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert m_query.call_count == 1
+    assert results == [True] * 8
+
+
+def test_sqlalchemy_auth_datastore_serves_stale_roles_while_refreshing(db_session, fixtures):
+    role, new_role = fixtures.Role(), fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    datastore = SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+        cache=AuthCache(default_timeout=10, stale_timeout=60)
+    )
+    with patch('thunderstorm_auth.cache.time.time', return_value=100):
+        assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    with patch.object(datastore, '_query_permission_roles', return_value={str(new_role.uuid)}) as m_query:
+        with patch('thunderstorm_auth.cache.time.time', return_value=120):
+            # the expired entry is served without waiting for the db
+            assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+            datastore.cache._refresh_queue.join()
+
+            assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[new_role.uuid])
+
+    m_query.assert_called_once_with(permission.uuid)
+
+
 def test_sqlalchemy_auth_datastore_is_permission_in_roles_fails_if_no_role(datastore, fixtures):
     permission = fixtures.Permission()
 
@@ -104,6 +288,21 @@ def test_sqlalchemy_auth_datastore_is_permission_in_roles_fails_if_no_role(datas
     )
 
 
+def test_sqlalchemy_auth_datastore_get_roles_with_permission(datastore, fixtures):
+    roles = [fixtures.Role() for _ in range(10)]
+    permission = fixtures.Permission(roles=roles[:5])
+
+    role_uuids = [r.uuid for r in roles[3:]]
+
+    assert datastore.get_roles_with_permission(role_uuids, permission_uuid=permission.uuid) == {
+        str(r.uuid) for r in roles[3:5]
+    }
+    assert datastore.get_roles_with_permission(role_uuids, permission_string=permission.permission) == {
+        str(r.uuid) for r in roles[3:5]
+    }
+    assert datastore.get_roles_with_permission([], permission_uuid=permission.uuid) == set()
+
+
 def test_sqlalchemy_auth_datastore_get_permission(datastore, fixtures):
     permission = fixtures.Permission()
 
@@ -176,6 +375,138 @@ def test_sqlalchemy_auth_datastore_delete_role_permission_association(datastore,
     assert not db_session.query(RolePermissionAssociation).get((role.uuid, permission.uuid))
 
 
+def test_sqlalchemy_auth_datastore_create_role_permission_association_invalidates_cache_on_commit(datastore, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[fixtures.Role()])
+
+    assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    datastore.create_role_permission_association(role.uuid, permission.uuid)
+
+    # the association is not committed yet
+    assert datastore.cache.get(str(permission.uuid)) is not None
+
+    datastore.commit()
+
+    assert datastore.cache.get(str(permission.uuid)) is None
+    assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+
+def test_sqlalchemy_auth_datastore_delete_role_permission_association_invalidates_cache(db_session, fixtures):
+    role = fixtures.Role()
+    other_permission = fixtures.Permission(roles=[role])
+    permission = fixtures.Permission(roles=[role])
+    broadcaster = Mock(spec=InvalidationBroadcaster)
+    datastore = SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+        broadcaster=broadcaster
+    )
+
+    assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+    assert datastore.is_permission_in_roles(permission_uuid=other_permission.uuid, role_uuids=[role.uuid])
+
+    datastore.delete_role_permission_association(role.uuid, permission.uuid, commit=True)
+
+    broadcaster.publish.assert_called_once_with([str(permission.uuid)])
+    assert datastore.cache.get(str(other_permission.uuid)) == {str(role.uuid)}
+    assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+
+def test_sqlalchemy_auth_datastore_keeps_cache_if_commit_fails(datastore, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[fixtures.Role()])
+    datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    datastore.create_role_permission_association(role.uuid, permission.uuid)
+    with patch.object(datastore.db_session, 'commit', side_effect=SQLAlchemyError):
+        with pytest.raises(SQLAlchemyError):
+            datastore.commit()
+
+    assert datastore.cache.get(str(permission.uuid)) is not None
+    assert datastore._pending_invalidations() == set()
+
+
+def test_sqlalchemy_auth_datastore_batch_commits_once_at_exit(datastore, db_session, fixtures):
+    role = fixtures.Role()
+    permissions = [fixtures.Permission(roles=[fixtures.Role()]) for _ in range(3)]
+    for permission in permissions:
+        datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    with patch.object(db_session, 'commit', wraps=db_session.commit) as m_commit:
+        with datastore.batch():
+            for permission in permissions:
+                datastore.create_role_permission_association(role.uuid, permission.uuid, commit=True)
+            with datastore.batch():
+                datastore.create_group_association(uuid4(), uuid4(), commit=True)
+
+            assert not m_commit.called
+            assert datastore.cache.get(str(permissions[0].uuid)) is not None
+
+    m_commit.assert_called_once_with()
+    assert all(datastore.cache.get(str(permission.uuid)) is None for permission in permissions)
+    assert all(
+        datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+        for permission in permissions
+    )
+
+
+def test_sqlalchemy_auth_datastore_batch_rolls_back_if_block_raises(datastore, db_session, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission()
+
+    with pytest.raises(ValueError):
+        with datastore.batch():
+            datastore.create_role_permission_association(role.uuid, permission.uuid, commit=True)
+            raise ValueError()
+
+    assert not db_session.query(RolePermissionAssociation).count()
+    assert datastore._pending_invalidations() == set()
+    # the next writes are not batched anymore
+    assert datastore._batch.depth == 0
+
+
+def test_sqlalchemy_auth_datastore_batch_rolls_back_if_commit_fails(datastore, db_session, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission()
+
+    with patch.object(db_session, 'commit', side_effect=SQLAlchemyError):
+        with pytest.raises(SQLAlchemyError):
+            with datastore.batch():
+                datastore.create_role_permission_association(role.uuid, permission.uuid, commit=True)
+
+    assert datastore._pending_invalidations() == set()
+    assert not db_session.query(RolePermissionAssociation).count()
+
+
+def test_sqlalchemy_auth_datastore_drops_cache_entries_broadcasted_by_other_processes(db_session, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    broadcaster = Mock(spec=InvalidationBroadcaster)
+    datastore = SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+        broadcaster=broadcaster
+    )
+    datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    callback, = broadcaster.subscribe.call_args[0]
+    callback([str(permission.uuid)])
+
+    assert datastore.cache.get(str(permission.uuid)) is None
+    assert broadcaster.ensure_listening.called
+
+
+def test_sqlalchemy_auth_datastore_invalidate_permission_uuids_broadcasts_keys(db_session):
+    broadcaster = Mock(spec=InvalidationBroadcaster)
+    datastore = SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+        broadcaster=broadcaster
+    )
+
+    datastore.invalidate_permission_uuids(['perm-a'])
+
+    broadcaster.publish.assert_called_once_with([_permission_string_key('perm-a')])
+
+
 def test_sqlalchemy_auth_datastore_delete_role_permission_association_no_commit(datastore, db_session, fixtures):
     role = fixtures.Role()
     permission = fixtures.Permission(roles=[role] + [fixtures.Role() for _ in range(10)])
@@ -329,3 +660,329 @@ def test_sqlalchemy_auth_datastore_create_group_association(datastore, fixtures)
 
     assert datastore.create_group_association(group_uuid, complex_uuid) == (group_uuid, complex_uuid)
     assert datastore.get_group_associations([group_uuid]).count() == 1
+
+
+def test_sqlalchemy_auth_datastore_iter_group_complex_uuids_streams_sorted_uuids(datastore, fixtures):
+    group_uuid = uuid4()
+    complex_uuids = [fixtures.ComplexGroupComplexAssociation(group_uuid=group_uuid).complex_uuid for _ in range(25)]
+    fixtures.ComplexGroupComplexAssociation()
+
+    assert list(datastore.iter_group_complex_uuids(group_uuid, chunk_size=10)) == sorted(complex_uuids)
+    assert list(datastore.iter_group_complex_uuids(uuid4())) == []
+
+
+def test_sqlalchemy_auth_datastore_update_group_associations(datastore, db_session, fixtures):
+    group_uuid, other_group_uuid = uuid4(), uuid4()
+    kept, removed = [fixtures.ComplexGroupComplexAssociation(group_uuid=group_uuid) for _ in range(2)]
+    other = fixtures.ComplexGroupComplexAssociation(group_uuid=other_group_uuid, complex_uuid=removed.complex_uuid)
+    new_uuids = [uuid4() for _ in range(3)]
+    db_session.flush()
+
+    with patch('thunderstorm_auth.datastore._BULK_INSERT_CHUNK_SIZE', 2), \
+            patch('thunderstorm_auth.datastore.statsd') as m_statsd, \
+            count_statements(db_session) as statements:
+        result = datastore.update_group_associations(
+            group_uuid, [str(removed.complex_uuid)], [str(u) for u in new_uuids], commit=True
+        )
+
+    assert result == (3, 1)
+    # one delete semi-joined against the removed complexes, two inserts of at most 2 rows
+    assert len(statements) == 3
+    assert statements[0].startswith('DELETE') and 'unnest' in statements[0]
+    m_statsd.incr.assert_called_once_with('datastore.update_group_associations.rows', 4)
+    assert {a.complex_uuid for a in datastore.get_group_associations([group_uuid])} == {kept.complex_uuid} | set(
+        new_uuids
+    )
+    assert [a.complex_uuid for a in datastore.get_group_associations([other_group_uuid])] == [other.complex_uuid]
+
+    with count_statements(db_session) as statements:
+        assert datastore.update_group_associations(group_uuid, [], new_uuids[:1]) == (0, 0)
+    assert len(statements) == 1
+    assert datastore.update_group_associations(group_uuid, [kept.complex_uuid] + new_uuids, []) == (0, 4)
+    assert not datastore.get_group_associations([group_uuid]).count()
+
+
+def test_sqlalchemy_auth_datastore_apply_role(datastore, db_session, fixtures):
+    role = fixtures.Role()
+    kept, removed, added = [fixtures.Permission() for _ in range(3)]
+    kept.roles.append(role)
+    removed.roles.append(role)
+    db_session.flush()
+    for permission in [kept, removed, added]:
+        datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    with patch.object(db_session, 'commit', wraps=db_session.commit) as m_commit:
+        result = datastore.apply_role(role.uuid, role.type, [kept.uuid, str(added.uuid), uuid4()], commit=True)
+
+    assert result == ({str(added.uuid)}, {str(removed.uuid)})
+    m_commit.assert_called_once_with()
+    assert {p.uuid for p in datastore.get_role_permissions(role.uuid)} == {kept.uuid, added.uuid}
+    assert datastore.cache.get(str(kept.uuid)) is not None
+    assert datastore.cache.get(str(added.uuid)) is None
+    assert datastore.cache.get(str(removed.uuid)) is None
+    assert datastore.apply_role(role.uuid, role.type, [kept.uuid, added.uuid]) == (set(), set())
+    assert datastore.apply_role(role.uuid, role.type, []) == (set(), {str(kept.uuid), str(added.uuid)})
+
+
+def test_sqlalchemy_auth_datastore_apply_role_creates_role(datastore, db_session, fixtures):
+    permission = fixtures.Permission()
+    role_uuid = uuid4()
+
+    datastore.apply_role(str(role_uuid), 'new', [permission.uuid], commit=True)
+
+    assert datastore.get_role(role_uuid).type == 'new'
+    assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role_uuid])
+
+
+def test_sqlalchemy_auth_datastore_apply_role_fails_if_type_exists(datastore, fixtures):
+    role = fixtures.Role()
+
+    with pytest.raises(IntegrityError):
+        datastore.apply_role(uuid4(), role.type, [], commit=True)
+
+
+def test_sqlalchemy_auth_datastore_replace_role_permissions(datastore, db_session, fixtures):
+    role, other_role = fixtures.Role(), fixtures.Role()
+    kept, *orphans = [fixtures.Permission(roles=[role, other_role]) for _ in range(3)]
+    db_session.flush()
+    datastore.is_permission_in_roles(permission_uuid=orphans[0].uuid, role_uuids=[role.uuid])
+
+    with count_statements(db_session) as statements:
+        removed = datastore.replace_role_permissions(role.uuid, [str(kept.uuid), uuid4()], commit=True)
+
+    assert removed == {str(p.uuid) for p in orphans}
+    assert len(statements) == 1
+    assert statements[0].startswith('DELETE') and 'unnest' in statements[0]
+    assert datastore.cache.get(str(orphans[0].uuid)) is None
+    assert {p.uuid for p in datastore.get_role_permissions(role.uuid)} == {kept.uuid}
+    assert len(datastore.get_role_permissions(other_role.uuid).all()) == 3
+    assert datastore.replace_role_permissions(role.uuid, []) == {str(kept.uuid)}
+
+
+@pytest.fixture
+def memory_store():
+    return InMemoryAuthStore(permissions={'perm-a': uuid4(), 'perm-b': uuid4()})
+
+
+def test_in_memory_auth_store_roles_and_permissions(memory_store):
+    role_uuid, other_role_uuid = uuid4(), uuid4()
+    permission_uuid = memory_store.get_permission_uuid('perm-a')
+
+    # same calls as the role sync tasks
+    assert not memory_store.get_role(role_uuid)
+    memory_store.create_role(role_uuid, 'test', commit=True)
+    memory_store.create_role(other_role_uuid, 'test', commit=True)
+    assert memory_store.get_permission(permission_uuid).permission == 'perm-a'
+    memory_store.create_role_permission_association(str(role_uuid), permission_uuid, commit=True)
+
+    assert memory_store.get_role(str(role_uuid)).type == 'test'
+    assert [str(p.uuid) for p in memory_store.get_role_permissions(role_uuid)] == [permission_uuid]
+    assert [str(p.uuid) for p in memory_store.get_roles_permissions([role_uuid, other_role_uuid])] == [permission_uuid]
+    assert [r.uuid for r in memory_store.get_permission_roles(permission_uuid)] == [role_uuid]
+    assert len(memory_store.get_roles([role_uuid, other_role_uuid, uuid4()])) == 2
+
+    assert memory_store.is_permission_in_roles(permission_string='perm-a', role_uuids=[role_uuid])
+    assert memory_store.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[str(role_uuid)])
+    assert not memory_store.is_permission_in_roles(permission_string='perm-b', role_uuids=[role_uuid])
+    assert not memory_store.is_permission_in_roles(permission_string='unknown', role_uuids=[role_uuid])
+    assert not memory_store.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[other_role_uuid])
+    assert memory_store.get_roles_with_permission([role_uuid, other_role_uuid], permission_string='perm-a') == {
+        str(role_uuid)
+    }
+
+    memory_store.delete_role_permission_association(role_uuid, permission_uuid, commit=True)
+
+    assert not memory_store.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[role_uuid])
+    assert memory_store.get_role_permissions(role_uuid) == []
+    assert memory_store.get_permission(uuid4()) is None
+
+
+def test_in_memory_auth_store_learns_permissions_of_its_service():
+    memory_store = InMemoryAuthStore(service_name='test')
+    permission_uuid, other_uuid = uuid4(), uuid4()
+
+    memory_store.learn_permissions([
+        {'uuid': permission_uuid, 'service': 'test', 'permission_string': 'perm-a'},
+        {'uuid': other_uuid, 'service': 'other', 'permission_string': 'perm-b'},
+    ])
+
+    assert memory_store.get_permission_uuid('perm-a') == str(permission_uuid)
+    assert memory_store.get_permission(other_uuid) is None
+
+    memory_store.learn_permissions([{'uuid': permission_uuid, 'service': 'test', 'permission_string': 'perm-c'}])
+
+    assert memory_store.get_permission_uuid('perm-a') is None
+    assert memory_store.get_permission_uuid('perm-c') == str(permission_uuid)
+
+
+def test_in_memory_auth_store_without_service_name_learns_no_permissions(memory_store):
+    memory_store.learn_permissions([{'uuid': uuid4(), 'service': 'test', 'permission_string': 'perm-c'}])
+
+    assert memory_store.get_permission_uuid('perm-c') is None
+
+
+def test_in_memory_auth_store_group_associations(memory_store):
+    group_uuid, complex_uuid, other_complex_uuid = uuid4(), uuid4(), uuid4()
+
+    assert not memory_store.group_associations_exist()
+
+    memory_store.create_group_association(group_uuid, complex_uuid, commit=True)
+    memory_store.create_group_association(str(group_uuid), other_complex_uuid, commit=True)
+    memory_store.create_group_association(group_uuid, complex_uuid, commit=True)
+
+    assert memory_store.group_associations_exist()
+    assert sorted(memory_store.get_group_associations([group_uuid, uuid4()])) == sorted([
+        GroupAssociation(str(group_uuid), str(complex_uuid)),
+        GroupAssociation(str(group_uuid), str(other_complex_uuid)),
+    ])
+    assert list(memory_store.iter_group_complex_uuids(group_uuid)) == sorted([complex_uuid, other_complex_uuid])
+
+    memory_store.delete_group_association(group_uuid, complex_uuid, commit=True)
+    memory_store.delete_group_association(group_uuid, other_complex_uuid, commit=True)
+
+    assert not memory_store.group_associations_exist()
+    assert memory_store.get_group_associations([group_uuid]) == []
+
+
+@pytest.fixture
+def exists_datastore(db_session):
+    return SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation, exists_on_miss=True
+    )
+
+
+def test_sqlalchemy_auth_datastore_exists_on_miss_checks_uuid_with_single_query(exists_datastore, db_session, fixtures):
+    datastore = exists_datastore
+    role, other_role = fixtures.Role(), fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    db_session.flush()
+
+    with count_statements(db_session) as statements:
+        assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    assert len(statements) == 1
+    assert 'EXISTS' in statements[0]
+
+    datastore.cache._refresh_queue.join()
+
+    with count_statements(db_session) as statements:
+        assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+        assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[other_role.uuid])
+
+    assert statements == []
+    assert datastore.cache.get(str(permission.uuid)) == {str(role.uuid)}
+
+
+def test_sqlalchemy_auth_datastore_exists_on_miss_checks_string_with_single_query(exists_datastore, db_session, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    db_session.flush()
+
+    # the string is loaded in the background after the first check, the roles after the second
+    for expected_statements in [1, 1, 0]:
+        with count_statements(db_session) as statements:
+            assert exists_datastore.is_permission_in_roles(permission_string=permission.permission, role_uuids=[role.uuid])
+
+        assert len(statements) == expected_statements
+        exists_datastore.cache._refresh_queue.join()
+
+    assert not exists_datastore.is_permission_in_roles(permission_string=permission.permission, role_uuids=[uuid4()])
+    assert exists_datastore.cache.get(_permission_string_key(permission.permission)) == str(permission.uuid)
+
+
+def test_sqlalchemy_auth_datastore_exists_on_miss_caches_unknown_permission_string(exists_datastore):
+    assert not exists_datastore.is_permission_in_roles(permission_string='unknown', role_uuids=[uuid4()])
+    exists_datastore.cache._refresh_queue.join()
+
+    assert exists_datastore.cache.get(_permission_string_key('unknown')) == ''
+
+
+def test_sqlalchemy_auth_datastore_exists_on_miss_ignores_invalid_role_uuids(exists_datastore, db_session):
+    with count_statements(db_session) as statements:
+        assert not exists_datastore.is_permission_in_roles(permission_uuid=uuid4(), role_uuids=['not-a-uuid'])
+
+    assert statements == []
+
+
+def test_sqlalchemy_auth_datastore_exists_on_miss_requires_auth_cache(db_session):
+    with pytest.raises(NotImplementedError):
+        SQLAlchemySessionAuthStore(
+            db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+            cache=SimpleCache(), exists_on_miss=True
+        )
+
+
+def test_sqlalchemy_auth_datastore_exists_on_miss_requires_scoped_session(db_connection):
+    with pytest.raises(NotImplementedError):
+        SQLAlchemySessionAuthStore(
+            Session(bind=db_connection), Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+            exists_on_miss=True
+        )
+
+
+def test_sqlalchemy_auth_datastore_with_plain_session_reloads_stale_roles_in_the_request(
+        db_connection, db_session, fixtures
+):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    db_session.flush()
+    datastore = SQLAlchemySessionAuthStore(
+        Session(bind=db_connection), Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+        cache=AuthCache(stale_timeout=3600)
+    )
+    with patch('thunderstorm_auth.cache.time.time', return_value=100):
+        datastore.cache.set(str(permission.uuid), set(), timeout=10)
+
+    with patch('thunderstorm_auth.cache.time.time', return_value=200), \
+            patch.object(datastore.cache, '_schedule_refresh') as m_schedule_refresh:
+        assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    assert not datastore.refreshes_in_background
+    assert not m_schedule_refresh.called
+
+
+def test_sqlalchemy_auth_datastore_runs_background_queries_in_background_context(db_session, fixtures):
+    permission = fixtures.Permission()
+    background_context = MagicMock()
+    datastore = SQLAlchemySessionAuthStore(
+        db_session, Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation,
+        background_context=background_context
+    )
+
+    with patch.object(datastore, '_remove_thread_session') as m_remove_thread_session:
+        assert datastore._refresh_permission_uuid(permission.permission) == str(permission.uuid)
+
+    assert background_context.return_value.__enter__.called
+    assert background_context.return_value.__exit__.called
+    assert m_remove_thread_session.called
+
+
+def test_in_memory_auth_store_update_group_associations(memory_store):
+    group_uuid, kept_uuid, removed_uuid, new_uuid = uuid4(), uuid4(), uuid4(), uuid4()
+    memory_store.create_group_association(group_uuid, kept_uuid)
+    memory_store.create_group_association(group_uuid, removed_uuid)
+
+    assert memory_store.update_group_associations(group_uuid, [removed_uuid], [str(new_uuid)], commit=True) == (1, 1)
+    assert list(memory_store.iter_group_complex_uuids(group_uuid)) == sorted([kept_uuid, new_uuid])
+    assert memory_store.update_group_associations(group_uuid, [kept_uuid, new_uuid], []) == (0, 2)
+    assert not memory_store.group_associations_exist()
+
+
+def test_in_memory_auth_store_apply_role(memory_store):
+    role_uuid = uuid4()
+    permission_a, permission_b = memory_store.get_permission_uuid('perm-a'), memory_store.get_permission_uuid('perm-b')
+
+    assert memory_store.apply_role(role_uuid, 'test', [permission_a, uuid4()]) == ({permission_a}, set())
+    assert memory_store.get_role(role_uuid).type == 'test'
+    assert memory_store.apply_role(role_uuid, 'test', [permission_b]) == ({permission_b}, {permission_a})
+    assert memory_store.is_permission_in_roles(permission_string='perm-b', role_uuids=[role_uuid])
+    assert not memory_store.is_permission_in_roles(permission_string='perm-a', role_uuids=[role_uuid])
+
+
+def test_in_memory_auth_store_replace_role_permissions(memory_store):
+    role_uuid = uuid4()
+    permission_a, permission_b = memory_store.get_permission_uuid('perm-a'), memory_store.get_permission_uuid('perm-b')
+    memory_store.apply_role(role_uuid, 'test', [permission_a, permission_b])
+
+    assert memory_store.replace_role_permissions(role_uuid, [permission_b]) == {permission_a}
+    assert [str(p.uuid) for p in memory_store.get_role_permissions(role_uuid)] == [permission_b]
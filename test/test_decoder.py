@@ -1,7 +1,18 @@
+from datetime import datetime, timedelta
+import json
+import time
+from unittest.mock import patch
+
+import jwt
+from jwt.utils import base64url_decode, base64url_encode
 import pytest
 
-from thunderstorm_auth.decoder import decode_token, get_kid_and_alg_headers_from_token
+from thunderstorm_auth.cache import RejectedTokenCache, TokenCache
+from thunderstorm_auth.decoder import (
+    decode_token, get_kid_and_alg_headers_from_token, _split_token, _verify_and_decode
+)
 from thunderstorm_auth.exceptions import (ExpiredTokenError, BrokenTokenError, MissingKeyErrror, TokenDecodeError)
+from thunderstorm_auth.jwks import get_key_registry
 
 
 def test_decode_token_returns_if_jwt_valid(access_token, jwk_set):
@@ -55,3 +66,157 @@ def test_get_headers_from_token_raises_BrokenTokenError_if_headers_are_missing()
 def test_decode_valid_token_with_invalid_key(token_signed_with_incorrect_key, jwk_set):
     with pytest.raises(TokenDecodeError):
         decode_token(token_signed_with_incorrect_key, jwk_set)
+
+
+def test_decode_token_with_cache_verifies_token_once(access_token, jwk_set):
+    cache = TokenCache()
+
+    with patch('thunderstorm_auth.decoder._verify_and_decode', wraps=_verify_and_decode) as m_verify_and_decode:
+        first = decode_token(access_token, jwk_set, cache=cache)
+        second = decode_token(access_token, jwk_set, cache=cache)
+
+    assert first == second
+    assert m_verify_and_decode.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_decode_token_with_cache_does_not_cache_expired_tokens(access_token_expired_with_permissions, jwk_set):
+    cache = TokenCache()
+
+    for _ in range(2):
+        with pytest.raises(ExpiredTokenError):
+            decode_token(access_token_expired_with_permissions, jwk_set, cache=cache)
+
+    assert len(cache) == 0
+
+
+def test_decode_token_with_cache_expires_entries_with_leeway(access_token_expired_with_permissions, jwk_set):
+    cache = TokenCache()
+
+    assert decode_token(access_token_expired_with_permissions, jwk_set, leeway=3605, cache=cache)
+    assert decode_token(access_token_expired_with_permissions, jwk_set, leeway=3605, cache=cache)
+    assert cache.hits == 1
+
+
+def test_decode_token_with_cache_is_bypassed_when_options_are_passed(access_token, jwk_set):
+    cache = TokenCache()
+
+    assert decode_token(access_token, jwk_set, options={'verify_exp': False}, cache=cache)
+    assert len(cache) == 0
+
+
+def test_decode_token_with_rejected_cache_rejects_repeat_offenders_without_decoding(malformed_token, jwk_set):
+    rejected_cache = RejectedTokenCache()
+
+    with pytest.raises(BrokenTokenError):
+        decode_token(malformed_token, jwk_set, rejected_cache=rejected_cache)
+
+    with patch('thunderstorm_auth.decoder._decode_token') as m_decode_token:
+        with pytest.raises(BrokenTokenError):
+            decode_token(malformed_token, jwk_set, rejected_cache=rejected_cache)
+
+    assert not m_decode_token.called
+    assert rejected_cache.hits == 1
+
+
+def test_decode_token_with_rejected_cache_does_not_reject_valid_tokens(access_token, jwk_set):
+    rejected_cache = RejectedTokenCache()
+
+    assert decode_token(access_token, jwk_set, rejected_cache=rejected_cache)
+    assert len(rejected_cache) == 0
+
+
+def test_decode_token_fast_path_matches_pyjwt(access_token, jwk_set, jwk):
+    public_key = get_key_registry(jwk_set).get_key(jwk['kid'])
+
+    assert decode_token(access_token, jwk_set) == jwt.decode(access_token, key=public_key, algorithms=['RS512'])
+
+
+@pytest.mark.parametrize('claims', [
+    {'exp': int(time.time()) - 300},
+    {'exp': 'tomorrow'},
+    {'nbf': int(time.time()) + 3600},
+    {'nbf': 'soon'},
+    {'iat': 'now'},
+    {'aud': 'someone-else'},
+])
+def test_decode_token_fast_path_raises_the_same_errors_as_pyjwt(claims, access_token_payload, private_key, jwk):
+    payload = dict(access_token_payload, iat=int(time.time()), exp=int(time.time()) + 900)
+    payload.update(claims)
+    token = jwt.encode(payload, private_key, algorithm='RS512', headers={'kid': jwk['kid']}).decode()
+    public_key = get_key_registry({'keys': [jwk]}).get_key(jwk['kid'])
+
+    with pytest.raises(jwt.exceptions.InvalidTokenError) as pyjwt_error:
+        jwt.decode(token, key=public_key, algorithms=['RS512'])
+    with pytest.raises(jwt.exceptions.InvalidTokenError) as fast_path_error:
+        _verify_and_decode(_split_token(token), public_key, 'RS512', 0)
+
+    assert type(fast_path_error.value) is type(pyjwt_error.value)
+
+
+def test_decode_token_uses_pyjwt_when_options_are_passed(access_token, jwk_set):
+    with patch('thunderstorm_auth.decoder.jwt.decode', wraps=jwt.decode) as m_decode:
+        assert decode_token(access_token, jwk_set, options={'verify_exp': False})
+
+    assert m_decode.call_count == 1
+
+
+def test_decode_token_raises_if_jwt_signature_segment_is_malformed(access_token, jwk_set):
+    with pytest.raises(BrokenTokenError):
+        decode_token(access_token + '!', jwk_set)
+
+
+def test_decode_token_raises_if_jwt_not_yet_valid(make_token, access_token_payload, jwk_set):
+    access_token_payload['nbf'] = datetime.utcnow() + timedelta(hours=1)
+
+    with pytest.raises(jwt.exceptions.ImmatureSignatureError):
+        decode_token(make_token(access_token_payload), jwk_set)
+
+
+def test_decode_token_raises_if_jwt_has_an_audience(make_token, access_token_payload, jwk_set):
+    access_token_payload['aud'] = 'someone-else'
+
+    with pytest.raises(jwt.exceptions.InvalidAudienceError):
+        decode_token(make_token(access_token_payload), jwk_set)
+
+
+def test_decode_token_with_cache_verifies_token_again_after_key_rotation(access_token, jwk_set, jwk):
+    cache = TokenCache()
+    assert decode_token(access_token, jwk_set, cache=cache)
+
+    with pytest.raises(MissingKeyErrror):
+        decode_token(access_token, {'keys': [k for k in jwk_set['keys'] if k['kid'] != jwk['kid']]}, cache=cache)
+
+    assert decode_token(access_token, jwk_set, leeway=10, cache=cache)
+    assert cache.hits == 0
+
+
+def test_decode_token_with_rejected_cache_does_not_reject_tokens_of_missing_keys(access_token, jwk_set):
+    rejected_cache = RejectedTokenCache()
+
+    with pytest.raises(MissingKeyErrror):
+        decode_token(access_token, {'keys': []}, rejected_cache=rejected_cache)
+
+    assert len(rejected_cache) == 0
+    assert decode_token(access_token, jwk_set, rejected_cache=rejected_cache)
+
+
+@pytest.mark.parametrize('headers', [{'alg': ['RS512']}, {'kid': {'id': 'key'}}])
+def test_decode_token_raises_if_jwt_headers_are_not_strings(headers, access_token, jwk_set):
+    header = json.loads(base64url_decode(access_token.split('.')[0].encode()).decode())
+    header.update(headers)
+    token = '.'.join([base64url_encode(json.dumps(header).encode()).decode()] + access_token.split('.')[1:])
+
+    with pytest.raises(BrokenTokenError):
+        decode_token(token, jwk_set)
+
+
+@pytest.mark.parametrize('claims', [{'exp': [1]}, {'nbf': {}}, {'iat': None}])
+def test_decode_token_fast_path_rejects_claims_of_the_wrong_type(claims, access_token_payload, private_key, jwk):
+    payload = dict(access_token_payload, iat=int(time.time()), exp=int(time.time()) + 900)
+    payload.update(claims)
+    token = jwt.encode(payload, private_key, algorithm='RS512', headers={'kid': jwk['kid']}).decode()
+    public_key = get_key_registry({'keys': [jwk]}).get_key(jwk['kid'])
+
+    with pytest.raises(jwt.exceptions.InvalidTokenError):
+        _verify_and_decode(_split_token(token), public_key, 'RS512', 0)
@@ -1,9 +1,13 @@
-from unittest.mock import patch, call, MagicMock
-from uuid import uuid4
+from unittest.mock import ANY, patch, call, MagicMock
+from uuid import UUID, uuid4
 
 import pytest
 from sqlalchemy.exc import DBAPIError
 
+from thunderstorm_auth.coalescing import SyncCoalescer
+from thunderstorm_auth.datastore import AuthStore, GroupAssociation
+from thunderstorm_auth.groups import _diff_members, _sorted_uuid_ints
+from thunderstorm_auth.setup import init_ts_auth_tasks
 from test.models import ComplexGroupComplexAssociation
 
 
@@ -31,6 +35,36 @@ def test_handle_group_data(m_group, db_session, celery, fixtures):
     m_add_group_association.si.assert_called_once_with(group_uuid, str(new_uuid))
 
 
+class GroupsOnlyAuthStore(AuthStore):
+    """Custom store implementing the group lookups of the baseline interface only"""
+
+    def __init__(self, associations):
+        AuthStore.__init__(self, None, None, None, None)
+        self.associations = associations
+
+    def get_group_associations(self, group_uuids):
+        return [a for a in self.associations if a.group_uuid in group_uuids]
+
+
+def test_handle_group_data_with_store_without_streamed_complexes(celery_app):
+    group_uuid, kept_uuid, removed_uuid, new_uuid = uuid4(), uuid4(), uuid4(), uuid4()
+    datastore = GroupsOnlyAuthStore([GroupAssociation(group_uuid, str(u)) for u in (kept_uuid, removed_uuid)])
+    init_ts_auth_tasks(celery_app, datastore)
+    celery_app.set_current()
+    handle_group_data = celery_app.tasks['ts_auth.group.complex.sync']
+
+    m_add, m_delete = MagicMock(), MagicMock()
+
+    with patch('thunderstorm_auth.groups.group'), patch.dict(celery_app.tasks, {
+        'thunderstorm_auth.groups.add_group_association': m_add,
+        'thunderstorm_auth.groups.delete_group_association': m_delete,
+    }):
+        handle_group_data(group_uuid, [str(kept_uuid), str(new_uuid)])
+
+    m_delete.si.assert_called_once_with(group_uuid, str(removed_uuid))
+    m_add.si.assert_called_once_with(group_uuid, str(new_uuid))
+
+
 def test_add_group_association_creates_group_association(db_session, celery, fixtures):
     add_group_association = celery.tasks['thunderstorm_auth.groups.add_group_association']
 
@@ -87,3 +121,121 @@ def test_delete_group_association_keeps_going_if_group_association_does_not_exis
     delete_group_association(group_uuid, complex_uuid)
 
     assert db_session.query(ComplexGroupComplexAssociation).count() == 0
+
+
+@pytest.mark.parametrize('has_associations', [False, True])
+@patch('thunderstorm_auth.groups.current_app')
+def test_request_groups_republish_only_without_group_associations(m_current_app, has_associations, celery, fixtures):
+    request_groups_republish = celery.tasks['auth.request_groups_republish']
+    if has_associations:
+        fixtures.ComplexGroupComplexAssociation()
+
+    request_groups_republish()
+
+    assert m_current_app.send_task.called != has_associations
+
+
+def test_handle_group_data_bulk_sync_applies_memberships_in_one_transaction(celery_app, datastore, db_session, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True)
+    celery_app.set_current()
+    handle_group_data = celery_app.tasks['ts_auth.group.complex.sync']
+
+    group_uuid = uuid4()
+    new_uuid = uuid4()
+    complex_uuids = [fixtures.ComplexGroupComplexAssociation(group_uuid=group_uuid).complex_uuid for _ in range(4)]
+
+    with patch('thunderstorm_auth.groups.group') as m_group, \
+            patch.object(db_session, 'commit', wraps=db_session.commit) as m_commit:
+        handle_group_data(group_uuid, [str(new_uuid)] + [str(c) for c in complex_uuids[:2]])
+
+    assert not m_group.called
+    m_commit.assert_called_once_with()
+    assert {a.complex_uuid for a in datastore.get_group_associations([group_uuid])} == {new_uuid} | set(complex_uuids[:2])
+
+
+def test_handle_group_data_bulk_sync_writes_only_the_streamed_changes(celery_app, datastore, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True)
+    celery_app.set_current()
+    handle_group_data = celery_app.tasks['ts_auth.group.complex.sync']
+    group_uuid, new_uuid = uuid4(), uuid4()
+    complex_uuids = [fixtures.ComplexGroupComplexAssociation(group_uuid=group_uuid).complex_uuid for _ in range(3)]
+
+    with patch.object(datastore, 'iter_group_complex_uuids', wraps=datastore.iter_group_complex_uuids) as m_iter, \
+            patch.object(datastore, 'update_group_associations') as m_update:
+        handle_group_data(group_uuid, [str(new_uuid)] + [str(c) for c in complex_uuids[1:]])
+
+    m_iter.assert_called_once_with(group_uuid)
+    m_update.assert_called_once_with(group_uuid, [complex_uuids[0]], [new_uuid], commit=True)
+
+
+def test_handle_group_data_skips_memberships_identical_to_last_applied(celery_app, datastore):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True, coalescer=SyncCoalescer())
+    celery_app.set_current()
+    handle_group_data = celery_app.tasks['ts_auth.group.complex.sync']
+    group_uuid = uuid4()
+    complex_uuids = [str(uuid4()) for _ in range(3)]
+
+    with patch.object(datastore, 'update_group_associations', wraps=datastore.update_group_associations) as m_update:
+        handle_group_data(group_uuid, complex_uuids)
+        handle_group_data(str(group_uuid), complex_uuids[::-1])
+
+    m_update.assert_called_once_with(group_uuid, [], sorted(UUID(c) for c in complex_uuids), commit=True)
+
+
+def test_handle_group_data_skips_memberships_identical_to_last_applied_without_bulk_sync(celery_app, datastore):
+    init_ts_auth_tasks(celery_app, datastore, coalescer=SyncCoalescer())
+    celery_app.set_current()
+    handle_group_data = celery_app.tasks['ts_auth.group.complex.sync']
+    group_uuid = uuid4()
+    complex_uuids = [str(uuid4()) for _ in range(3)]
+
+    with patch('thunderstorm_auth.groups.group') as m_group:
+        handle_group_data(group_uuid, complex_uuids)
+        handle_group_data(group_uuid, complex_uuids[::-1])
+
+    # one group of deletions and one of additions for the first memberships only
+    assert m_group.call_count == 2
+
+
+def test_handle_group_data_debounce_sends_memberships_back_to_group_queue(celery_app, datastore):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True, coalescer=SyncCoalescer(debounce=1))
+    celery_app.set_current()
+    handle_group_data = celery_app.tasks['ts_auth.group.complex.sync']
+    group_uuid = uuid4()
+    complex_uuids = [str(uuid4())]
+
+    with patch.object(handle_group_data, 'apply_async') as m_apply_async, \
+            patch.object(datastore, 'update_group_associations') as m_update:
+        handle_group_data(group_uuid, complex_uuids)
+
+    assert not m_update.called
+    m_apply_async.assert_called_once_with((group_uuid, complex_uuids), {'debounced': True}, countdown=1, queue=ANY)
+    queue = m_apply_async.call_args[1]['queue']
+    assert queue.name == '{}.ts_auth.group'.format(celery_app.main)
+
+
+def test_handle_group_data_debounce_publishes_to_own_queue_only(celery_app, datastore):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True, coalescer=SyncCoalescer(debounce=1))
+    celery_app.set_current()
+    handle_group_data = celery_app.tasks['ts_auth.group.complex.sync']
+
+    with patch('kombu.messaging.Producer.publish') as m_publish:
+        handle_group_data(uuid4(), [str(uuid4())])
+
+    # the default exchange routes to the queue named by the routing key, not to the other services' queues
+    # bound to ts.messaging
+    options = m_publish.call_args[1]
+    assert options['exchange'] == ''
+    assert options['routing_key'] == '{}.ts_auth.group'.format(celery_app.main)
+
+
+def test_diff_members_merges_sorted_members():
+    members = sorted(uuid4() for _ in range(6))
+    current = [members[0], members[2], members[3], members[5]]
+    latest = [str(members[1]), str(members[3]), str(members[4]), str(members[3])]
+
+    removed, added = _diff_members(iter(current), _sorted_uuid_ints(latest))
+
+    assert removed == [members[0].int, members[2].int, members[5].int]
+    assert added == [members[1].int, members[4].int]
+    assert _diff_members(iter([]), []) == ([], [])
@@ -0,0 +1,112 @@
+import json
+from os import environ
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+import redis
+
+from thunderstorm_auth.exceptions import ThunderstormAuthError
+from thunderstorm_auth.invalidation import RedisInvalidationBroadcaster
+
+
+@pytest.fixture
+def broadcaster():
+    broadcaster = RedisInvalidationBroadcaster(client=Mock(spec=redis.Redis), channel='test-channel')
+    yield broadcaster
+    broadcaster.stop()
+
+
+def _message(origin, keys):
+    return json.dumps({'origin': origin, 'keys': keys}).encode('utf-8')
+
+
+def test_redis_invalidation_broadcaster_requires_redis():
+    with patch('thunderstorm_auth.invalidation.HAS_REDIS', False):
+        with pytest.raises(ThunderstormAuthError):
+            RedisInvalidationBroadcaster()
+
+
+def test_redis_invalidation_broadcaster_publishes_keys(broadcaster):
+    broadcaster.publish(['key-a', 'key-b'])
+
+    channel, message = broadcaster.client.publish.call_args[0]
+    assert channel == 'test-channel'
+    assert json.loads(message)['keys'] == ['key-a', 'key-b']
+
+
+def test_redis_invalidation_broadcaster_does_not_publish_empty_keys(broadcaster):
+    broadcaster.publish([])
+
+    assert not broadcaster.client.publish.called
+
+
+def test_redis_invalidation_broadcaster_logs_publish_errors(broadcaster):
+    broadcaster.client.publish.side_effect = redis.ConnectionError
+
+    with patch('thunderstorm_auth.invalidation.logger') as m_logger:
+        broadcaster.publish(['key-a'])
+
+    assert m_logger.error.called
+
+
+def test_redis_invalidation_broadcaster_calls_callbacks_with_keys_of_other_processes(broadcaster):
+    callback = Mock()
+    broadcaster._callbacks.append(callback)
+
+    broadcaster._handle(_message('other-process', ['key-a']))
+
+    callback.assert_called_once_with(['key-a'])
+
+
+def test_redis_invalidation_broadcaster_ignores_own_messages(broadcaster):
+    callback = Mock()
+    broadcaster._callbacks.append(callback)
+    broadcaster.publish(['key-a'])
+
+    broadcaster._handle(broadcaster.client.publish.call_args[0][1])
+
+    assert not callback.called
+
+
+def test_redis_invalidation_broadcaster_ignores_malformed_messages(broadcaster):
+    callback = Mock()
+    broadcaster._callbacks.append(callback)
+
+    broadcaster._handle(b'not json')
+    broadcaster._handle(json.dumps({'keys': ['key-a']}))
+
+    assert not callback.called
+
+
+def test_redis_invalidation_broadcaster_listens_once_per_process(broadcaster):
+    with patch('thunderstorm_auth.invalidation.threading.Thread') as m_thread:
+        broadcaster.ensure_listening()
+        assert not m_thread.called
+
+        broadcaster.subscribe(Mock())
+        broadcaster.ensure_listening()
+
+    assert m_thread.call_count == 1
+
+
+def test_redis_invalidation_broadcaster_between_processes():
+    client = redis.Redis(host=environ['REDIS_HOST'], db=environ['REDIS_DB'])
+    publisher = RedisInvalidationBroadcaster(client=client, channel='test-invalidation')
+    subscriber = RedisInvalidationBroadcaster(client=client, channel='test-invalidation')
+    received = threading.Event()
+    keys = []
+
+    def _callback(invalidated_keys):
+        keys.extend(invalidated_keys)
+        received.set()
+
+    try:
+        subscriber.subscribe(_callback)
+        # publish until the subscriber thread is connected to the channel
+        while not received.wait(0.1):
+            publisher.publish(['key-a'])
+    finally:
+        subscriber.stop()
+
+    assert keys[0] == 'key-a'
@@ -0,0 +1,275 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import threading
+import time
+from unittest.mock import patch
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+import pytest
+
+from thunderstorm_auth.decoder import decode_token
+from thunderstorm_auth.exceptions import MissingKeyErrror
+from thunderstorm_auth.jwks import KeyRegistry, JWKSFileProvider, RemoteJWKSProvider, get_key_registry
+from thunderstorm_auth import utils
+from thunderstorm_auth.logging import requests
+
+
+def test_key_registry_indexes_keys_by_kid(jwk_set, jwk, alternate_jwk):
+    registry = KeyRegistry(jwk_set)
+
+    assert len(registry) == 2
+    assert jwk['kid'] in registry
+    assert alternate_jwk['kid'] in registry
+    assert isinstance(registry.get_key(jwk['kid']), rsa.RSAPublicKey)
+
+
+def test_key_registry_supports_deprecated_dict_format(jwk):
+    registry = KeyRegistry({'keys': {jwk['kid']: jwk}})
+
+    assert jwk['kid'] in registry
+
+
+def test_key_registry_raises_key_error_on_unknown_kid(jwk_set):
+    with pytest.raises(KeyError):
+        KeyRegistry(jwk_set).get_key('unknown')
+
+
+def test_key_registry_skips_unusable_keys(jwk_set, jwk, private_key):
+    jwks = {'keys': jwk_set['keys'] + [
+        {'kid': 'not-rsa', 'kty': 'EC', 'crv': 'P-256', 'x': 'bad', 'y': 'bad'},
+        {'kid': ['unhashable'], 'kty': 'RSA'},
+        {'kty': 'RSA'},
+        'not-a-jwk',
+    ]}
+
+    registry = KeyRegistry(jwks)
+
+    assert isinstance(registry.get_key(jwk['kid']), rsa.RSAPublicKey)
+    with pytest.raises(KeyError):
+        registry.get_key('not-rsa')
+    with pytest.raises(KeyError):
+        registry.get_key(['unhashable'])
+
+    token = utils.encode_token(private_key, jwk['kid'], {'username': 'test-user'})
+    assert decode_token(token, jwks)['username'] == 'test-user'
+    with pytest.raises(MissingKeyErrror):
+        decode_token(utils.encode_token(private_key, 'not-rsa', {'username': 'test-user'}), jwks)
+
+
+def test_get_key_registry_builds_keys_once_per_jwk_set(jwk_set, jwk):
+    with patch('thunderstorm_auth.jwks.load_public_key') as m_load_public_key:
+        registry = get_key_registry(jwk_set)
+        registry.get_key(jwk['kid'])
+
+        assert get_key_registry(jwk_set) is registry
+        registry.get_key(jwk['kid'])
+        assert m_load_public_key.call_count == 1
+
+
+def test_get_key_registry_rebuilds_when_jwk_set_object_changes(jwk_set):
+    registry = get_key_registry(jwk_set)
+
+    assert get_key_registry({'keys': list(jwk_set['keys'])}) is not registry
+
+
+def test_get_key_registry_returns_registry_as_is(jwk_set):
+    registry = KeyRegistry(jwk_set)
+
+    assert get_key_registry(registry) is registry
+
+
+@pytest.fixture
+def jwks_file(tmpdir, jwk):
+    path = tmpdir.join('jwks.json')
+    path.write(json.dumps({'keys': [jwk]}))
+    return path
+
+
+def _rewrite(path, jwks):
+    stat = os.stat(str(path))
+    path.write(json.dumps(jwks))
+    # make sure the mtime changes even on filesystems with a coarse resolution
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_jwks_file_provider_loads_jwk_set(jwks_file, jwk):
+    provider = JWKSFileProvider(str(jwks_file))
+
+    assert provider.jwks == {'keys': [jwk]}
+    assert get_key_registry(provider) is provider.key_registry
+    assert jwk['kid'] in provider.key_registry
+
+
+def test_jwks_file_provider_raises_if_jwk_set_is_invalid(tmpdir):
+    path = tmpdir.join('jwks.json')
+    path.write(json.dumps({'keys': []}))
+
+    with pytest.raises(ValueError):
+        JWKSFileProvider(str(path))
+
+
+def test_jwks_file_provider_swaps_registry_when_file_changes(jwks_file, jwk, alternate_jwk):
+    provider = JWKSFileProvider(str(jwks_file), check_interval=0)
+    registry = provider.key_registry
+
+    assert provider.key_registry is registry
+
+    _rewrite(jwks_file, {'keys': [alternate_jwk]})
+
+    assert provider.key_registry is not registry
+    assert alternate_jwk['kid'] in provider.key_registry
+    assert jwk['kid'] not in provider.key_registry
+
+
+def test_jwks_file_provider_checks_file_at_most_once_per_interval(jwks_file, alternate_jwk):
+    provider = JWKSFileProvider(str(jwks_file), check_interval=3600)
+
+    _rewrite(jwks_file, {'keys': [alternate_jwk]})
+
+    with patch('thunderstorm_auth.jwks.os.stat') as m_stat:
+        assert alternate_jwk['kid'] not in provider.key_registry
+
+    assert not m_stat.called
+
+
+def test_jwks_file_provider_keeps_registry_if_new_file_is_invalid(jwks_file, jwk):
+    provider = JWKSFileProvider(str(jwks_file), check_interval=0)
+
+    _rewrite(jwks_file, {'keys': []})
+
+    assert jwk['kid'] in provider.key_registry
+
+
+@pytest.fixture
+def jwks_server(jwk):
+    """Local stub of the user service JWK set endpoint"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.requests += 1
+            body = json.dumps(server.jwks).encode('utf-8')
+            self.send_response(server.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.jwks = {'keys': [jwk]}
+    server.status = 200
+    server.requests = 0
+    server.url = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(server.server_port)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def remote_provider(jwks_server):
+    provider = RemoteJWKSProvider(jwks_server.url, unknown_kid_cooldown=3600)
+    assert provider.wait_until_loaded(5)
+    yield provider
+    provider.stop()
+
+
+def test_remote_jwks_provider_fetches_jwk_set(remote_provider, jwks_server, jwk, access_token):
+    assert remote_provider.jwks == {'keys': [jwk]}
+    assert decode_token(access_token, remote_provider)
+    assert jwks_server.requests == 1
+
+
+def test_remote_jwks_provider_refetches_on_unknown_kid(remote_provider, jwks_server, jwk, alternate_jwk, alternate_private_key):
+    jwks_server.jwks = {'keys': [jwk, alternate_jwk]}
+    token = utils.encode_token(alternate_private_key, alternate_jwk['kid'], {'username': 'test-user'})
+
+    assert decode_token(token, remote_provider)
+    assert jwks_server.requests == 2
+
+
+def test_remote_jwks_provider_refetches_unknown_kids_once_per_cooldown(remote_provider, jwks_server, alternate_private_key):
+    tokens = [utils.encode_token(alternate_private_key, 'unknown-{}'.format(i), {'username': 'test-user'}) for i in range(10)]
+
+    for token in tokens:
+        with pytest.raises(MissingKeyErrror):
+            decode_token(token, remote_provider)
+
+    assert jwks_server.requests == 2
+
+
+def test_remote_jwks_provider_refreshes_in_background(jwks_server, jwk, alternate_jwk):
+    provider = RemoteJWKSProvider(jwks_server.url, ttl=0.2, refresh_margin=0.1)
+
+    try:
+        assert provider.wait_until_loaded(5)
+        assert jwk['kid'] in provider.key_registry
+        jwks_server.jwks = {'keys': [alternate_jwk]}
+
+        deadline = time.monotonic() + 5
+        while alternate_jwk['kid'] not in provider.key_registry and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert alternate_jwk['kid'] in provider.key_registry
+    finally:
+        provider.stop()
+
+
+def test_remote_jwks_provider_keeps_keys_if_refresh_fails(remote_provider, jwks_server, jwk):
+    jwks_server.status = 500
+
+    assert not remote_provider.refresh()
+    assert jwk['kid'] in remote_provider.key_registry
+
+
+def test_remote_jwks_provider_starts_empty_if_user_service_is_unavailable(jwks_server):
+    jwks_server.status = 503
+    provider = RemoteJWKSProvider(jwks_server.url)
+
+    assert not provider.wait_until_loaded(0.5)
+    provider.stop()
+
+    assert len(provider.key_registry) == 0
+
+
+def test_remote_jwks_provider_loads_keys_in_background(jwks_server, jwk, access_token):
+    with patch('thunderstorm_auth.jwks.requests.get', wraps=requests.get) as m_get:
+        jwks_server.status = 503
+        provider = RemoteJWKSProvider(jwks_server.url, retry_interval=3600)
+
+        # building the provider does not wait on the user service
+        assert len(provider.key_registry) == 0
+        assert not provider.wait_until_loaded(0.5)
+
+        jwks_server.status = 200
+        try:
+            assert decode_token(access_token, provider)
+        finally:
+            provider.stop()
+
+    assert m_get.called
+
+
+def test_remote_jwks_provider_unknown_kids_share_a_single_fetch(remote_provider, jwks_server, jwk, alternate_jwk,
+                                                               alternate_private_key):
+    jwks_server.jwks = {'keys': [jwk, alternate_jwk]}
+    token = utils.encode_token(alternate_private_key, alternate_jwk['kid'], {'username': 'test-user'})
+    refresh = remote_provider.refresh
+
+    def _slow_refresh():
+        time.sleep(0.2)
+        return refresh()
+
+    with patch.object(remote_provider, 'refresh', side_effect=_slow_refresh):
+        threads = [threading.Thread(target=decode_token, args=(token, remote_provider)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert jwks_server.requests == 2
+    assert alternate_jwk['kid'] in remote_provider.key_registry
@@ -1,8 +1,12 @@
+from unittest.mock import patch
 from uuid import uuid4
 
 import pytest
 from sqlalchemy.exc import IntegrityError
 
+from thunderstorm_auth.coalescing import SyncCoalescer
+from thunderstorm_auth.datastore import InMemoryAuthStore
+from thunderstorm_auth.setup import init_ts_auth_tasks
 from test.models import Role, RolePermissionAssociation
 
 
@@ -41,6 +45,18 @@ def test_create_role_permission_association_if_not_exists_task_succeed_and_creat
     ).one()
 
 
+def test_create_role_permission_association_if_not_exists_task_invalidates_cached_roles(datastore, celery, fixtures):
+    create_role_permission_association_if_not_exists = celery.tasks['thunderstorm_auth.roles.create_role_permission_association_if_not_exists']
+    role = fixtures.Role()
+    permission = fixtures.Permission()
+
+    assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+    create_role_permission_association_if_not_exists(role.uuid, permission.uuid)
+
+    assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+
 def test_create_role_permission_association_if_not_exists_task_succeed_if_association_already_exists(db_session, celery, fixtures):
     create_role_permission_association_if_not_exists = celery.tasks['thunderstorm_auth.roles.create_role_permission_association_if_not_exists']
     role = fixtures.Role()
@@ -92,6 +108,18 @@ def test_remove_role_orphan_permission_associations_none_permissions(db_session,
     assert not db_session.query(RolePermissionAssociation).count()
 
 
+def test_remove_role_orphan_permission_associations_commits_once(db_session, celery, fixtures):
+    remove_role_orphan_permission_associations = celery.tasks['thunderstorm_auth.roles.remove_role_orphan_permission_associations']
+    role = fixtures.Role()
+    [fixtures.Permission(roles=[role]) for i in range(5)]
+
+    with patch.object(db_session, 'commit', wraps=db_session.commit) as m_commit:
+        remove_role_orphan_permission_associations(role.uuid, [])
+
+    m_commit.assert_called_once_with()
+    assert not db_session.query(RolePermissionAssociation).count()
+
+
 def test_remove_role_orphan_permission_associations_removes_stale_permissions(db_session, celery, fixtures):
     remove_role_orphan_permission_associations = celery.tasks['thunderstorm_auth.roles.remove_role_orphan_permission_associations']
     role = fixtures.Role()
@@ -107,3 +135,168 @@ def test_remove_role_orphan_permission_associations_removes_stale_permissions(db
     assert not db_session.query(RolePermissionAssociation).get((role.uuid, permissions[7].uuid))
     assert not db_session.query(RolePermissionAssociation).get((role.uuid, permissions[8].uuid))
     assert not db_session.query(RolePermissionAssociation).get((role.uuid, permissions[9].uuid))
+
+
+def test_handle_role_data_bulk_sync_applies_payload_in_one_transaction(celery_app, datastore, db_session, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True)
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    role_uuid = uuid4()
+    permissions = [fixtures.Permission() for _ in range(3)]
+    payload = {
+        'data': {
+            'uuid': str(role_uuid),
+            'type': 'test',
+            'permissions': [
+                {'uuid': str(permission.uuid), 'service': 'test', 'permission_string': permission.permission}
+                for permission in permissions
+            ] + [{'uuid': str(uuid4()), 'service': 'other', 'permission_string': 'other'}],
+        }
+    }
+
+    with patch('thunderstorm_auth.roles.chain') as m_chain, \
+            patch.object(db_session, 'commit', wraps=db_session.commit) as m_commit:
+        handle_role_data(payload)
+
+    assert not m_chain.called
+    m_commit.assert_called_once_with()
+    assert {p.uuid for p in datastore.get_role_permissions(role_uuid)} == {p.uuid for p in permissions}
+
+
+def _role_payload(role_uuid, permissions):
+    return {
+        'data': {
+            'uuid': str(role_uuid),
+            'type': 'test',
+            'permissions': [
+                {'uuid': str(permission.uuid), 'service': 'test', 'permission_string': permission.permission}
+                for permission in permissions
+            ],
+        }
+    }
+
+
+def test_handle_role_data_feeds_in_memory_store_of_the_worker(celery_app):
+    memory_store = InMemoryAuthStore(service_name='test')
+    init_ts_auth_tasks(celery_app, memory_store, bulk_sync=True)
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    role_uuid, permission_uuid = uuid4(), uuid4()
+    payload = {
+        'data': {
+            'uuid': str(role_uuid),
+            'type': 'test',
+            'permissions': [
+                {'uuid': str(permission_uuid), 'service': 'test', 'permission_string': 'perm-a'},
+                {'uuid': str(uuid4()), 'service': 'other', 'permission_string': 'perm-b'},
+            ],
+        }
+    }
+
+    handle_role_data(payload)
+
+    # the permissions of the service are learned from the payload, the other ones are ignored
+    assert memory_store.get_permission_uuid('perm-a') == str(permission_uuid)
+    assert memory_store.get_permission_uuid('perm-b') is None
+    assert memory_store.is_permission_in_roles(permission_string='perm-a', role_uuids=[role_uuid])
+    assert not memory_store.is_permission_in_roles(permission_string='perm-b', role_uuids=[role_uuid])
+
+
+def test_handle_role_data_accepts_payload_keyword(celery_app, datastore, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True)
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    role_uuid, permission = uuid4(), fixtures.Permission()
+
+    # producers may send the payload as a keyword argument
+    handle_role_data(payload=_role_payload(role_uuid, [permission]))
+
+    assert {p.uuid for p in datastore.get_role_permissions(role_uuid)} == {permission.uuid}
+
+
+def test_handle_role_data_skips_payload_identical_to_last_applied(celery_app, datastore, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True, coalescer=SyncCoalescer())
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    role_uuid = uuid4()
+    permissions = [fixtures.Permission() for _ in range(2)]
+
+    with patch.object(datastore, 'apply_role', wraps=datastore.apply_role) as m_apply_role:
+        handle_role_data(_role_payload(role_uuid, permissions))
+        handle_role_data(_role_payload(role_uuid, permissions[::-1]))
+        handle_role_data(_role_payload(role_uuid, permissions[:1]))
+
+    assert m_apply_role.call_count == 2
+    assert {p.uuid for p in datastore.get_role_permissions(role_uuid)} == {permissions[0].uuid}
+
+
+def test_handle_role_data_debounce_applies_latest_payload_only(celery_app, datastore, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True, coalescer=SyncCoalescer(debounce=2))
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    role_uuid = uuid4()
+    permissions = [fixtures.Permission() for _ in range(2)]
+    first, latest = _role_payload(role_uuid, permissions), _role_payload(role_uuid, permissions[:1])
+
+    with patch.object(handle_role_data, 'apply_async') as m_apply_async:
+        handle_role_data(first)
+        handle_role_data(latest)
+
+    assert m_apply_async.call_count == 2
+    assert m_apply_async.call_args[1]['countdown'] == 2
+    # sent back to the queue of this service only
+    assert m_apply_async.call_args[1]['queue'].name == '{}.ts_auth.group'.format(celery_app.main)
+    assert 'exchange' not in m_apply_async.call_args[1]
+
+    handle_role_data(first, debounced=True)
+    assert datastore.get_role(role_uuid) is None
+
+    handle_role_data(latest, debounced=True)
+    assert {p.uuid for p in datastore.get_role_permissions(role_uuid)} == {permissions[0].uuid}
+
+
+def test_handle_role_data_skips_payload_identical_to_last_applied_without_bulk_sync(celery_app, datastore, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, coalescer=SyncCoalescer())
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    role_uuid = uuid4()
+    permissions = [fixtures.Permission() for _ in range(2)]
+
+    with patch('thunderstorm_auth.roles.chain') as m_chain:
+        handle_role_data(_role_payload(role_uuid, permissions))
+        handle_role_data(_role_payload(role_uuid, permissions[::-1]))
+
+    assert m_chain.call_count == 1
+
+
+def test_handle_role_data_debounce_applies_identical_deferred_payloads_once(celery_app, datastore, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True, coalescer=SyncCoalescer(debounce=2))
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    payload = _role_payload(uuid4(), [fixtures.Permission()])
+
+    with patch.object(handle_role_data, 'apply_async'):
+        handle_role_data(payload)
+        handle_role_data(payload)
+
+    with patch.object(datastore, 'apply_role', wraps=datastore.apply_role) as m_apply_role:
+        handle_role_data(payload, debounced=True)
+        handle_role_data(payload, debounced=True)
+
+    assert m_apply_role.call_count == 1
+
+
+def test_handle_role_data_applies_redelivery_of_payload_failing_to_apply(celery_app, datastore, fixtures):
+    init_ts_auth_tasks(celery_app, datastore, bulk_sync=True, coalescer=SyncCoalescer())
+    celery_app.set_current()
+    handle_role_data = celery_app.tasks['handle_role_data']
+    role_uuid = uuid4()
+    payload = _role_payload(role_uuid, [fixtures.Permission()])
+
+    with patch.object(datastore, 'apply_role', side_effect=RuntimeError('database is down')):
+        with pytest.raises(RuntimeError):
+            handle_role_data(payload)
+
+    handle_role_data(payload)
+
+    assert datastore.get_role(role_uuid) is not None
@@ -24,3 +24,11 @@ def test_init_permissions(celery_app, datastore):
 
     # assert
     assert 'ts_auth.permissions.sync' in celery_app.tasks
+
+
+def test_init_group_sync_tasks_with_batch_consumer(celery_app, datastore):
+    init_ts_auth_tasks(celery_app, datastore, batch_size=100)
+
+    assert 'handle_role_data' in celery_app.tasks
+    assert not celery_app.conf.task_queues
+    assert any(step.__name__ == 'SyncBatchConsumer' for step in celery_app.steps['consumer'])
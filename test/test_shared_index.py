@@ -0,0 +1,241 @@
+import os
+from unittest.mock import Mock, patch
+from uuid import uuid4
+
+import pytest
+
+from thunderstorm_auth.consumer import SyncBatch
+from thunderstorm_auth.datastore import MmapAuthStore
+from thunderstorm_auth.shared_index import (
+    SharedIndex, SharedIndexWriter, _init_shared_index_writer, write_shared_index
+)
+
+
+@pytest.fixture
+def index_data():
+    roles = [uuid4() for _ in range(20)]
+    permissions = [uuid4() for _ in range(5)]
+    groups = [uuid4() for _ in range(3)]
+    return {
+        'roles': roles,
+        'groups': groups,
+        'permission_roles': {permission: roles[i:i + 5] for i, permission in enumerate(permissions)},
+        'permission_uuids': {'perm-{}'.format(i): permission for i, permission in enumerate(permissions)},
+        'group_complexes': {group_uuid: [uuid4() for _ in range(i + 1)] for i, group_uuid in enumerate(groups)},
+    }
+
+
+@pytest.fixture
+def index_path(tmpdir, index_data):
+    path = str(tmpdir.join('auth.index'))
+    write_shared_index(
+        path, index_data['permission_roles'], index_data['permission_uuids'], index_data['group_complexes']
+    )
+    return path
+
+
+def test_shared_index_is_permission_in_roles(index_path, index_data):
+    index = SharedIndex.open(index_path)
+    roles = index_data['roles']
+
+    for permission_uuid, permission_roles in index_data['permission_roles'].items():
+        for role_uuid in roles:
+            assert index.is_permission_in_roles(permission_uuid, [str(role_uuid)]) == (role_uuid in permission_roles)
+
+    assert not index.is_permission_in_roles(uuid4(), roles)
+    assert not index.is_permission_in_roles(next(iter(index_data['permission_roles'])), ['not-a-uuid'])
+
+
+def test_shared_index_get_roles_with_permission(index_path, index_data):
+    index = SharedIndex.open(index_path)
+    permission_uuid, permission_roles = next(iter(index_data['permission_roles'].items()))
+
+    assert index.get_roles_with_permission(index_data['roles'], permission_uuid) == {str(r) for r in permission_roles}
+    assert index.get_roles_with_permission(index_data['roles'], uuid4()) == set()
+
+
+def test_shared_index_get_permission_uuid(index_path, index_data):
+    index = SharedIndex.open(index_path)
+
+    for permission_string, permission_uuid in index_data['permission_uuids'].items():
+        assert index.get_permission_uuid(permission_string) == str(permission_uuid)
+    assert index.get_permission_uuid('unknown') is None
+
+
+def test_shared_index_get_complex_uuids(index_path, index_data):
+    index = SharedIndex.open(index_path)
+
+    for group_uuid, complex_uuids in index_data['group_complexes'].items():
+        assert sorted(index.get_complex_uuids(group_uuid)) == sorted(complex_uuids)
+    assert index.get_complex_uuids(uuid4()) == []
+    assert index.has_group_complexes()
+
+
+def test_shared_index_rejects_other_files():
+    with pytest.raises(ValueError):
+        SharedIndex(b'not an index file, definitely not one')
+
+
+def test_write_shared_index_replaces_file_atomically(index_path, tmpdir):
+    index = SharedIndex.open(index_path)
+
+    write_shared_index(index_path, {}, {}, {})
+
+    # the previous mapping is still readable while the new file is in place
+    assert index.permission_count == 5
+    assert SharedIndex.open(index_path).permission_count == 0
+    assert os.listdir(str(tmpdir)) == ['auth.index']
+
+
+def test_mmap_auth_store(index_path, index_data):
+    datastore = MmapAuthStore(index_path)
+    (permission_string, permission_uuid), = list(index_data['permission_uuids'].items())[:1]
+    role_uuid = index_data['permission_roles'][permission_uuid][0]
+    group_uuid = index_data['groups'][1]
+
+    assert datastore.is_permission_in_roles(permission_string=permission_string, role_uuids=[str(role_uuid)])
+    assert datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[role_uuid])
+    assert not datastore.is_permission_in_roles(permission_string='unknown', role_uuids=[role_uuid])
+    assert not datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[])
+    assert datastore.get_roles_with_permission([role_uuid, uuid4()], permission_string=permission_string) == {
+        str(role_uuid)
+    }
+    assert datastore.get_permission_uuid(permission_string) == str(permission_uuid)
+    assert datastore.group_associations_exist()
+    assert {a.complex_uuid for a in datastore.get_group_associations([group_uuid])} == set(
+        index_data['group_complexes'][group_uuid]
+    )
+
+
+def test_mmap_auth_store_denies_all_until_index_is_written(tmpdir):
+    path = str(tmpdir.join('auth.index'))
+    datastore = MmapAuthStore(path, check_interval=0)
+    permission_uuid, role_uuid = uuid4(), uuid4()
+
+    assert not datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[role_uuid])
+    assert not datastore.group_associations_exist()
+    assert datastore.get_group_associations([uuid4()]) == []
+
+    write_shared_index(path, {permission_uuid: [role_uuid]}, {}, {})
+
+    assert datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[role_uuid])
+
+
+def test_mmap_auth_store_maps_new_index_file(index_path):
+    datastore = MmapAuthStore(index_path, check_interval=0)
+    permission_uuid, role_uuid = uuid4(), uuid4()
+    index = datastore.index
+
+    write_shared_index(index_path, {permission_uuid: [role_uuid]}, {}, {})
+
+    assert datastore.index is not index
+    assert datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[role_uuid])
+
+
+def test_mmap_auth_store_checks_file_at_most_once_per_interval(index_path):
+    datastore = MmapAuthStore(index_path, check_interval=3600)
+    datastore.index
+
+    with patch('thunderstorm_auth.datastore.os.stat') as m_stat:
+        datastore.index
+
+    assert not m_stat.called
+
+
+def test_shared_index_writer_writes_datastore_content(datastore, db_session, fixtures, tmpdir):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    association = fixtures.ComplexGroupComplexAssociation()
+    db_session.flush()
+    path = str(tmpdir.join('auth.index'))
+
+    assert SharedIndexWriter(datastore, path).write() == os.path.getsize(path)
+
+    index = SharedIndex.open(path)
+    assert index.is_permission_in_roles(permission.uuid, [role.uuid])
+    assert index.get_permission_uuid(permission.permission) == str(permission.uuid)
+    assert index.get_complex_uuids(association.group_uuid) == [association.complex_uuid]
+
+
+@patch('thunderstorm_auth.shared_index.threading.Timer')
+def test_shared_index_writer_coalesces_scheduled_writes(m_timer, datastore):
+    writer = SharedIndexWriter(datastore, 'auth.index', delay=2)
+
+    writer.schedule()
+    writer.schedule()
+
+    m_timer.assert_called_once_with(2, writer._write_scheduled)
+
+
+@patch('thunderstorm_auth.shared_index.threading.Timer')
+def test_shared_index_writer_schedules_its_own_write_in_forked_processes(m_timer, datastore):
+    writer = SharedIndexWriter(datastore, 'auth.index', delay=2)
+    writer.schedule()
+
+    # the timer pending in the parent process was not copied into the child
+    with patch('thunderstorm_auth.shared_index.os.getpid', return_value=os.getpid() + 1):
+        writer.schedule()
+        writer.schedule()
+
+    assert m_timer.call_count == 2
+
+
+def test_shared_index_writer_listens_to_datastore_commits(datastore, fixtures):
+    role, permission = fixtures.Role(), fixtures.Permission()
+    group_uuid, complex_uuid = uuid4(), uuid4()
+
+    with patch('thunderstorm_auth.shared_index.signals'), \
+            patch.object(SharedIndexWriter, 'schedule') as m_schedule:
+        _init_shared_index_writer(datastore, 'auth.index')
+
+        datastore.create_role_permission_association(role.uuid, permission.uuid, commit=True)
+        assert m_schedule.call_count == 1
+
+        datastore.update_group_associations(group_uuid, [], [complex_uuid], commit=True)
+        assert m_schedule.call_count == 2
+
+        # nothing changed, nothing to rewrite
+        datastore.update_group_associations(group_uuid, [], [complex_uuid], commit=True)
+        datastore.create_role(uuid4(), 'test', commit=True)
+        assert m_schedule.call_count == 2
+
+
+def test_shared_index_writer_does_not_listen_to_rolled_back_writes(datastore):
+    with patch('thunderstorm_auth.shared_index.signals'), \
+            patch.object(SharedIndexWriter, 'schedule') as m_schedule:
+        _init_shared_index_writer(datastore, 'auth.index')
+
+        datastore.create_group_association(uuid4(), uuid4())
+        datastore.rollback()
+        datastore.commit()
+
+    assert not m_schedule.called
+
+
+def test_shared_index_writer_rewrites_file_after_sync_batch(datastore, fixtures, tmpdir):
+    role_uuid, group_uuid, complex_uuid = uuid4(), uuid4(), uuid4()
+    permission = fixtures.Permission()
+    permission_uuid = permission.uuid
+    path = str(tmpdir.join('auth.index'))
+    role_message = Mock()
+    role_message.headers = {'task': 'handle_role_data'}
+    role_body = [[{'data': {'uuid': str(role_uuid), 'type': 'test', 'permissions': [
+        {'uuid': str(permission_uuid), 'service': 'test', 'permission_string': permission.permission}
+    ]}}], {}, {}]
+    group_message = Mock()
+    group_message.headers = {'task': 'ts_auth.group.complex.sync'}
+    group_body = [[str(group_uuid), [str(complex_uuid)]], {}, {}]
+
+    with patch('thunderstorm_auth.shared_index.signals'), \
+            patch('thunderstorm_auth.shared_index.threading.Timer') as m_timer:
+        _init_shared_index_writer(datastore, path)
+        # the batch consumer applies the messages without running any sync task
+        SyncBatch(datastore).apply([(role_body, role_message), (group_body, group_message)])
+
+    m_timer.assert_called_once()
+    _, write_scheduled = m_timer.call_args[0]
+    write_scheduled()
+
+    index = SharedIndex.open(path)
+    assert index.is_permission_in_roles(permission_uuid, [role_uuid])
+    assert index.get_complex_uuids(group_uuid) == [complex_uuid]
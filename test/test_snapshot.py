@@ -0,0 +1,202 @@
+from unittest.mock import Mock, patch
+from uuid import uuid4
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from thunderstorm_auth.datastore import SQLAlchemySessionAuthStore
+from thunderstorm_auth.snapshot import AuthSnapshot, freeze
+from test.models import Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation
+from test.test_datastore import count_statements
+
+
+def test_auth_snapshot_load(datastore, db_session, fixtures):
+    roles = [fixtures.Role() for _ in range(3)]
+    permission = fixtures.Permission(roles=roles)
+    permission_without_roles = fixtures.Permission()
+    group_uuid = uuid4()
+    associations = [fixtures.ComplexGroupComplexAssociation(group_uuid=group_uuid) for _ in range(2)]
+    db_session.flush()
+
+    with count_statements(db_session) as statements:
+        snapshot = AuthSnapshot.load(datastore)
+
+    assert len(statements) == 2
+    assert snapshot.get_permission_roles(permission.uuid) == frozenset(str(r.uuid) for r in roles)
+    assert snapshot.get_permission_roles(permission_without_roles.uuid) == frozenset()
+    assert snapshot.get_permission_roles(uuid4()) is None
+    assert snapshot.get_permission_uuid(permission.permission) == str(permission.uuid)
+    assert snapshot.get_permission_uuid('unknown') is None
+    assert snapshot.get_complex_uuids(group_uuid) == frozenset(str(a.complex_uuid) for a in associations)
+    assert snapshot.get_complex_uuids(uuid4()) == frozenset()
+
+
+def test_auth_snapshot_load_without_groups(datastore, db_session, fixtures):
+    fixtures.Permission()
+    fixtures.ComplexGroupComplexAssociation()
+    db_session.flush()
+
+    with count_statements(db_session) as statements:
+        snapshot = AuthSnapshot.load(datastore, with_groups=False)
+
+    assert len(statements) == 1
+    assert snapshot.group_complexes is None
+    assert snapshot.get_complex_uuids(uuid4()) is None
+
+
+def test_auth_snapshot_interns_uuids(datastore, db_session, fixtures):
+    role = fixtures.Role()
+    fixtures.Permission(roles=[role])
+    fixtures.Permission(roles=[role])
+    db_session.flush()
+
+    snapshot = AuthSnapshot.load(datastore)
+
+    first, second = (next(iter(roles)) for roles in snapshot.permission_roles.values())
+    assert first is second
+
+
+@patch('thunderstorm_auth.snapshot.gc')
+def test_freeze(m_gc):
+    freeze()
+
+    assert m_gc.freeze.called
+
+
+def test_datastore_preload_snapshot_serves_checks_without_queries(datastore, db_session, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    db_session.flush()
+
+    with patch('thunderstorm_auth.datastore.freeze') as m_freeze:
+        snapshot = datastore.preload_snapshot()
+
+    assert m_freeze.called
+    assert datastore.snapshot is snapshot
+
+    with count_statements(db_session) as statements:
+        assert datastore.is_permission_in_roles(permission_string=permission.permission, role_uuids=[role.uuid])
+        assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[uuid4()])
+
+    assert statements == []
+    assert datastore.cache.get(str(permission.uuid)) is None
+
+
+def test_datastore_snapshot_falls_back_to_cache_for_invalidated_entries(datastore, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[fixtures.Role()])
+    snapshot = datastore.preload_snapshot(freeze_objects=False)
+
+    datastore.create_role_permission_association(role.uuid, permission.uuid, commit=True)
+
+    assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+    # the snapshot shared with the other workers is never mutated
+    assert str(role.uuid) not in snapshot.get_permission_roles(permission.uuid)
+
+
+def test_datastore_refresh_snapshot_swaps_snapshot(datastore, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[fixtures.Role()])
+    snapshot = datastore.preload_snapshot(freeze_objects=False)
+    datastore.create_role_permission_association(role.uuid, permission.uuid, commit=True)
+
+    new_snapshot = datastore.refresh_snapshot()
+
+    assert new_snapshot is not snapshot
+    assert datastore.snapshot is new_snapshot
+    assert datastore._stale_snapshot_keys == set()
+    assert str(role.uuid) in new_snapshot.get_permission_roles(permission.uuid)
+
+
+def test_datastore_refresh_snapshot_keeps_entries_invalidated_while_loading(datastore, fixtures):
+    permission = fixtures.Permission()
+    datastore.preload_snapshot(freeze_objects=False)
+    load = AuthSnapshot.load
+
+    def _load_and_invalidate(store, **kwargs):
+        snapshot = load(store, **kwargs)
+        store._drop_cache_entries([str(permission.uuid)])
+        return snapshot
+
+    with patch('thunderstorm_auth.datastore.AuthSnapshot.load', side_effect=_load_and_invalidate):
+        datastore.refresh_snapshot()
+
+    assert datastore._stale_snapshot_keys == {str(permission.uuid)}
+
+
+def test_datastore_snapshot_is_served_after_timeout_while_a_refresh_is_scheduled(datastore, fixtures):
+    role, new_role = fixtures.Role(), fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    permission_uuid, new_role_uuid = permission.uuid, new_role.uuid
+    with patch('thunderstorm_auth.snapshot.time.time', return_value=100):
+        snapshot = datastore.preload_snapshot(freeze_objects=False, timeout=60)
+    # written by another process, nothing drops the snapshot entry
+    fixtures.RolePermissionAssociation(role_uuid=new_role_uuid, permission_uuid=permission_uuid)
+
+    with patch('thunderstorm_auth.datastore.threading.Thread') as m_thread:
+        with patch('thunderstorm_auth.datastore.time.time', return_value=159):
+            assert not datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[new_role_uuid])
+        assert not m_thread.called
+
+        with patch('thunderstorm_auth.datastore.time.time', return_value=160):
+            assert not datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[new_role_uuid])
+            assert not datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[new_role_uuid])
+
+    assert m_thread.call_count == 1
+    assert datastore.snapshot is snapshot
+
+    # the session of the refresher thread is the one of the test here
+    with patch.object(datastore, '_remove_thread_session'):
+        m_thread.call_args[1]['target']()
+
+    assert datastore.snapshot is not snapshot
+    assert datastore.is_permission_in_roles(permission_uuid=permission_uuid, role_uuids=[new_role_uuid])
+
+
+def test_datastore_with_plain_session_refreshes_snapshot_in_the_request(db_connection, db_session, fixtures):
+    role, new_role = fixtures.Role(), fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    db_session.flush()
+    datastore = SQLAlchemySessionAuthStore(
+        Session(bind=db_connection), Role, Permission, RolePermissionAssociation, ComplexGroupComplexAssociation
+    )
+    with patch('thunderstorm_auth.snapshot.time.time', return_value=100):
+        datastore.preload_snapshot(freeze_objects=False, timeout=60)
+    fixtures.RolePermissionAssociation(role_uuid=new_role.uuid, permission_uuid=permission.uuid)
+    db_session.flush()
+
+    with patch('thunderstorm_auth.datastore.threading.Thread') as m_thread, \
+            patch('thunderstorm_auth.datastore.time.time', return_value=160):
+        assert not datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[new_role.uuid])
+
+    assert not m_thread.called
+    assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[new_role.uuid])
+
+
+def test_datastore_snapshot_gives_way_to_the_cache_when_the_refresh_fails(datastore, fixtures):
+    role = fixtures.Role()
+    permission = fixtures.Permission(roles=[role])
+    datastore.preload_snapshot(freeze_objects=False)
+
+    with patch.object(datastore, 'refresh_snapshot', side_effect=ValueError('db down')), \
+            patch.object(datastore, '_remove_thread_session'):
+        datastore._refresh_snapshot_in_background()
+
+    assert datastore.snapshot is None
+    assert datastore._snapshot_refresh_pid is None
+    assert datastore.is_permission_in_roles(permission_uuid=permission.uuid, role_uuids=[role.uuid])
+
+
+def test_datastore_snapshot_timeout_defaults_to_cache_timeout(datastore):
+    assert datastore.snapshot_timeout == datastore.cache.default_timeout == 450
+
+
+def test_datastore_preload_snapshot_releases_connections(datastore):
+    engine = Mock(spec=Engine)
+
+    with patch.object(datastore.db_session, 'remove') as m_remove, \
+            patch.object(datastore.db_session, 'get_bind', return_value=engine):
+        datastore.preload_snapshot(freeze_objects=False)
+
+    assert m_remove.called
+    assert engine.dispose.called
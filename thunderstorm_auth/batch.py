@@ -0,0 +1,70 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+
+from thunderstorm_auth import DEFAULT_LEEWAY
+from thunderstorm_auth.datastore import _valid_uuids
+from thunderstorm_auth.decoder import decode_token
+from thunderstorm_auth.exceptions import BrokenTokenError, InsufficientPermissions, TokenDecodeError, TokenError
+
+AuthorizationResult = collections.namedtuple('AuthorizationResult', 'authorized payload error')
+
+DEFAULT_MAX_WORKERS = 4
+
+
+def authorize_many(
+        tokens, permission, jwks, datastore, leeway=DEFAULT_LEEWAY, max_workers=DEFAULT_MAX_WORKERS, cache=None
+):
+    """Decode many tokens and check them against a single permission
+
+    Duplicate tokens are decoded once, signatures are verified on a thread pool and the roles of all the
+    tokens are resolved against the permission with a single datastore query.
+
+    Args:
+        tokens (list of str): Tokens to authorize.
+        permission (str): The permission string required.
+        jwks (dict or KeyRegistry): JWK Set containing JWKs to be tried to decode the tokens.
+        datastore (AuthStore): datastore used for the auth data retrieval
+        leeway (int): Number of seconds of lenience used in determining if a token has expired.
+        max_workers (int): Number of threads verifying token signatures.
+        cache (TokenCache): Optional cache of verified token payloads.
+
+    Returns:
+        list of AuthorizationResult: one result per token, in the same order as `tokens`
+    """
+    unique_tokens = list(dict.fromkeys(tokens))
+
+    def _decode(token):
+        try:
+            payload = decode_token(token, jwks, leeway=leeway, cache=cache)
+            if not isinstance(payload.get('roles'), list):
+                raise BrokenTokenError('Token roles must be structured as a list')
+            if not all(isinstance(role, str) for role in payload['roles']):
+                raise BrokenTokenError('Token roles must be strings')
+            return payload, None
+        except TokenError as error:
+            return None, error
+        except jwt.exceptions.InvalidTokenError as error:
+            # claims the decoder leaves to pyjwt's exceptions (eg. not yet valid), one token must not fail the batch
+            return None, TokenDecodeError('An error occurred while decoding your token: {}'.format(error))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        decoded = dict(zip(unique_tokens, executor.map(_decode, unique_tokens)))
+
+    role_sets = {frozenset(payload['roles']) for payload, error in decoded.values() if error is None}
+    granted_roles = datastore.get_roles_with_permission(
+        _valid_uuids(set().union(*role_sets)), permission_string=permission
+    )
+
+    results = {}
+    for token, (payload, error) in decoded.items():
+        if error is not None:
+            results[token] = AuthorizationResult(False, None, error)
+        elif granted_roles.intersection(payload['roles']):
+            results[token] = AuthorizationResult(True, payload, None)
+        else:
+            error = InsufficientPermissions('You do not have the permission required to carry out this action')
+            results[token] = AuthorizationResult(False, payload, error)
+
+    return [results[token] for token in tokens]
@@ -0,0 +1,444 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from statsd.defaults.env import statsd
+
+logger = logging.getLogger(__name__)
+
+
+def token_digest(token):
+    """
+    Digest used to key tokens in the token caches, so raw tokens are never kept in memory
+
+    Args:
+        token (str): encoded JWT
+
+    Returns:
+        bytes: sha256 digest of the token
+    """
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()
+
+
+class _ExpiringLRUCache(object):
+    """
+    Bounded LRU cache whose entries expire at a given timestamp
+    """
+
+    def __init__(self, maxsize):
+        """
+        Args:
+            maxsize (int): maximum number of entries kept, the least recently used one is evicted first
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, digest):
+        """
+        Args:
+            digest (bytes or tuple): digest of the token, see `token_digest`, alone or with the context the
+                value depends on
+
+        Returns:
+            object: value cached for the token
+            None: token not in the cache or expired
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return value
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    def set(self, digest, value, expires_at):
+        """
+        Args:
+            digest (bytes or tuple): digest of the token, see `token_digest`, alone or with the context the
+                value depends on
+            value (object): value to cache for the token
+            expires_at (int or float): timestamp after which the value must not be served anymore
+        """
+        with self._lock:
+            self._entries[digest] = (value, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class TokenCache(_ExpiringLRUCache):
+    """
+    Bounded LRU cache of verified token payloads keyed by token digest, JWK set fingerprint and leeway
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        Args:
+            maxsize (int): maximum number of payloads kept, the least recently used one is evicted first
+        """
+        super().__init__(maxsize)
+
+
+class RejectedTokenCache(_ExpiringLRUCache):
+    """
+    Bounded LRU cache of recently rejected token digests, so clients retrying with the same bad token are
+    rejected at the cost of a hash lookup
+
+    Tokens signed with an unknown key are not rejected through it, the key may be fetched any moment.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        """
+        Args:
+            maxsize (int): maximum number of rejected tokens kept, the least recently used one is evicted first
+            ttl (int or float): number of seconds a token stays rejected
+        """
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def reject(self, digest, error):
+        """
+        Args:
+            digest (bytes): digest of the token, see `token_digest`
+            error (TokenError): error raised when decoding the token
+        """
+        self.set(digest, (type(error), error.args), time.time() + self.ttl)
+
+    def raise_if_rejected(self, digest):
+        """
+        Args:
+            digest (bytes): digest of the token, see `token_digest`
+
+        Raises:
+            TokenError: the same error type and message the token was rejected with
+        """
+        entry = self.get(digest)
+        if entry is not None:
+            error_type, args = entry
+            raise error_type(*args)
+
+
+class AuthCache(_ExpiringLRUCache):
+    """
+    Thread-safe bounded LRU cache with a timeout per entry, used by the datastore for the auth data
+
+    Concurrent misses on the same key share a single load through `get_or_load`, so an expiring popular
+    entry triggers one database query instead of one per request in flight.
+
+    With a `stale_timeout`, `get_or_load` keeps serving an expired entry for that many more seconds while a
+    background thread reloads it, so only entries expired for longer than that are loaded inline.
+
+    Processes started together expire their entries together, `jitter` shortens the timeout of each entry by
+    a random fraction and `refresh_ahead` reloads entries in the background at a random point of their last
+    seconds, so the reloads of a fleet of workers are spread over time instead of hitting the db at once.
+    """
+
+    def __init__(self, maxsize=4096, default_timeout=450, stale_timeout=0, jitter=0, refresh_ahead=0):
+        """
+        Args:
+            maxsize (int): maximum number of entries kept, the least recently used one is evicted first
+            default_timeout (int): number of seconds an entry is kept when no timeout is given, 0 keeps it
+                until it is evicted
+            stale_timeout (int): number of seconds an expired entry is still served by `get_or_load` while it
+                is reloaded in the background, 0 disables stale-while-revalidate
+            jitter (float): maximum fraction of its timeout randomly taken off each entry, eg. 0.1 expires an
+                entry with a 450 seconds timeout after 405 to 450 seconds
+            refresh_ahead (int): number of seconds before expiry during which `get_or_load` may reload an entry
+                in the background, the chance growing as the entry gets closer to its expiry
+        """
+        if not 0 <= jitter < 1:
+            raise ValueError('jitter must be a fraction between 0 and 1')
+        super().__init__(maxsize)
+        self.default_timeout = default_timeout
+        self.stale_timeout = stale_timeout
+        self.jitter = jitter
+        self.refresh_ahead = refresh_ahead
+        self.stale_hits = 0
+        self._key_locks = {}
+        # key -> token of the load queued for it, see `_refresh`
+        self._refreshing = {}
+        # key -> token of the load running inline for it, see `get_or_load`
+        self._loading = {}
+        self._refresh_queue = None
+        self._refresher_pid = None
+
+    def get(self, key):
+        """
+        Args:
+            key (str): cache key
+
+        Returns:
+            object: value cached for the key
+            None: key not in the cache or expired
+        """
+        return self._get_entry(key, allow_stale=False)[0]
+
+    def set(self, key, value, timeout=None):
+        """
+        Args:
+            key (str): cache key
+            value (object): value to cache, a None value reads as a miss
+            timeout (int): number of seconds the entry is kept, defaults to `default_timeout`, 0 keeps it
+                until it is evicted
+        """
+        super().set(key, value, self._expires_at(timeout))
+
+    def set_many(self, mapping, timeout=None):
+        """
+        Args:
+            mapping (dict): values to cache by key
+            timeout (int): number of seconds the entries are kept, see `set`
+        """
+        for key, value in mapping.items():
+            # expiry drawn per entry, a preloaded cache must not expire all at once
+            super().set(key, value, self._expires_at(timeout))
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def delete(self, key):
+        with self._lock:
+            self._refreshing.pop(key, None)
+            self._loading.pop(key, None)
+            return self._entries.pop(key, None) is not None
+
+    def delete_many(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._refreshing.pop(key, None)
+                self._loading.pop(key, None)
+                self._entries.pop(key, None)
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._refreshing.clear()
+            self._loading.clear()
+
+    def get_or_load(self, key, loader, timeout=None, refresh=None):
+        """
+        Return the cached value of a key, loading it on a miss with a single call to the loader however many
+        threads miss the key at the same time
+
+        An entry expired for less than `stale_timeout` seconds, or about to expire (see `refresh_ahead`), is
+        returned as is and reloaded by the refresher thread.
+
+        Args:
+            key (str): cache key
+            loader (callable): function without arguments returning the value of the key
+            timeout (int or callable): number of seconds the loaded value is kept, see `set`, or a function
+                returning it for the loaded value
+            refresh (callable): function without arguments returning the value of the key, called from the
+                refresher thread to reload a stale entry, defaults to the loader
+
+        Returns:
+            object: the cached or loaded value
+        """
+        value, needs_refresh = self._get_entry(key, allow_stale=True)
+        if value is not None:
+            if needs_refresh:
+                self._schedule_refresh(key, refresh or loader, timeout)
+            return value
+
+        with self._lock:
+            key_lock = self._key_locks.get(key)
+            if key_lock is None:
+                key_lock = self._key_locks[key] = _KeyLock()
+            key_lock.waiters += 1
+
+        try:
+            with key_lock.lock:
+                # the value has been loaded by another thread while this one was waiting
+                value = self._peek(key)
+                if value is None:
+                    value = self._load(key, loader, timeout)
+                return value
+        finally:
+            with self._lock:
+                key_lock.waiters -= 1
+                if not key_lock.waiters:
+                    del self._key_locks[key]
+
+    def _load(self, key, loader, timeout):
+        with self._lock:
+            token = self._loading[key] = object()
+
+        try:
+            value = loader()
+        except Exception:
+            with self._lock:
+                if self._loading.get(key) is token:
+                    del self._loading[key]
+            raise
+
+        with self._lock:
+            # like in `_refresh`, a key deleted while it was loading is not cached: the value is returned to
+            # this caller only and the next lookup loads the key again
+            if self._loading.get(key) is token:
+                del self._loading[key]
+                self._store(key, value, timeout)
+        return value
+
+    def get_or_schedule(self, key, loader, timeout=None):
+        """
+        Return the cached value of a key without ever loading it inline: a missing key is loaded by the
+        refresher thread and None returned meanwhile, a stale one is returned and reloaded like in
+        `get_or_load`
+
+        Args:
+            key (str): cache key
+            loader (callable): function without arguments returning the value of the key, called from the
+                refresher thread
+            timeout (int or callable): number of seconds the loaded value is kept, see `get_or_load`
+
+        Returns:
+            object: the cached value
+            None: key not in the cache yet
+        """
+        value, needs_refresh = self._get_entry(key, allow_stale=True)
+        if value is None or needs_refresh:
+            self._schedule_refresh(key, loader, timeout)
+        return value
+
+    def _get_entry(self, key, allow_stale):
+        """
+        Returns:
+            tuple: the value of the key, None on a miss, and whether it is stale or due for an early refresh
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                now = time.time()
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value, allow_stale and self._refresh_early(expires_at - now)
+                if expires_at + self.stale_timeout > now:
+                    if allow_stale:
+                        self._entries.move_to_end(key)
+                        self.stale_hits += 1
+                        return value, True
+                else:
+                    del self._entries[key]
+            self.misses += 1
+            return None, False
+
+    def _peek(self, key):
+        """Get a fresh value without counting a hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+            return None
+
+    def _expires_at(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if not timeout:
+            return float('inf')
+        if self.jitter:
+            timeout -= timeout * random.uniform(0, self.jitter)
+        return time.time() + timeout
+
+    def _refresh_early(self, time_left):
+        return time_left < self.refresh_ahead and random.uniform(0, self.refresh_ahead) > time_left
+
+    def _schedule_refresh(self, key, refresh, timeout):
+        self._ensure_refresher()
+        with self._lock:
+            if key in self._refreshing:
+                return
+            token = self._refreshing[key] = object()
+        self._refresh_queue.put((key, token, refresh, timeout))
+
+    def _ensure_refresher(self):
+        # threads do not survive a fork, so each (pre-forked) worker process starts its own refresher
+        if self._refresher_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._refresher_pid != os.getpid():
+                self._refresh_queue = queue.Queue()
+                self._refreshing = {}
+                thread = threading.Thread(
+                    target=self._run_refresher, args=(self._refresh_queue,), name='auth-cache-refresher', daemon=True
+                )
+                thread.start()
+                self._refresher_pid = os.getpid()
+
+    def _run_refresher(self, refresh_queue):
+        while True:
+            key, token, refresh, timeout = refresh_queue.get()
+            try:
+                self._refresh(key, token, refresh, timeout)
+            finally:
+                refresh_queue.task_done()
+
+    def _refresh(self, key, token, refresh, timeout):
+        try:
+            value = refresh()
+        except Exception:
+            with self._lock:
+                if self._refreshing.get(key) is token:
+                    del self._refreshing[key]
+            logger.exception('Could not refresh auth cache entry {}'.format(key))
+            statsd.incr('auth_cache.refresh.errors')
+            return
+
+        with self._lock:
+            # a key deleted while it was loading has been invalidated, the value loaded may predate the change
+            # so it is dropped and the next lookup loads the key again
+            if self._refreshing.get(key) is not token:
+                return
+            del self._refreshing[key]
+            entry = self._entries.get(key)
+            self._store(key, value, timeout)
+
+        if entry is not None:
+            statsd.timing('auth_cache.refresh.lag', max(time.time() - entry[1], 0) * 1000)
+
+    def _store(self, key, value, timeout):
+        """Cache a loaded value, the caller holds the lock"""
+        self._entries[key] = (value, self._expires_at(_timeout_for(timeout, value)))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def _timeout_for(timeout, value):
+    return timeout(value) if callable(timeout) else timeout
+
+
+class _KeyLock(object):
+    __slots__ = ('lock', 'waiters')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = 0
@@ -0,0 +1,144 @@
+import hashlib
+import json
+
+from thunderstorm_auth.cache import AuthCache
+
+
+class SyncCoalescer(object):
+    """
+    Remembers the content hash of the last sync payload applied for each role and group, so identical
+    copies (eg. the hourly role rebroadcast or a group republish) are skipped without touching the database
+
+    With a debounce window, a payload is not applied when received but sent back to the queue for later:
+    only the latest payload received for an entity during the window is applied, the others are dropped.
+
+    The default cache is local to the worker process. Several worker processes only see each other's payloads
+    through a shared cache (eg. `werkzeug.contrib.cache.RedisCache`), without one a process may skip a payload
+    reverting a change applied by another process until the hash expires.
+    """
+
+    def __init__(self, cache=None, ttl=6 * 3600, debounce=0, prefix='ts_auth.sync'):
+        """
+        Args:
+            cache (object): cache with the `get` and `set(key, value, timeout)` methods of werkzeug caches,
+                defaults to an `AuthCache` local to the process
+            ttl (int): number of seconds a payload hash is remembered, a copy received after that is applied
+            debounce (int or float): number of seconds to wait for a newer payload of the same entity before
+                applying one, 0 applies payloads when received
+            prefix (str): prefix of the cache keys
+        """
+        self.cache = AuthCache(maxsize=65536, default_timeout=ttl) if cache is None else cache
+        self.ttl = ttl
+        self.debounce = debounce
+        self.prefix = prefix
+
+    @staticmethod
+    def digest(content):
+        """
+        Args:
+            content (object): JSON serializable content of a payload, lists must be sorted by the caller
+
+        Returns:
+            str: content hash of the payload
+        """
+        serialized = json.dumps(content, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def role_digest(self, data):
+        """
+        Args:
+            data (dict): role loaded from a sync message with `thunderstorm_auth.roles.RoleSchema`
+
+        Returns:
+            tuple: entity key and content hash of the role payload
+        """
+        permission_uuids = sorted(str(permission['uuid']) for permission in data['permissions'])
+        return 'role:{}'.format(data['uuid']), self.digest([str(data['uuid']), data['type'], permission_uuids])
+
+    def group_digest(self, group_uuid, complex_uuids):
+        """
+        Args:
+            group_uuid (object): primary identifier of a group
+            complex_uuids (list): uuids of the complexes of the group
+
+        Returns:
+            tuple: entity key and content hash of the group memberships
+        """
+        content = [str(group_uuid), sorted(set(str(c) for c in complex_uuids))]
+        return 'group:{}'.format(group_uuid), self.digest(content)
+
+    def is_applied(self, key, digest):
+        """
+        Args:
+            key (str): entity of the payload, eg. 'role:<uuid>'
+            digest (str): content hash of the payload
+
+        Returns:
+            bool: the payload is the last one applied for the entity
+        """
+        return self.cache.get(self._applied_key(key)) == digest
+
+    def mark_applied(self, key, digest):
+        """
+        Args:
+            key (str): entity of the payload
+            digest (str): content hash of the payload just applied
+        """
+        self.cache.set(self._applied_key(key), digest, timeout=self.ttl)
+
+    def claim(self, key, digest):
+        """
+        Record a payload as applied before applying it, so that a copy handled meanwhile is skipped
+
+        Args:
+            key (str): entity of the payload
+            digest (str): content hash of the payload about to be applied
+
+        Returns:
+            bool: the payload was not the last one applied for the entity, the caller must apply it
+        """
+        if self.is_applied(key, digest):
+            return False
+        self.mark_applied(key, digest)
+        return True
+
+    def forget(self, key):
+        """
+        Forget the last payload applied for an entity, eg. when the payload just claimed could not be applied
+
+        Args:
+            key (str): entity of the payload
+        """
+        self.cache.delete(self._applied_key(key))
+
+    def defer(self, key, digest):
+        """
+        Record a payload as the latest received for its entity, superseding the ones waiting for the window
+
+        Args:
+            key (str): entity of the payload
+            digest (str): content hash of the payload
+        """
+        self.cache.set(self._latest_key(key), digest, timeout=self._latest_timeout())
+
+    def is_latest(self, key, digest):
+        """
+        Args:
+            key (str): entity of the payload
+            digest (str): content hash of a deferred payload
+
+        Returns:
+            bool: no other payload was received for the entity after this one, or the record expired
+        """
+        latest = self.cache.get(self._latest_key(key))
+        return latest is None or latest == digest
+
+    def _applied_key(self, key):
+        return '{}.applied:{}'.format(self.prefix, key)
+
+    def _latest_key(self, key):
+        return '{}.latest:{}'.format(self.prefix, key)
+
+    def _latest_timeout(self):
+        # long enough to outlive queueing delays of the deferred payload
+        return max(int(self.debounce * 10), 60)
@@ -0,0 +1,333 @@
+from collections import OrderedDict, deque
+import logging
+import os
+import queue
+import threading
+import time
+
+from celery import bootsteps
+from kombu import Consumer
+from statsd.defaults.env import statsd
+
+from thunderstorm_auth.groups import _group_changes
+from thunderstorm_auth.roles import _load_role_data
+
+logger = logging.getLogger(__name__)
+
+ROLE_TASK = 'handle_role_data'
+GROUP_TASK = 'ts_auth.group.complex.sync'
+# seconds the consumer waits for the batches being applied when it stops
+STOP_TIMEOUT = 30
+
+
+class SyncBatch(object):
+    """
+    Buffer of role and group sync messages applied together in a single transaction
+
+    Only the latest message of each role or group in the batch is applied. Messages are acknowledged once
+    the transaction is committed. If the transaction fails, each role and group is applied again in its own
+    transaction, and the messages of those still failing are rejected like a failed sync task would be dropped.
+
+    In the worker's consumer the batches are applied by a thread of their own so a slow database does not block
+    the consumer, while the messages are acknowledged and rejected from the consumer as its channel is not
+    thread safe.
+    """
+
+    def __init__(self, datastore, batch_size=500, coalescer=None):
+        """
+        Args:
+            datastore (SQLAlchemySessionAuthStore): datastore the messages are applied to
+            batch_size (int): number of messages applying the batch when reached
+            coalescer (SyncCoalescer): skip the roles and groups identical to the last ones applied
+        """
+        self.datastore = datastore
+        self.batch_size = batch_size
+        self.coalescer = coalescer
+        self._messages = []
+        self._lock = threading.Lock()
+        self._batches = None
+        self._settled = deque()
+        self._applier_pid = None
+
+    def add(self, body, message):
+        """
+        Consumer callback buffering a message, the batch is handed to the applier thread once full
+
+        Args:
+            body (object): decoded body of a Celery task message
+            message (kombu.Message): message to acknowledge once applied
+        """
+        with self._lock:
+            self._messages.append((body, message))
+            full = len(self._messages) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered messages to the applier thread and settle the messages of the batches it committed
+
+        Returns:
+            int: number of messages handed to the applier thread
+        """
+        with self._lock:
+            messages, self._messages = self._messages, []
+
+        if messages:
+            self._ensure_applier()
+            self._batches.put(messages)
+        self.settle()
+        return len(messages)
+
+    def settle(self):
+        """
+        Acknowledge or reject the messages of the batches committed by the applier thread
+
+        Returns:
+            int: number of messages settled
+        """
+        settled = 0
+        while self._settled:
+            message, accepted = self._settled.popleft()
+            if accepted:
+                message.ack()
+            else:
+                message.reject()
+            settled += 1
+        return settled
+
+    def drain(self, timeout=None):
+        """
+        Wait for the applier thread to apply the batches handed to it and settle their messages
+
+        Args:
+            timeout (int or float): maximum number of seconds to wait, no limit if None
+
+        Returns:
+            bool: whether all the batches were applied in time, the messages of the others are redelivered
+                once the consumer's channel is closed
+        """
+        batches = self._batches
+        if batches is not None and self._applier_pid == os.getpid():
+            deadline = None if timeout is None else time.time() + timeout
+            with batches.all_tasks_done:
+                while batches.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    batches.all_tasks_done.wait(remaining)
+            done = not batches.unfinished_tasks
+        else:
+            done = True
+
+        self.settle()
+        return done
+
+    def apply(self, messages):
+        """
+        Apply messages and settle them right away
+
+        Args:
+            messages (list): (body, message) tuples in the order they were received
+        """
+        self._apply(messages)
+        self.settle()
+
+    def _ensure_applier(self):
+        # threads do not survive a fork, so each worker process starts its own applier
+        if self._applier_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._applier_pid != os.getpid():
+                self._batches = queue.Queue()
+                thread = threading.Thread(
+                    target=self._run_applier, args=(self._batches,), name='auth-sync-batch', daemon=True
+                )
+                thread.start()
+                self._applier_pid = os.getpid()
+
+    def _run_applier(self, batches):
+        while True:
+            messages = batches.get()
+            try:
+                self._apply(messages)
+            finally:
+                batches.task_done()
+
+    def _apply(self, messages):
+        # the messages are settled once the whole batch is handled, each of them exactly once
+        settled = []
+        try:
+            self._apply_batch(messages, settled)
+        except Exception:
+            logger.exception('Rejecting auth sync messages that could not be applied')
+            done = set(id(message) for message, _ in settled)
+            settled.extend((message, False) for _, message in messages if id(message) not in done)
+        self._settled.extend(settled)
+
+    def _apply_batch(self, messages, settled):
+        start = time.time()
+        updates = OrderedDict()
+        for body, message in messages:
+            try:
+                key, update, digest = self._parse(body, message)
+            except Exception:
+                logger.exception('Rejecting invalid auth sync message {}'.format(message.delivery_tag))
+                settled.append((message, False))
+                continue
+
+            _, _, superseded = updates.pop(key, (None, None, []))
+            updates[key] = (update, digest, superseded + [message])
+
+        if self.coalescer is not None:
+            for key, (update, digest, key_messages) in list(updates.items()):
+                if self.coalescer.is_applied(key, digest):
+                    del updates[key]
+                    settled.extend((message, True) for message in key_messages)
+
+        try:
+            with self.datastore.batch():
+                for update, _, _ in updates.values():
+                    update()
+        except Exception:
+            logger.exception('Could not apply {} auth sync messages together, applying them one by one'.format(
+                len(messages)
+            ))
+            self._apply_each(updates, settled)
+        else:
+            for key, (_, digest, key_messages) in updates.items():
+                self._applied(key, digest, key_messages, settled)
+
+        statsd.incr('auth_sync_batch.messages', len(messages))
+        statsd.timing('auth_sync_batch.time', (time.time() - start) * 1000)
+
+    def _apply_each(self, updates, settled):
+        for key, (update, digest, key_messages) in updates.items():
+            try:
+                with self.datastore.batch():
+                    update()
+            except Exception:
+                logger.exception('Rejecting auth sync messages of {}'.format(key))
+                settled.extend((message, False) for message in key_messages)
+            else:
+                self._applied(key, digest, key_messages, settled)
+
+    def _applied(self, key, digest, messages, settled):
+        if self.coalescer is not None:
+            self.coalescer.mark_applied(key, digest)
+        settled.extend((message, True) for message in messages)
+
+    def _parse(self, body, message):
+        """
+        Returns:
+            tuple: entity key, function applying the message to the datastore and content hash of the message
+        """
+        task_name, args, kwargs = _task_call(body, message)
+
+        if task_name == ROLE_TASK:
+            data = _load_role_data(_role_message(*args, **kwargs))
+            key, digest = self._role_digest(data)
+
+            def update():
+                self.datastore.learn_permissions(data['permissions'])
+                permission_uuids = [permission['uuid'] for permission in data['permissions']]
+                self.datastore.apply_role(data['uuid'], data['type'], permission_uuids, commit=True)
+
+            return key, update, digest
+
+        if task_name == GROUP_TASK:
+            group_uuid, complex_uuids = _group_message(*args, **kwargs)
+            key, digest = self._group_digest(group_uuid, complex_uuids)
+
+            def update():
+                removed, added = _group_changes(self.datastore, group_uuid, complex_uuids)
+                self.datastore.update_group_associations(group_uuid, removed, added, commit=True)
+
+            return key, update, digest
+
+        raise ValueError('Not an auth sync task: {}'.format(task_name))
+
+    def _role_digest(self, data):
+        if self.coalescer is None:
+            return 'role:{}'.format(data['uuid']), None
+        return self.coalescer.role_digest(data)
+
+    def _group_digest(self, group_uuid, complex_uuids):
+        if self.coalescer is None:
+            return 'group:{}'.format(group_uuid), None
+        return self.coalescer.group_digest(group_uuid, complex_uuids)
+
+
+def _init_batch_consumer(celery_app, datastore, queue, batch_size=500, batch_wait=0.2, coalescer=None):
+    """
+    Add a consumer step to the Celery worker applying the sync messages of the queue in batches
+
+    Args:
+        celery_app (Celery): Celery app of the worker
+        datastore (SQLAlchemySessionAuthStore): datastore the messages are applied to
+        queue (kombu.Queue): queue of the role and group sync messages, not consumed by the task consumer
+        batch_size (int): number of messages applying the batch when reached
+        batch_wait (int or float): number of seconds to wait for more messages before applying a batch
+        coalescer (SyncCoalescer): skip the roles and groups identical to the last ones applied
+
+    Returns:
+        SyncBatch
+    """
+    batch = SyncBatch(datastore, batch_size=batch_size, coalescer=coalescer)
+
+    class SyncBatchConsumer(bootsteps.ConsumerStep):
+        flush_timer = None
+
+        def get_consumers(self, channel):
+            # room for a second batch to be buffered while the previous one is being applied
+            return [Consumer(
+                channel, queues=[queue], callbacks=[batch.add], accept=['json'], prefetch_count=2 * batch_size
+            )]
+
+        def start(self, c):
+            super(SyncBatchConsumer, self).start(c)
+            self.flush_timer = c.timer.call_repeatedly(batch_wait, batch.flush)
+
+        def stop(self, c):
+            self._stop_flushing()
+            super(SyncBatchConsumer, self).stop(c)
+
+        def shutdown(self, c):
+            self._stop_flushing()
+            super(SyncBatchConsumer, self).shutdown(c)
+
+        def _stop_flushing(self):
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            # the buffered messages are settled while their channel is still open
+            batch.flush()
+            if not batch.drain(timeout=STOP_TIMEOUT):
+                logger.warning('Auth sync batches still applying after {}s, their messages will be redelivered'.format(
+                    STOP_TIMEOUT
+                ))
+
+    celery_app.steps['consumer'].add(SyncBatchConsumer)
+    return batch
+
+
+def _task_call(body, message):
+    """
+    Returns:
+        tuple: name, args and kwargs of a Celery task message, in protocol 2 or 1
+    """
+    task_name = (message.headers or {}).get('task')
+    if task_name:
+        args, kwargs = body[0], body[1]
+        return task_name, args, kwargs or {}
+    return body['task'], body.get('args') or (), body.get('kwargs') or {}
+
+
+def _role_message(payload, debounced=False):
+    return payload
+
+
+def _group_message(group_uuid, complex_uuids, debounced=False):
+    return group_uuid, complex_uuids
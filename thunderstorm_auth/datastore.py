@@ -1,7 +1,37 @@
 from abc import ABC
-
+from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+import logging
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import Text, cast, exists, func, literal, literal_column, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import DBAPIError, SQLAlchemyError
-from werkzeug.contrib.cache import BaseCache, SimpleCache
+from sqlalchemy.orm import scoped_session
+from statsd.defaults.env import statsd
+
+from thunderstorm_auth.cache import AuthCache
+from thunderstorm_auth.permissions import get_registered_permissions
+from thunderstorm_auth.shared_index import SharedIndex
+from thunderstorm_auth.snapshot import AuthSnapshot, freeze
+
+logger = logging.getLogger(__name__)
+
+_PERMISSION_STRING_KEY_PREFIX = 'permission:'
+# methods a cache must provide to be used by the datastore, werkzeug caches have them too
+_CACHE_METHODS = ('get', 'set', 'set_many', 'delete_many')
+# rows per multi-row INSERT of the bulk writes
+_BULK_INSERT_CHUNK_SIZE = 1000
+# rows fetched at once when streaming the complexes of a group
+_GROUP_STREAM_CHUNK_SIZE = 10000
+
+GroupAssociation = namedtuple('GroupAssociation', 'group_uuid complex_uuid')
+RoleRecord = namedtuple('RoleRecord', 'uuid type')
+PermissionRecord = namedtuple('PermissionRecord', 'uuid permission')
 
 
 class AuthStore(ABC):
@@ -69,6 +99,15 @@ class AuthStore(ABC):
         """
         raise NotImplementedError
 
+    def get_roles_with_permission(self, role_uuids, permission_uuid=None, permission_string=None):
+        """
+        Args:
+            role_uuids (list of objects): primary identifiers of roles
+            permission_uuid (object): primary identifier of a permission
+            permission_string (object): string of a permission
+        """
+        raise NotImplementedError
+
     def get_permission(self, permission_uuid):
         """
         Args:
@@ -76,6 +115,20 @@ class AuthStore(ABC):
         """
         raise NotImplementedError
 
+    def get_permission_uuid(self, permission_string):
+        """
+        Args:
+            permission_string (object): string of a permission
+        """
+        raise NotImplementedError
+
+    def invalidate_permission_uuids(self, permission_strings=None):
+        """
+        Args:
+            permission_strings (list of objects): strings of permissions
+        """
+        raise NotImplementedError
+
     def get_permission_roles(self, permission_uuid):
         """
         Args:
@@ -98,6 +151,32 @@ class AuthStore(ABC):
         """
         raise NotImplementedError
 
+    def apply_role(self, role_uuid, role_type, permission_uuids):
+        """
+        Args:
+            role_uuid (object): primary identifier of a role
+            role_type (object): type of a role
+            permission_uuids (list of objects): primary identifiers of all the permissions of the role
+        """
+        raise NotImplementedError
+
+    def replace_role_permissions(self, role_uuid, permission_uuids):
+        """
+        Args:
+            role_uuid (object): primary identifier of a role
+            permission_uuids (list of objects): primary identifiers of all the permissions of the role
+        """
+        raise NotImplementedError
+
+    def learn_permissions(self, permissions):
+        """
+        Called by the role sync with the permissions of a role payload, stores with a permission table of their
+        own ignore them
+
+        Args:
+            permissions (list of dict): uuid, service and permission_string of each permission
+        """
+
     def group_associations_exist(self):
         raise NotImplementedError
 
@@ -108,6 +187,20 @@ class AuthStore(ABC):
         """
         raise NotImplementedError
 
+    def iter_group_complex_uuids(self, group_uuid):
+        """
+        Loads all the associations of the group with `get_group_associations`, stores holding large groups
+        should stream them instead
+
+        Args:
+            group_uuid (object): primary identifier of a group
+
+        Returns:
+            iterator of uuids: primary identifiers of the complexes of the group, in ascending order
+        """
+        associations = self.get_group_associations([group_uuid])
+        return iter(sorted({uuid.UUID(str(association.complex_uuid)) for association in associations}))
+
     def create_group_association(self, group_uuid, complex_uuid):
         """
         Args:
@@ -124,6 +217,15 @@ class AuthStore(ABC):
         """
         raise NotImplementedError
 
+    def update_group_associations(self, group_uuid, removed_uuids, added_uuids):
+        """
+        Args:
+            group_uuid (object): primary identifier of a group
+            removed_uuids (list of objects): primary identifiers of the complexes removed from the group
+            added_uuids (list of objects): primary identifiers of the complexes added to the group
+        """
+        raise NotImplementedError
+
 
 class SQLAlchemySessionStore(object):
     """
@@ -136,15 +238,50 @@ class SQLAlchemySessionStore(object):
             db_session (sqlalchemy session): database session
         """
         self.db_session = db_session
+        # sessions are usually scoped to a thread, so are the batches
+        self._batch = threading.local()
 
     def commit(self):
         """
-        Commit method
+        Commit method, deferred to the end of the enclosing `batch` block if any
         """
+        if getattr(self._batch, 'depth', 0):
+            return
+        self._commit()
+
+    def rollback(self):
+        """
+        Rollback method
+        """
+        self.db_session.rollback()
+
+    @contextmanager
+    def batch(self):
+        """
+        Defer the commits of the writes made in the block to a single commit when it exits, so a sync message
+        costs one transaction. Nested blocks commit with the outermost one.
+
+        The transaction is rolled back if the block raises, or if the commit raises a DBAPIError or a
+        SQLAlchemyError which is then re-raised.
+        """
+        self._batch.depth = getattr(self._batch, 'depth', 0) + 1
+        try:
+            yield self
+        except BaseException:
+            self._batch.depth -= 1
+            if not self._batch.depth:
+                self.rollback()
+            raise
+
+        self._batch.depth -= 1
+        if not self._batch.depth:
+            self._commit()
+
+    def _commit(self):
         try:
             self.db_session.commit()
         except (DBAPIError, SQLAlchemyError):
-            self.db_session.rollback()
+            self.rollback()
             raise
 
 
@@ -153,7 +290,11 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
     SQLAlchemy auth store implementation
     """
 
-    def __init__(self, db_session, role_model, permission_model, association_model, group_association_model, bootstrap=False, cache=None):
+    def __init__(
+            self, db_session, role_model, permission_model, association_model, group_association_model, bootstrap=False,
+            cache=None, negative_timeout=30, broadcaster=None, exists_on_miss=False,
+            background_context=None
+    ):
         """
         Args:
             db_session (sqlalchemy session): database session
@@ -162,25 +303,165 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
             permission_model (sqlalchemy model): a permission model class definition
             group_association_model (sqlalchemy model): A group model class definition (eg complex-group)
             bootstrap (bool): defines if the class should preload the permissions and roles into the cache
-            cache (werkzeug.contrib.cache.BaseCache): cache object, defaults to SimpleCache is None
+            cache (AuthCache): cache object, defaults to an AuthCache if None. Any object with the get, set,
+                set_many and delete_many methods of werkzeug caches (eg. a RedisCache) can be used
+            negative_timeout (int): number of seconds a permission string not found in the db is cached as missing
+            broadcaster (InvalidationBroadcaster): Optional broadcaster of the cache entries invalidated by the
+                writes, to drop them in the other processes too
+            exists_on_miss (bool): answer permission checks missing the cache with a single EXISTS query and
+                load the cache entries in the background, requires an AuthCache and a scoped_session
+            background_context (callable): function returning the context manager the queries of the background
+                threads run in (eg. a Flask app's `app_context`)
         """
         SQLAlchemySessionStore.__init__(self, db_session)
         AuthStore.__init__(self, role_model, permission_model, association_model, group_association_model)
 
-        # default in-memory cache with 7.5mins timeout and max 500 elements cached
-        if cache and not isinstance(cache, BaseCache):
+        if cache is not None and not all(callable(getattr(cache, method, None)) for method in _CACHE_METHODS):
             raise NotImplementedError('Cache class {} not supported'.format(type(cache)))
-        self.cache = cache or SimpleCache(default_timeout=450)
+        # default in-memory cache with a 7.5mins timeout, shortened by up to 10% so workers expire out of step
+        self.cache = cache if cache is not None else AuthCache(default_timeout=450, jitter=0.1)
+        if exists_on_miss and not callable(getattr(self.cache, 'get_or_schedule', None)):
+            raise NotImplementedError('exists_on_miss requires an AuthCache, not {}'.format(type(self.cache)))
+        # a plain session is not thread safe, the stale entries are then reloaded by the requests finding them
+        self.refreshes_in_background = isinstance(db_session, scoped_session)
+        if exists_on_miss and not self.refreshes_in_background:
+            raise NotImplementedError('exists_on_miss requires a scoped_session, not {}'.format(type(db_session)))
+        self.background_context = background_context
+        self.exists_on_miss = exists_on_miss
+        self.negative_timeout = negative_timeout
+
+        self.snapshot = None
+        self.snapshot_timeout = getattr(self.cache, 'default_timeout', 450)
+        self._stale_snapshot_keys = set()
+        self._stale_during_refresh = None
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_refresh_pid = None
+
+        # sessions are usually scoped to a thread, so are the invalidations waiting for their commit
+        self._pending = threading.local()
+        self._commit_listeners = []
+        self.broadcaster = broadcaster
+        if broadcaster is not None:
+            broadcaster.subscribe(self._drop_cache_entries)
 
         if bootstrap:
             self.preload_cache()
 
     def preload_cache(self):
         """
-        Setup the cache for all the permissions in the db
+        Setup the cache for all the permissions in the db with a single query, filling both the
+        permission->roles entries and the permission string->uuid mapping
+
+        Returns:
+            int: number of permissions loaded into the cache
+        """
+        start = time.perf_counter()
+
+        query = self.db_session.query(
+            self.permission_model.uuid, self.permission_model.permission, self.association_model.role_uuid
+        ).outerjoin(self.association_model, self.association_model.permission_uuid == self.permission_model.uuid)
+
+        permission_roles = {}
+        permission_uuids = {}
+        for permission_uuid, permission_string, role_uuid in query:
+            roles = permission_roles.setdefault(str(permission_uuid), set())
+            # permissions without any role come back once with a null role_uuid
+            if role_uuid is not None:
+                roles.add(str(role_uuid))
+            permission_uuids[_permission_string_key(permission_string)] = str(permission_uuid)
+
+        self.cache.set_many(permission_roles)
+        self.cache.set_many(permission_uuids)
+
+        elapsed = time.perf_counter() - start
+        statsd.timing('datastore.preload_cache.time', elapsed * 1000)
+        statsd.gauge('datastore.preload_cache.entries', len(permission_roles))
+        logger.info('Auth cache preloaded with {} permissions in {:.3f}s'.format(len(permission_roles), elapsed))
+
+        return len(permission_roles)
+
+    def preload_snapshot(self, freeze_objects=True, timeout=None):
+        """
+        Load an immutable snapshot of the auth data, served before the cache and reloaded once older than
+        `timeout`
+
+        Meant to be called in the master process of a prefork server (eg. gunicorn --preload) so all the
+        workers share the snapshot instead of each warming its own cache. The session is removed and the
+        connection pool of its engine disposed afterwards, so the workers do not inherit the master's
+        connection.
+
+        Args:
+            freeze_objects (bool): call `gc.freeze()` so the snapshot pages stay shared with the workers
+            timeout (int): number of seconds after which each process loads a new snapshot in the background,
+                defaults to the cache timeout, 0 serves it until the next `refresh_snapshot`
+
+        Returns:
+            AuthSnapshot: the snapshot loaded
+        """
+        if timeout is not None:
+            self.snapshot_timeout = timeout
+        try:
+            self.refresh_snapshot()
+        finally:
+            self._release_connections()
+        if freeze_objects:
+            freeze()
+        return self.snapshot
+
+    def refresh_snapshot(self):
+        """
+        Load a new snapshot and swap it in, the previous one is never mutated
+
+        Returns:
+            AuthSnapshot: the snapshot loaded
+        """
+        start = time.perf_counter()
+        self._stale_during_refresh = set()
+        # the group lookups return queries, the snapshot has nothing to serve them
+        snapshot = AuthSnapshot.load(self, with_groups=False)
+
+        # entries invalidated before the load are up to date in the new snapshot, not the ones invalidated during
+        self.snapshot, self._stale_snapshot_keys = snapshot, self._stale_during_refresh
+        self._stale_during_refresh = None
+
+        statsd.timing('datastore.refresh_snapshot.time', (time.perf_counter() - start) * 1000)
+        return snapshot
+
+    def rollback(self):
+        """
+        Rollback method, the cached entries affected by the writes rolled back are still valid
+        """
+        SQLAlchemySessionStore.rollback(self)
+        self._pending_invalidations().clear()
+        self._pending.groups_changed = False
+
+    def add_commit_listener(self, listener):
+        """
+        Args:
+            listener (callable): function without arguments called after each commit changing the roles of a
+                permission or the complexes of a group, whatever task or consumer made the writes
+        """
+        self._commit_listeners.append(listener)
+
+    def _commit(self):
+        """
+        Commit, then drop the cache entries affected by the writes, broadcast them to the other processes and
+        notify the commit listeners
         """
-        for permission in self.db_session.query(self.permission_model):
-            self.get_permission_roles(permission.uuid)
+        SQLAlchemySessionStore._commit(self)
+
+        keys = list(self._pending_invalidations())
+        self._pending_invalidations().clear()
+        groups_changed = getattr(self._pending, 'groups_changed', False)
+        self._pending.groups_changed = False
+        if keys:
+            self._drop_cache_entries(keys)
+            if self.broadcaster is not None:
+                self.broadcaster.publish(keys)
+
+        if keys or groups_changed:
+            for listener in self._commit_listeners:
+                listener()
 
     def get_role(self, role_uuid):
         """
@@ -248,25 +529,60 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
         if any([(not (permission_uuid or permission_string)), (not role_uuids)]):
             return False
 
+        if self.broadcaster is not None:
+            self.broadcaster.ensure_listening()
+
         if permission_string and not permission_uuid:
-            permission = self.db_session.query(
-                self.permission_model
-            ).filter(self.permission_model.permission == permission_string).one_or_none()
-            if permission:
-                permission_uuid = permission.uuid
+            if self.exists_on_miss:
+                permission_uuid = self._get_or_schedule_permission_uuid(permission_string)
+                if permission_uuid is None:
+                    return self._query_permission_in_roles(role_uuids, permission_string=permission_string)
             else:
+                permission_uuid = self.get_permission_uuid(permission_string)
+            if not permission_uuid:
                 return False
 
-        # check if this works on other types of cache
-        if not self.cache.get(str(permission_uuid)):
-            # call get_permission_roles to set cache
-            self.get_permission_roles(permission_uuid)
+        snapshot_roles = self._get_snapshot_entry(str(permission_uuid))
+        if snapshot_roles is not None:
+            return not snapshot_roles.isdisjoint(str(role_uuid) for role_uuid in role_uuids)
+
+        role_uuids_with_permission = self._get_cached_permission_roles(permission_uuid)
+        if role_uuids_with_permission is None:
+            return self._query_permission_in_roles(role_uuids, permission_uuid=permission_uuid)
 
         # return True if there is intersection
-        if self.cache.get(str(permission_uuid)) & {str(role_uuid) for role_uuid in role_uuids}:
+        if role_uuids_with_permission & {str(role_uuid) for role_uuid in role_uuids}:
             return True
         return False
 
+    def get_roles_with_permission(self, role_uuids, permission_uuid=None, permission_string=None):
+        """
+        Filters the roles holding a permission in a single query, to resolve many role sets at once
+
+        Args:
+            role_uuids (list of uuids): primary identifiers of roles
+            permission_uuid (uuid): primary identifier of a permission
+            permission_string (str): permission name and definition
+
+        Returns:
+            set: string uuids of the roles holding the permission
+        """
+        if any([(not (permission_uuid or permission_string)), (not role_uuids)]):
+            return set()
+
+        query = self.db_session.query(
+            self.association_model.role_uuid
+        ).filter(self.association_model.role_uuid.in_(role_uuids))
+
+        if permission_uuid:
+            query = query.filter(self.association_model.permission_uuid == permission_uuid)
+        else:
+            query = query.join(
+                self.permission_model, self.permission_model.uuid == self.association_model.permission_uuid
+            ).filter(self.permission_model.permission == permission_string)
+
+        return {str(role_uuid) for role_uuid, in query}
+
     def get_permission(self, permission_uuid):
         """
         Args:
@@ -278,6 +594,51 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
         """
         return self.db_session.query(self.permission_model).get(permission_uuid)
 
+    def get_permission_uuid(self, permission_string):
+        """
+        Resolves a permission string to its uuid, going to the db only if the cache has no entry for it
+
+        Permissions not found in the db are cached as missing for `negative_timeout` seconds, so a request for
+        an unknown permission does not hit the db every time.
+
+        Args:
+            permission_string (str): permission name and definition
+
+        Returns:
+            str: primary identifier of the permission
+            None: no permission found with that string
+        """
+        key = _permission_string_key(permission_string)
+
+        permission_uuid = self._get_snapshot_entry(key)
+        if permission_uuid is not None:
+            return permission_uuid
+
+        permission_uuid = self.cache.get(key)
+        if permission_uuid is not None:
+            # missing permissions are cached as an empty string
+            return permission_uuid or None
+
+        permission_uuid = self._query_permission_uuid(permission_string)
+        self.cache.set(key, permission_uuid, timeout=self._permission_uuid_timeout(permission_uuid))
+        return permission_uuid or None
+
+    def invalidate_permission_uuids(self, permission_strings=None):
+        """
+        Drops cached permission string->uuid entries, so they are resolved against the db on next use
+
+        Args:
+            permission_strings (list of str): permission strings to invalidate, defaults to the registered ones
+        """
+        if permission_strings is None:
+            permission_strings = get_registered_permissions()
+
+        keys = [_permission_string_key(permission_string) for permission_string in permission_strings]
+        if keys:
+            self._drop_cache_entries(keys)
+            if self.broadcaster is not None:
+                self.broadcaster.publish(keys)
+
     def get_permission_roles(self, permission_uuid):
         """
         Args:
@@ -286,16 +647,166 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
         Returns:
             query (sqlalchemy query object): query with all the roles owning a specifics permission_uuid
         """
+        self._load_permission_roles(permission_uuid)
+
         subquery = self.db_session.query(
             self.association_model.role_uuid
         ).filter(self.association_model.permission_uuid == permission_uuid)
 
-        # subquery values are a 1 element lists of UUIDS: [[UUID], [UUID], [UUID]]
-        # setting the cache with permission_uuid as key and roles_uuids as string values
-        self.cache.set(str(permission_uuid), {str(role[0]) for role in subquery})
-
         return self.db_session.query(self.role_model).filter(self.role_model.uuid.in_(subquery))
 
+    def _get_cached_permission_roles(self, permission_uuid):
+        """
+        Returns the cached roles of a permission, loading them on a miss. With an AuthCache concurrent misses
+        share a single query, with `exists_on_miss` the roles are loaded in the background instead.
+
+        Returns:
+            set: string uuids of the roles owning the permission
+            None: roles not cached yet, only with `exists_on_miss`
+        """
+        if self.exists_on_miss:
+            return self.cache.get_or_schedule(
+                str(permission_uuid), lambda: self._refresh_permission_roles(permission_uuid)
+            )
+
+        get_or_load = getattr(self.cache, 'get_or_load', None) if self.refreshes_in_background else None
+        if get_or_load is not None:
+            return get_or_load(
+                str(permission_uuid),
+                lambda: self._query_permission_roles(permission_uuid),
+                refresh=lambda: self._refresh_permission_roles(permission_uuid),
+            )
+
+        # an empty set is a valid cached value, only a missing entry triggers the query
+        role_uuids = self.cache.get(str(permission_uuid))
+        if role_uuids is None:
+            role_uuids = self._load_permission_roles(permission_uuid)
+        return role_uuids
+
+    def _load_permission_roles(self, permission_uuid):
+        """
+        Sets the cache with permission_uuid as key and the uuids of the roles owning it as string values
+
+        Returns:
+            set: string uuids of the roles owning the permission
+        """
+        role_uuids = self._query_permission_roles(permission_uuid)
+        self.cache.set(str(permission_uuid), role_uuids)
+
+        return role_uuids
+
+    def _refresh_permission_roles(self, permission_uuid):
+        """
+        Reload the roles of a permission whose cache entry is stale, called from the cache refresher thread
+
+        Returns:
+            set: string uuids of the roles owning the permission
+        """
+        with self._background_session():
+            return self._query_permission_roles(permission_uuid)
+
+    def _get_or_schedule_permission_uuid(self, permission_string):
+        """
+        Resolves a permission string from the snapshot or the cache, loading it in the background on a miss
+
+        Returns:
+            str: primary identifier of the permission, empty if the permission is not in the db
+            None: permission string not cached yet
+        """
+        key = _permission_string_key(permission_string)
+
+        permission_uuid = self._get_snapshot_entry(key)
+        if permission_uuid is not None:
+            return permission_uuid
+
+        return self.cache.get_or_schedule(
+            key, lambda: self._refresh_permission_uuid(permission_string), timeout=self._permission_uuid_timeout
+        )
+
+    def _refresh_permission_uuid(self, permission_string):
+        """
+        Resolve a permission string, called from the cache refresher thread
+
+        Returns:
+            str: primary identifier of the permission, empty if the permission is not in the db
+        """
+        with self._background_session():
+            return self._query_permission_uuid(permission_string)
+
+    def _query_permission_uuid(self, permission_string):
+        """
+        Returns:
+            str: primary identifier of the permission, empty if the permission is not in the db so that
+                missing permissions can be cached too
+        """
+        permission_uuid = self.db_session.query(
+            self.permission_model.uuid
+        ).filter(self.permission_model.permission == permission_string).scalar()
+
+        return str(permission_uuid) if permission_uuid is not None else ''
+
+    def _permission_uuid_timeout(self, permission_uuid):
+        # missing permissions are cached for a short time, they appear once synced
+        return None if permission_uuid else self.negative_timeout
+
+    def _query_permission_in_roles(self, role_uuids, permission_uuid=None, permission_string=None):
+        """
+        Checks a permission against some roles with a single EXISTS query, without loading all the roles
+        of the permission
+
+        Returns:
+            bool: permission belongs to at least one role
+        """
+        statsd.incr('datastore.is_permission_in_roles.exists_query')
+
+        # role uuids which are not uuids can not match and would break the query
+        role_uuids = _valid_uuids(role_uuids)
+        if not role_uuids:
+            return False
+
+        query = self.db_session.query(self.association_model).filter(self.association_model.role_uuid.in_(role_uuids))
+        if permission_uuid is not None:
+            query = query.filter(self.association_model.permission_uuid == permission_uuid)
+        else:
+            query = query.join(
+                self.permission_model, self.permission_model.uuid == self.association_model.permission_uuid
+            ).filter(self.permission_model.permission == permission_string)
+
+        return self.db_session.query(query.exists()).scalar()
+
+    def _release_connections(self):
+        self._remove_thread_session()
+        engine = self.db_session.get_bind()
+        # sessions bound to a connection (eg. in a test transaction) have no pool to dispose
+        if isinstance(engine, Engine):
+            engine.dispose()
+
+    @contextmanager
+    def _background_session(self):
+        """
+        Run the queries of a background thread in `background_context`, removing the thread's session afterwards
+        """
+        with ExitStack() as stack:
+            if self.background_context is not None:
+                stack.enter_context(self.background_context())
+            try:
+                yield
+            finally:
+                self._remove_thread_session()
+
+    def _remove_thread_session(self):
+        # the scoped session of the refresher thread must not be left open
+        remove_session = getattr(self.db_session, 'remove', None)
+        if remove_session is not None:
+            remove_session()
+
+    def _query_permission_roles(self, permission_uuid):
+        query = self.db_session.query(
+            self.association_model.role_uuid
+        ).filter(self.association_model.permission_uuid == permission_uuid)
+
+        return {str(role_uuid) for role_uuid, in query}
+
     def get_permissions(self, permission_uuids):
         """
         Args:
@@ -323,6 +834,89 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
 
         return role_uuid
 
+    def apply_role(self, role_uuid, role_type, permission_uuids, commit=False):
+        """
+        Apply a role sync payload with set-based statements: the role is created if missing, the associations
+        to permissions not in the payload are deleted and the ones to the payload permissions owned by this
+        service are inserted, the other permissions being filtered out by the insert itself
+
+        Args:
+            role_uuid (uuid): primary identifier of a role
+            role_type (str): type of a role
+            permission_uuids (list of uuids): primary identifiers of all the permissions of the role, of any
+                service
+            commit (bool): commit or not the db session
+
+        Returns:
+            (added, removed) (tuple): sets of the string uuids of the permissions associated to and dissociated
+                from the role
+        """
+        start = time.perf_counter()
+        permission_uuids = sorted({uuid.UUID(str(permission_uuid)) for permission_uuid in permission_uuids})
+        role_table = self.role_model.__table__
+        association_table = self.association_model.__table__
+        # the statements below bypass the unit of work, the pending writes must reach the db first
+        self.db_session.flush()
+
+        # a role with the same type but another uuid still raises an IntegrityError, like `create_role`
+        self.db_session.execute(
+            postgresql.insert(role_table).values(uuid=role_uuid, type=role_type).on_conflict_do_nothing(
+                index_elements=[role_table.c.uuid]
+            )
+        )
+
+        removed = self.replace_role_permissions(role_uuid, permission_uuids)
+
+        added = set()
+        if permission_uuids:
+            owned_permissions = select([
+                literal(role_uuid, type_=association_table.c.role_uuid.type), self.permission_model.uuid
+            ]).where(self.permission_model.uuid.in_(permission_uuids))
+            insert = postgresql.insert(association_table).from_select(
+                ['role_uuid', 'permission_uuid'], owned_permissions
+            ).on_conflict_do_nothing().returning(association_table.c.permission_uuid)
+            added = {str(permission_uuid) for permission_uuid, in self.db_session.execute(insert)}
+
+        self._pending_invalidations().update(added)
+
+        if commit:
+            self.commit()
+
+        statsd.timing('datastore.apply_role.time', (time.perf_counter() - start) * 1000)
+        return (added, removed)
+
+    def replace_role_permissions(self, role_uuid, permission_uuids, commit=False):
+        """
+        Remove every association of a role to a permission not listed with a single DELETE, anti-joined
+        against the listed permissions
+
+        Args:
+            role_uuid (uuid): primary identifier of a role
+            permission_uuids (list of uuids): primary identifiers of all the permissions of the role
+            commit (bool): commit or not the db session
+
+        Returns:
+            set: string uuids of the permissions dissociated from the role, their cache entries are dropped
+                on commit
+        """
+        association_table = self.association_model.__table__
+        permission_uuids = [uuid.UUID(str(permission_uuid)) for permission_uuid in permission_uuids]
+        self.db_session.flush()
+
+        delete = association_table.delete().where(association_table.c.role_uuid == role_uuid)
+        if permission_uuids:
+            delete = delete.where(_not_in_uuids(association_table.c.permission_uuid, permission_uuids))
+        removed = {
+            str(permission_uuid)
+            for permission_uuid, in self.db_session.execute(delete.returning(association_table.c.permission_uuid))
+        }
+        self._pending_invalidations().update(removed)
+
+        if commit:
+            self.commit()
+
+        return removed
+
     def create_role_permission_association(self, role_uuid, permission_uuid, commit=False):
         """
         Args:
@@ -336,6 +930,7 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
         query = self.get_role_permissions(role_uuid).filter(self.permission_model.uuid == permission_uuid)
         if not query.one_or_none():
             self.db_session.add(self.association_model(role_uuid=role_uuid, permission_uuid=permission_uuid))
+            self._pending_invalidations().add(str(permission_uuid))
 
         if commit:
             self.commit()
@@ -357,6 +952,7 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
 
         if association:
             self.db_session.delete(association)
+            self._pending_invalidations().add(str(permission_uuid))
 
             if commit:
                 self.commit()
@@ -384,6 +980,24 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
             return self.db_session.query(self.group_association_model).filter(self.group_association_model.group_uuid == group_uuids[0])
         return self.db_session.query(self.group_association_model).filter(self.group_association_model.group_uuid.in_(group_uuids))
 
+    def iter_group_complex_uuids(self, group_uuid, chunk_size=_GROUP_STREAM_CHUNK_SIZE):
+        """
+        Stream the complexes of a group in chunks read from a server side cursor, without loading the
+        association objects
+
+        Args:
+            group_uuid (uuid): primary identifier of a group
+            chunk_size (int): number of rows fetched at once
+
+        Returns:
+            iterator of uuids: primary identifiers of the complexes of the group, in ascending order
+        """
+        model = self.group_association_model
+        query = self.db_session.query(model.complex_uuid).filter(
+            model.group_uuid == group_uuid
+        ).order_by(model.complex_uuid).yield_per(chunk_size)
+        return (complex_uuid for complex_uuid, in query)
+
     def create_group_association(self, group_uuid, complex_uuid, commit=False):
         """
         Args:
@@ -395,6 +1009,7 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
             (group_uuid, complex_uuid) (tuple): identifier of the group association created
         """
         self.db_session.add(self.group_association_model(group_uuid=group_uuid, complex_uuid=complex_uuid))
+        self._pending.groups_changed = True
 
         if commit:
             self.commit()
@@ -415,8 +1030,735 @@ class SQLAlchemySessionAuthStore(SQLAlchemySessionStore, AuthStore):
 
         if association:
             self.db_session.delete(association)
+            self._pending.groups_changed = True
 
             if commit:
                 self.commit()
 
         return (group_uuid, complex_uuid)
+
+    def update_group_associations(self, group_uuid, removed_uuids, added_uuids, commit=False):
+        """
+        Apply the changes to the complexes of a group found by diffing them with its current complexes, with a
+        single DELETE of the complexes removed and multi-row INSERT ... ON CONFLICT DO NOTHING of the ones added
+
+        Args:
+            group_uuid (uuid): primary identifier of a group
+            removed_uuids (list of uuids): primary identifiers of the complexes removed from the group
+            added_uuids (list of uuids): primary identifiers of the complexes added to the group
+            commit (bool): commit or not the db session
+
+        Returns:
+            (added, removed) (tuple): number of group associations inserted and deleted
+        """
+        start = time.perf_counter()
+        model = self.group_association_model
+        # sorted so concurrent syncs of overlapping groups lock the rows in the same order
+        removed_uuids = sorted({uuid.UUID(str(complex_uuid)) for complex_uuid in removed_uuids})
+        added_uuids = sorted({uuid.UUID(str(complex_uuid)) for complex_uuid in added_uuids})
+        # the statements below bypass the unit of work, the pending writes must reach the db first
+        self.db_session.flush()
+
+        removed = 0
+        if removed_uuids:
+            removed = self.db_session.query(model).filter(
+                model.group_uuid == group_uuid, _in_uuids(model.complex_uuid, removed_uuids)
+            ).delete(synchronize_session=False)
+
+        added = 0
+        for offset in range(0, len(added_uuids), _BULK_INSERT_CHUNK_SIZE):
+            insert = postgresql.insert(model.__table__).values([
+                {'group_uuid': group_uuid, 'complex_uuid': complex_uuid}
+                for complex_uuid in added_uuids[offset:offset + _BULK_INSERT_CHUNK_SIZE]
+            ]).on_conflict_do_nothing()
+            added += self.db_session.execute(insert).rowcount
+
+        if added or removed:
+            self._pending.groups_changed = True
+
+        if commit:
+            self.commit()
+
+        statsd.timing('datastore.update_group_associations.time', (time.perf_counter() - start) * 1000)
+        statsd.incr('datastore.update_group_associations.rows', added + removed)
+        return (added, removed)
+
+    def _pending_invalidations(self):
+        """
+        Returns:
+            set: cache keys of the entries affected by the uncommitted writes of the current thread
+        """
+        try:
+            return self._pending.keys
+        except AttributeError:
+            self._pending.keys = set()
+            return self._pending.keys
+
+    def _drop_cache_entries(self, keys):
+        """
+        Args:
+            keys (list of str): cache keys to drop, they are reloaded from the db on next use
+        """
+        self.cache.delete_many(*keys)
+        # the shared snapshot is left untouched, the keys are served from the cache until the next refresh
+        if self.snapshot is not None:
+            self._stale_snapshot_keys.update(keys)
+        if self._stale_during_refresh is not None:
+            self._stale_during_refresh.update(keys)
+
+    def _get_snapshot_entry(self, key):
+        """
+        Args:
+            key (str): cache key of the entry
+
+        Returns:
+            object: the snapshot value of the entry
+            None: no snapshot, entry not in the snapshot or invalidated since it was loaded
+        """
+        snapshot = self.snapshot
+        if snapshot is None or key in self._stale_snapshot_keys:
+            return None
+        # without a broadcaster the writes of the other processes are only picked up by a new snapshot, the old
+        # one is served while it loads like a stale cache entry
+        if self.snapshot_timeout and time.time() - snapshot.loaded_at >= self.snapshot_timeout:
+            self._schedule_snapshot_refresh()
+
+        if key.startswith(_PERMISSION_STRING_KEY_PREFIX):
+            return snapshot.get_permission_uuid(key[len(_PERMISSION_STRING_KEY_PREFIX):])
+        return snapshot.get_permission_roles(key)
+
+    def _schedule_snapshot_refresh(self):
+        # a refresh started by the master before the fork is not running in the workers, each starts its own
+        if self._snapshot_refresh_pid == os.getpid():
+            return
+
+        with self._snapshot_lock:
+            if self._snapshot_refresh_pid == os.getpid():
+                return
+            self._snapshot_refresh_pid = os.getpid()
+
+        if not self.refreshes_in_background:
+            self._refresh_expired_snapshot()
+            return
+
+        thread = threading.Thread(
+            target=self._refresh_snapshot_in_background, name='auth-snapshot-refresher', daemon=True
+        )
+        thread.start()
+
+    def _refresh_snapshot_in_background(self):
+        with self._background_session():
+            self._refresh_expired_snapshot()
+
+    def _refresh_expired_snapshot(self):
+        try:
+            self.refresh_snapshot()
+        except Exception:
+            # a snapshot which can not be refreshed gives way to the cache so it is no staler than the cache
+            self.snapshot = None
+            logger.exception('Could not refresh the auth snapshot, falling back to the cache')
+            statsd.incr('datastore.refresh_snapshot.errors')
+        finally:
+            self._snapshot_refresh_pid = None
+
+
+class MmapAuthStore(AuthStore):
+    """
+    Read-only auth store answering straight from an index file mapped in memory, see
+    `thunderstorm_auth.shared_index`
+
+    All the workers of a host map the same file, so the auth data is in memory once per host and a new
+    worker has nothing to warm. The file is reopened when the writer replaces it.
+    """
+
+    def __init__(self, path, check_interval=5):
+        """
+        Args:
+            path (str): path to the index file written by `SharedIndexWriter`
+            check_interval (int or float): minimum number of seconds between two checks for a new index file
+        """
+        AuthStore.__init__(self, None, None, None, None)
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stat = None
+        self._index = None
+        self._next_check = 0
+
+    @property
+    def index(self):
+        """
+        Returns:
+            SharedIndex: the current index
+            None: no index file has been written yet
+        """
+        if time.monotonic() >= self._next_check:
+            self.reload_if_changed()
+        return self._index
+
+    def reload_if_changed(self):
+        """
+        Map the index file again if it has been replaced since it was last mapped
+
+        Returns:
+            bool: True if a new index file has been mapped
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                if self._index is None:
+                    logger.warning('Auth index {} not written yet, denying all permissions'.format(self.path))
+                return False
+
+            stat = stat.st_ino, stat.st_mtime_ns, stat.st_size
+            if stat == self._stat:
+                return False
+
+            try:
+                index = SharedIndex.open(self.path)
+            except (OSError, ValueError) as ex:
+                logger.warning('Could not map auth index {}: {}'.format(self.path, ex))
+                return False
+
+            # the previous mapping is closed once the requests in flight using it are done
+            self._index, self._stat = index, stat
+            return True
+        finally:
+            self._lock.release()
+
+    def is_permission_in_roles(self, permission_uuid=None, permission_string=None, role_uuids=None):
+        """
+        Args:
+            permission_uuid (uuid): primary identifier of a permission
+            permission_string (str): permission name and definition
+            role_uuids (list of uuids): primary identifiers of roles
+
+        Returns:
+            bool: permission belongs to at least one role
+        """
+        index = self.index
+        if index is None or not (permission_uuid or permission_string) or not role_uuids:
+            return False
+
+        if permission_string and not permission_uuid:
+            permission_uuid = index.get_permission_uuid(permission_string)
+            if permission_uuid is None:
+                return False
+
+        return index.is_permission_in_roles(permission_uuid, role_uuids)
+
+    def get_roles_with_permission(self, role_uuids, permission_uuid=None, permission_string=None):
+        """
+        Args:
+            role_uuids (list of uuids): primary identifiers of roles
+            permission_uuid (uuid): primary identifier of a permission
+            permission_string (str): permission name and definition
+
+        Returns:
+            set: string uuids of the roles holding the permission
+        """
+        index = self.index
+        if index is None or not (permission_uuid or permission_string) or not role_uuids:
+            return set()
+
+        if permission_string and not permission_uuid:
+            permission_uuid = index.get_permission_uuid(permission_string)
+            if permission_uuid is None:
+                return set()
+
+        return index.get_roles_with_permission(role_uuids, permission_uuid)
+
+    def get_permission_uuid(self, permission_string):
+        """
+        Args:
+            permission_string (str): permission name and definition
+
+        Returns:
+            str: primary identifier of the permission
+            None: no permission found with that string
+        """
+        index = self.index
+        return index.get_permission_uuid(permission_string) if index is not None else None
+
+    def group_associations_exist(self):
+        """
+        Returns:
+            bool: True if at least one group is present, False otherwise
+        """
+        index = self.index
+        return index is not None and index.has_group_complexes()
+
+    def get_group_associations(self, group_uuids):
+        """
+        Args:
+            group_uuids (list of uuids): primary identifiers of groups
+
+        Returns:
+            list of GroupAssociation: the group associations with those group uuids
+        """
+        index = self.index
+        if index is None:
+            return []
+        return [
+            GroupAssociation(group_uuid, complex_uuid)
+            for group_uuid in group_uuids for complex_uuid in index.get_complex_uuids(group_uuid)
+        ]
+
+
+class InMemoryAuthStore(AuthStore):
+    """
+    Auth store keeping the roles, permissions and group associations in dicts of sets, without any I/O
+
+    It is fed by the same sync tasks as the SQLAlchemy datastore, so a service able to rebuild its state from
+    the sync messages (eg. after a roles and groups republish) can check permissions without a database.
+    It only holds what the sync tasks applied in its own process: the Celery worker's store, never the one of
+    a web worker. The permissions of the service are learned from the role payloads.
+    Writes swap in new frozensets under a lock, reads never lock. The commit arguments and `commit` exist
+    for compatibility with the sync tasks, every write is applied immediately.
+    """
+
+    def __init__(self, permissions=None, service_name=None):
+        """
+        Args:
+            permissions (dict): Optional permission string -> permission uuid of the permissions of the service,
+                the role associations of the other permissions are ignored by the sync tasks
+            service_name (str): Optional name of the service, its permissions are learned from the role payloads
+        """
+        AuthStore.__init__(self, None, None, None, None)
+        self._lock = threading.Lock()
+        self._roles = {}
+        self._permissions = {}
+        self._permission_uuids = {}
+        self._permission_roles = {}
+        self._role_permissions = {}
+        self._group_complexes = {}
+        self.service_name = service_name
+
+        for permission_string, permission_uuid in (permissions or {}).items():
+            self.create_permission(permission_uuid, permission_string)
+
+    def commit(self):
+        """
+        Nothing to commit, kept for compatibility with the sync tasks
+        """
+
+    @contextmanager
+    def batch(self):
+        """
+        Nothing to batch, kept for compatibility with the sync tasks
+        """
+        yield self
+
+    def create_permission(self, permission_uuid, permission_string):
+        """
+        Args:
+            permission_uuid (uuid): primary identifier of a permission
+            permission_string (str): permission name and definition
+
+        Returns:
+            permission_uuid (uuid): identifier of the permission created
+        """
+        permission_key = str(permission_uuid)
+        with self._lock:
+            # a renamed permission is not found under its previous string anymore
+            known = self._permissions.get(permission_key)
+            if known is not None and self._permission_uuids.get(known.permission) == permission_key:
+                del self._permission_uuids[known.permission]
+            self._permissions[permission_key] = PermissionRecord(permission_uuid, permission_string)
+            self._permission_uuids[permission_string] = permission_key
+        return permission_uuid
+
+    def learn_permissions(self, permissions):
+        """
+        Create the permissions of the service found in a role payload, the ones of the other services are
+        ignored like they are by the permission table of a SQLAlchemy datastore
+
+        Args:
+            permissions (list of dict): uuid, service and permission_string of each permission
+        """
+        if self.service_name is None:
+            return
+
+        for permission in permissions:
+            if permission['service'] != self.service_name:
+                continue
+            permission_key = str(permission['uuid'])
+            known = self._permissions.get(permission_key)
+            if known is None or known.permission != permission['permission_string']:
+                self.create_permission(permission['uuid'], permission['permission_string'])
+
+    def create_role(self, role_uuid, role_type, commit=False):
+        """
+        Args:
+            role_uuid (uuid): primary identifier of a role
+            role_type (str): type of a role
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            role_uuid (uuid): identifier of the role created
+        """
+        self._roles[str(role_uuid)] = RoleRecord(role_uuid, role_type)
+        return role_uuid
+
+    def get_role(self, role_uuid):
+        """
+        Args:
+            role_uuid (uuid): primary identifier of a role
+
+        Returns:
+            RoleRecord: role with the id passed
+            None: no role found with that id
+        """
+        return self._roles.get(str(role_uuid))
+
+    def get_roles(self, role_uuids):
+        """
+        Args:
+            role_uuids (list of uuids): primary identifiers of roles
+
+        Returns:
+            list of RoleRecord: the roles with those ids
+        """
+        return [self._roles[key] for key in _unique_keys(role_uuids) if key in self._roles]
+
+    def get_role_permissions(self, role_uuid):
+        """
+        Args:
+            role_uuid (uuid): primary identifier of a role
+
+        Returns:
+            list of PermissionRecord: the permissions of the role
+        """
+        return self.get_permissions(self._role_permissions.get(str(role_uuid), ()))
+
+    def get_roles_permissions(self, role_uuids):
+        """
+        Args:
+            role_uuids (list of uuids): primary identifiers of roles
+
+        Returns:
+            list of PermissionRecord: the permissions of any of the roles
+        """
+        permission_uuids = set()
+        for key in _unique_keys(role_uuids):
+            permission_uuids.update(self._role_permissions.get(key, ()))
+        return self.get_permissions(permission_uuids)
+
+    def is_permission_in_roles(self, permission_uuid=None, permission_string=None, role_uuids=None):
+        """
+        Args:
+            permission_uuid (uuid): primary identifier of a permission
+            permission_string (str): permission name and definition
+            role_uuids (list of uuids): primary identifiers of roles
+
+        Returns:
+            bool: permission belongs to at least one role
+        """
+        if not (permission_uuid or permission_string) or not role_uuids:
+            return False
+
+        if permission_string and not permission_uuid:
+            permission_uuid = self._permission_uuids.get(permission_string)
+            if permission_uuid is None:
+                return False
+
+        permission_roles = self._permission_roles.get(str(permission_uuid), frozenset())
+        return not permission_roles.isdisjoint(str(role_uuid) for role_uuid in role_uuids)
+
+    def get_roles_with_permission(self, role_uuids, permission_uuid=None, permission_string=None):
+        """
+        Args:
+            role_uuids (list of uuids): primary identifiers of roles
+            permission_uuid (uuid): primary identifier of a permission
+            permission_string (str): permission name and definition
+
+        Returns:
+            set: string uuids of the roles holding the permission
+        """
+        if not (permission_uuid or permission_string) or not role_uuids:
+            return set()
+
+        if permission_string and not permission_uuid:
+            permission_uuid = self._permission_uuids.get(permission_string)
+            if permission_uuid is None:
+                return set()
+
+        return self._permission_roles.get(str(permission_uuid), frozenset()).intersection(_unique_keys(role_uuids))
+
+    def get_permission(self, permission_uuid):
+        """
+        Args:
+            permission_uuid (uuid): primary identifier of a permission
+
+        Returns:
+            PermissionRecord: permission with the id passed
+            None: no permission found with that id
+        """
+        return self._permissions.get(str(permission_uuid))
+
+    def get_permissions(self, permission_uuids):
+        """
+        Args:
+            permission_uuids (list of uuids): primary identifiers of permissions
+
+        Returns:
+            list of PermissionRecord: the permissions with those ids
+        """
+        return [self._permissions[key] for key in _unique_keys(permission_uuids) if key in self._permissions]
+
+    def get_permission_uuid(self, permission_string):
+        """
+        Args:
+            permission_string (str): permission name and definition
+
+        Returns:
+            str: primary identifier of the permission
+            None: no permission found with that string
+        """
+        return self._permission_uuids.get(permission_string)
+
+    def invalidate_permission_uuids(self, permission_strings=None):
+        """
+        Nothing is cached, kept for compatibility with the permission sync task
+        """
+
+    def get_permission_roles(self, permission_uuid):
+        """
+        Args:
+            permission_uuid (uuid): primary identifier of a permission
+
+        Returns:
+            list of RoleRecord: the roles owning the permission
+        """
+        return self.get_roles(self._permission_roles.get(str(permission_uuid), ()))
+
+    def create_role_permission_association(self, role_uuid, permission_uuid, commit=False):
+        """
+        Args:
+            role_uuid (uuid): primary identifier of a role
+            permission_uuid (uuid): primary identifier of a permission
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            (role_uuid, permission_uuid) (tuple): identifier of the role-permission association created
+        """
+        role_key, permission_key = str(role_uuid), str(permission_uuid)
+        with self._lock:
+            self._permission_roles[permission_key] = self._permission_roles.get(permission_key, frozenset()) | {
+                role_key
+            }
+            self._role_permissions[role_key] = self._role_permissions.get(role_key, frozenset()) | {permission_key}
+        return (role_uuid, permission_uuid)
+
+    def apply_role(self, role_uuid, role_type, permission_uuids, commit=False):
+        """
+        Args:
+            role_uuid (uuid): primary identifier of a role
+            role_type (str): type of a role
+            permission_uuids (list of uuids): primary identifiers of all the permissions of the role, the ones
+                not owned by this service are ignored
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            (added, removed) (tuple): sets of the string uuids of the permissions associated to and dissociated
+                from the role
+        """
+        role_key = str(role_uuid)
+        if role_key not in self._roles:
+            self.create_role(role_uuid, role_type)
+
+        removed = self.replace_role_permissions(role_key, permission_uuids)
+
+        permission_keys = _unique_keys(permission_uuids)
+        added = {
+            key for key in permission_keys - self._role_permissions.get(role_key, frozenset())
+            if key in self._permissions
+        }
+        for permission_key in added:
+            self.create_role_permission_association(role_key, permission_key)
+        return (added, removed)
+
+    def replace_role_permissions(self, role_uuid, permission_uuids, commit=False):
+        """
+        Args:
+            role_uuid (uuid): primary identifier of a role
+            permission_uuids (list of uuids): primary identifiers of all the permissions of the role
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            set: string uuids of the permissions dissociated from the role
+        """
+        role_key = str(role_uuid)
+        removed = set(self._role_permissions.get(role_key, frozenset()) - _unique_keys(permission_uuids))
+        for permission_key in removed:
+            self.delete_role_permission_association(role_key, permission_key)
+        return removed
+
+    def delete_role_permission_association(self, role_uuid, permission_uuid, commit=False):
+        """
+        Args:
+            role_uuid (uuid): primary identifier of a role
+            permission_uuid (uuid): primary identifier of a permission
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            (role_uuid, permission_uuid) (tuple): identifier of the role-permission association deleted
+        """
+        role_key, permission_key = str(role_uuid), str(permission_uuid)
+        with self._lock:
+            _discard(self._permission_roles, permission_key, role_key)
+            _discard(self._role_permissions, role_key, permission_key)
+        return (role_uuid, permission_uuid)
+
+    def group_associations_exist(self):
+        """
+        Returns:
+            bool: True if at least one group is present, False otherwise
+        """
+        return bool(self._group_complexes)
+
+    def get_group_associations(self, group_uuids):
+        """
+        Args:
+            group_uuids (list of uuids): primary identifiers of groups
+
+        Returns:
+            list of GroupAssociation: the group associations with those group uuids
+        """
+        return [
+            GroupAssociation(group_key, complex_uuid)
+            for group_key in _unique_keys(group_uuids) for complex_uuid in self._group_complexes.get(group_key, ())
+        ]
+
+    def iter_group_complex_uuids(self, group_uuid):
+        """
+        Args:
+            group_uuid (uuid): primary identifier of a group
+
+        Returns:
+            iterator of uuids: primary identifiers of the complexes of the group, in ascending order
+        """
+        return iter(sorted(uuid.UUID(complex_key) for complex_key in self._group_complexes.get(str(group_uuid), ())))
+
+    def create_group_association(self, group_uuid, complex_uuid, commit=False):
+        """
+        Args:
+            group_uuid (uuid): primary identifier of a group
+            complex_uuid (uuid): primary identifier of a complex
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            (group_uuid, complex_uuid) (tuple): identifier of the group association created
+        """
+        group_key = str(group_uuid)
+        with self._lock:
+            self._group_complexes[group_key] = self._group_complexes.get(group_key, frozenset()) | {
+                str(complex_uuid)
+            }
+        return (group_uuid, complex_uuid)
+
+    def delete_group_association(self, group_uuid, complex_uuid, commit=False):
+        """
+        Args:
+            group_uuid (uuid): primary identifier of a group
+            complex_uuid (uuid): primary identifier of a complex
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            (group_uuid, complex_uuid) (tuple): identifier of the group association deleted
+        """
+        with self._lock:
+            _discard(self._group_complexes, str(group_uuid), str(complex_uuid))
+        return (group_uuid, complex_uuid)
+
+    def update_group_associations(self, group_uuid, removed_uuids, added_uuids, commit=False):
+        """
+        Args:
+            group_uuid (uuid): primary identifier of a group
+            removed_uuids (list of uuids): primary identifiers of the complexes removed from the group
+            added_uuids (list of uuids): primary identifiers of the complexes added to the group
+            commit (bool): ignored, see `commit`
+
+        Returns:
+            (added, removed) (tuple): number of group associations added and removed
+        """
+        group_key = str(group_uuid)
+        removed_keys, added_keys = _unique_keys(removed_uuids), _unique_keys(added_uuids)
+        with self._lock:
+            current_keys = self._group_complexes.get(group_key, frozenset())
+            complex_keys = (current_keys - removed_keys) | added_keys
+            if complex_keys:
+                self._group_complexes[group_key] = complex_keys
+            else:
+                self._group_complexes.pop(group_key, None)
+        return (len(complex_keys - current_keys), len(current_keys - complex_keys))
+
+
+def _valid_uuids(values):
+    uuids = []
+    for value in values:
+        try:
+            uuids.append(value if isinstance(value, uuid.UUID) else uuid.UUID(str(value)))
+        except ValueError:
+            pass
+    return uuids
+
+
+def _in_uuids(column, uuids):
+    """
+    Condition of a column being one of the uuids, as a semi-join against `unnest(:uuids)`
+
+    Args:
+        column (sqlalchemy column): uuid column
+        uuids (list of uuids): values the column must match
+
+    Returns:
+        sqlalchemy clause: EXISTS (SELECT * FROM unnest(:uuids) AS listed WHERE listed = column)
+    """
+    uuid_type = postgresql.UUID(as_uuid=True)
+    listed = func.unnest(
+        cast(literal([str(value) for value in uuids], postgresql.ARRAY(Text)), postgresql.ARRAY(uuid_type))
+    ).alias('listed')
+    return exists().select_from(listed).where(literal_column('listed', type_=uuid_type) == column)
+
+
+def _not_in_uuids(column, uuids):
+    """
+    Condition of a column not being any of the uuids, as an anti-join against `unnest(:uuids)`
+
+    Postgres before 15 compares each row to every value of a NOT IN list, the anti-join hashes the uuids
+    instead. They are bound as a single array parameter rather than one parameter each.
+
+    Args:
+        column (sqlalchemy column): uuid column
+        uuids (list of uuids): values the column must not match
+
+    Returns:
+        sqlalchemy clause: NOT EXISTS (SELECT * FROM unnest(:uuids) AS listed WHERE listed = column)
+    """
+    return ~_in_uuids(column, uuids)
+
+
+def _unique_keys(values):
+    return {str(value) for value in values}
+
+
+def _discard(sets, key, value):
+    """Remove a value from a dict of frozensets, dropping the key with its last value"""
+    values = sets.get(key, frozenset()) - {value}
+    if values:
+        sets[key] = values
+    else:
+        sets.pop(key, None)
+
+
+def _permission_string_key(permission_string):
+    """
+    Cache key of the permission string->uuid mapping, prefixed so it never clashes with the permission uuid keys
+    """
+    return _PERMISSION_STRING_KEY_PREFIX + permission_string
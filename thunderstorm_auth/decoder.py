@@ -1,22 +1,39 @@
+from collections.abc import Mapping
+import binascii
 import json
+import time
 
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
 import jwt
-import jwt.algorithms
+from jwt.utils import base64url_decode
 
 from thunderstorm_auth import DEFAULT_LEEWAY
-from thunderstorm_auth.exceptions import (ExpiredTokenError, BrokenTokenError, MissingKeyErrror, TokenDecodeError)
+from thunderstorm_auth.cache import token_digest
+from thunderstorm_auth.exceptions import (
+    ExpiredTokenError, BrokenTokenError, MissingKeyErrror, TokenDecodeError, TokenError
+)
+from thunderstorm_auth.jwks import get_key_registry, load_public_key
 
+# algorithms verified directly with cryptography, tokens signed with anything else go through pyjwt
+_RSA_HASHES = {'RS256': hashes.SHA256, 'RS384': hashes.SHA384, 'RS512': hashes.SHA512}
 
-def decode_token(token, jwks, leeway=DEFAULT_LEEWAY, options=None):
+
+def decode_token(token, jwks, leeway=DEFAULT_LEEWAY, options=None, cache=None, rejected_cache=None):
     """Decode and extract data from a JWT.
 
     Args:
         token (str): Token data to decode.
-        jwks (dict): JWK Set containing JWKs to be tried to decode the token.
+        jwks (dict or KeyRegistry): JWK Set containing JWKs to be tried to decode the token.
         leeway (int): Number of seconds of lenience used in determining if a
             token has expired.
         options (dict): Allow the caller to pass additional options to the
             decode method of pyjwt.
+        cache (TokenCache): Optional cache of verified payloads, used only when
+            no options are passed.
+        rejected_cache (RejectedTokenCache): Optional cache of recently rejected
+            tokens, used only when no options are passed.
 
     Returns:
          dict payload stored in the token
@@ -26,10 +43,43 @@ def decode_token(token, jwks, leeway=DEFAULT_LEEWAY, options=None):
         BrokenTokenError: If the token is malformed.
         MissingKeyErrror: If the key_id in the token is not present in the JWK set provided.
     """
+    if options is not None or (cache is None and rejected_cache is None):
+        return _decode_token(token, jwks, leeway, options)
+
+    registry = get_key_registry(jwks)
+    digest = token_digest(token)
+    if rejected_cache is not None:
+        rejected_cache.raise_if_rejected(digest)
+
+    # a payload is only valid for the keys and leeway it was verified with, a rotated or revoked key
+    # changes the fingerprint so the tokens signed with it are verified again
+    cache_key = (digest, registry.fingerprint, leeway)
+    payload = cache.get(cache_key) if cache is not None else None
+    if payload is None:
+        try:
+            payload = _decode_token(token, registry, leeway, options)
+        except TokenError as error:
+            # a missing key may be fetched any moment (eg. just rotated), the token must be tried again
+            if rejected_cache is not None and not isinstance(error, MissingKeyErrror):
+                rejected_cache.reject(digest, error)
+            raise
+
+        # tokens without an expiry are never cached as there is nothing bounding their lifetime
+        if cache is not None and isinstance(payload.get('exp'), int):
+            cache.set(cache_key, payload, payload['exp'] + leeway)
+
+    return dict(payload)
+
+
+def _decode_token(token, jwks, leeway, options):
     try:
-        key_id, algorithm = get_kid_and_alg_headers_from_token(token)
+        segments = _split_token(token)
+        key_id, algorithm = _get_kid_and_alg_headers(segments[0])
+
+        public_key = get_key_registry(jwks).get_key(key_id)
 
-        public_key = get_public_key_from_jwk(jwks['keys'], key_id)
+        if options is None and algorithm in _RSA_HASHES:
+            return _verify_and_decode(segments, public_key, algorithm, leeway)
 
         return jwt.decode(token, key=public_key, leeway=leeway, algorithms=[algorithm], options=options)
 
@@ -65,9 +115,7 @@ def get_public_key_from_jwk(keys, key_id):
         if jwk is None:
             raise KeyError()
 
-    jwk_str = json.dumps(jwk)
-
-    return jwt.algorithms.RSAAlgorithm.from_jwk(jwk_str)
+    return load_public_key(jwk)
 
 
 def get_kid_and_alg_headers_from_token(token):
@@ -83,12 +131,99 @@ def get_kid_and_alg_headers_from_token(token):
     Raises:
         BrokenTokenError: If the JWT is malformed or missing required headers.
     """
+    return _get_kid_and_alg_headers(_split_token(token)[0])
+
+
+def _get_kid_and_alg_headers(header):
     try:
-        token_headers = jwt.PyJWS().get_unverified_header(token)
-        return token_headers['kid'], token_headers['alg']
-    except jwt.exceptions.DecodeError:
-        msg = 'The token supplied is either malformed or missing required segments.'
+        return header['kid'], header['alg']
     except KeyError:
-        msg = 'Token authentication failed due to missing <kid> or <alg> token header'
+        raise BrokenTokenError('Token authentication failed due to missing <kid> or <alg> token header')
+
+
+def _split_token(token):
+    """
+    Split and base64-decode the segments of a JWT in a single pass
 
-    raise BrokenTokenError(msg)
+    Args:
+        token (str): Signed token from the user service
+
+    Returns:
+        tuple: decoded header (dict), payload (bytes), signing input (bytes) and signature (bytes)
+
+    Raises:
+        BrokenTokenError: If the JWT is malformed or missing required segments.
+    """
+    try:
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+
+        signing_input, signature = token.rsplit(b'.', 1)
+        header, payload = signing_input.split(b'.', 1)
+
+        header = json.loads(base64url_decode(header).decode('utf-8'))
+        if not isinstance(header, Mapping):
+            raise ValueError()
+        # the kid and alg headers are used as lookup keys, anything but a string is malformed
+        if any(not isinstance(header.get(name, ''), str) for name in ('kid', 'alg')):
+            raise ValueError()
+
+        return header, base64url_decode(payload), signing_input, base64url_decode(signature)
+    except (ValueError, TypeError, binascii.Error):
+        raise BrokenTokenError('The token supplied is either malformed or missing required segments.')
+
+
+def _verify_and_decode(segments, public_key, algorithm, leeway):
+    """
+    Verify the signature of an already split token and validate its claims the same way pyjwt does
+
+    Raises:
+        jwt.exceptions.InvalidTokenError: the same subclasses pyjwt would raise for the token
+    """
+    _, payload, signing_input, signature = segments
+
+    try:
+        public_key.verify(signature, signing_input, padding.PKCS1v15(), _RSA_HASHES[algorithm]())
+    except InvalidSignature:
+        raise jwt.exceptions.DecodeError('Signature verification failed')
+
+    try:
+        payload = json.loads(payload.decode('utf-8'))
+    except ValueError as ex:
+        raise jwt.exceptions.DecodeError('Invalid payload string: {}'.format(ex))
+    if not isinstance(payload, Mapping):
+        raise jwt.exceptions.DecodeError('Invalid payload string: must be a json object')
+
+    _validate_claims(payload, leeway)
+
+    return payload
+
+
+def _validate_claims(payload, leeway):
+    now = int(time.time())
+
+    if 'iat' in payload:
+        try:
+            int(payload['iat'])
+        except (TypeError, ValueError):
+            raise jwt.exceptions.InvalidIssuedAtError('Issued At claim (iat) must be an integer.')
+
+    if 'nbf' in payload:
+        try:
+            nbf = int(payload['nbf'])
+        except (TypeError, ValueError):
+            raise jwt.exceptions.DecodeError('Not Before claim (nbf) must be an integer.')
+        if nbf > (now + leeway):
+            raise jwt.exceptions.ImmatureSignatureError('The token is not yet valid (nbf)')
+
+    if 'exp' in payload:
+        try:
+            exp = int(payload['exp'])
+        except (TypeError, ValueError):
+            raise jwt.exceptions.DecodeError('Expiration Time claim (exp) must be an integer.')
+        if exp < (now - leeway):
+            raise jwt.exceptions.ExpiredSignatureError('Signature has expired')
+
+    # no audience is ever expected so a token carrying one is rejected, as pyjwt does
+    if 'aud' in payload:
+        raise jwt.exceptions.InvalidAudienceError('Invalid audience')
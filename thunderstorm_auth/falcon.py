@@ -10,6 +10,7 @@ from thunderstorm_auth.exceptions import (
     TokenError, TokenHeaderMissing, AuthJwksNotSet, ThunderstormAuthError, InsufficientPermissions
 )
 from thunderstorm_auth import permissions
+from thunderstorm_auth.jwks import get_key_registry
 from thunderstorm_auth.user import User
 
 try:
@@ -33,16 +34,21 @@ class TsAuthMiddleware:
             expiration_leeway=0,
             with_permission=None,
             service_name=None,
-            auditing=False
+            auditing=False,
+            token_cache=None,
+            rejected_token_cache=None
     ):
         """Falcon middleware for Thunderstorm Authentication.
 
         Args:
-            jwks (dict): JWK Set containing JWKs (dicts) which may be used to decode an auth token
+            jwks (dict or JWKSProvider): JWK Set containing JWKs (dicts) which may be used to decode an auth token,
+                or a provider such as `JWKSFileProvider` to pick up rotated keys without restarts
             datastore (AuthDatastore object): datastore used for the auth data retrieval
             expiration_leeway (int): Optional number of seconds of lenience when
                 calculating token expiry.
             auditing (bool): Defines whether or not auditing is enabled for API calls
+            token_cache (TokenCache): Optional cache of verified token payloads
+            rejected_token_cache (RejectedTokenCache): Optional cache of recently rejected tokens
 
         Raises:
             ThunderstormAuthError: If Falcon is not installed.
@@ -57,6 +63,8 @@ class TsAuthMiddleware:
         self.service_name = service_name
         self.auditing = auditing
         self.audit_msg_exp = 3600
+        self.token_cache = token_cache
+        self.rejected_token_cache = rejected_token_cache
 
         if not self.with_permission:
             raise ThunderstormAuthError('Route with auth but no permission is not allowed.')
@@ -111,9 +119,16 @@ class TsAuthMiddleware:
 
     def _decode_token(self, request):
         token = _get_token(request)
-        if not self.jwks.get('keys'):
+        key_registry = get_key_registry(self.jwks)
+        if not key_registry:
             raise AuthJwksNotSet('There are no JWKs in the JWK set provided or the set is not structured properly')
-        return decode_token(token, self.jwks, leeway=self.expiration_leeway)
+        return decode_token(
+            token,
+            key_registry,
+            leeway=self.expiration_leeway,
+            cache=self.token_cache,
+            rejected_cache=self.rejected_token_cache
+        )
 
     def _validate_permission(self, token_data):
         if self.with_permission:
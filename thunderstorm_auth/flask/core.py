@@ -5,6 +5,7 @@ from thunderstorm.messaging import send_ts_task, SchemaError
 from thunderstorm_auth import TOKEN_HEADER, DEFAULT_LEEWAY
 from thunderstorm_auth.auditing import AuditSchema, AuditConf
 from thunderstorm_auth.exceptions import TokenError
+from thunderstorm_auth.jwks import JWKSFileProvider, RemoteJWKSProvider
 from thunderstorm_auth.utils import load_jwks_from_file
 from thunderstorm_auth.flask.cli import _permissions, _list_permissions, _update_permissions
 from thunderstorm_auth.flask.utils import _decode_token
@@ -40,13 +41,25 @@ class TsAuth(object):
             self.init_app(app, datastore, jwks_path, auditing=auditing, **kwargs)
 
     def _set_default_config(self, app, jwks_path):
-        jwks = load_jwks_from_file(jwks_path)
+        # keys can be rotated without restarting workers either by fetching them from the user service
+        # or by watching the JWK set file, nothing is loaded (nor fetched) when the app set its own keys
+        if 'TS_AUTH_JWKS' not in app.config:
+            if app.config.get('TS_AUTH_JWKS_URL'):
+                jwks = RemoteJWKSProvider(
+                    app.config['TS_AUTH_JWKS_URL'], ttl=app.config.get('TS_AUTH_JWKS_TTL', 3600)
+                )
+            elif app.config.get('TS_AUTH_JWKS_RELOAD_INTERVAL'):
+                jwks = JWKSFileProvider(jwks_path, check_interval=app.config['TS_AUTH_JWKS_RELOAD_INTERVAL'])
+            else:
+                jwks = load_jwks_from_file(jwks_path)
+            app.config['TS_AUTH_JWKS'] = jwks
 
         app.config.setdefault('TS_AUTH_SECRET_KEY', app.config.get('SECRET_KEY'))
         app.config.setdefault('TS_AUTH_LEEWAY', DEFAULT_LEEWAY)
         app.config.setdefault('TS_AUTH_TOKEN_HEADER', TOKEN_HEADER)
-        app.config.setdefault('TS_AUTH_JWKS', jwks)
         app.config.setdefault('TS_AUTH_AUDIT_MSG_EXP', 3600)
+        app.config.setdefault('TS_AUTH_TOKEN_CACHE', None)
+        app.config.setdefault('TS_AUTH_REJECTED_TOKEN_CACHE', None)
 
     @property
     def state(self):
@@ -64,9 +77,15 @@ class TsAuth(object):
         self.datastore = datastore
         self.auditing = auditing if isinstance(auditing, AuditConf) else AuditConf(auditing)
 
-        group = app.cli.group(name='permissions')(_permissions())
-        group.command(name='list')(_list_permissions(datastore.db_session, datastore.permission_model))
-        group.command(name='update')(_update_permissions(app, datastore.db_session, datastore.permission_model))
+        # the background refreshes of the datastore query the db through the app's session (eg. Flask-SQLAlchemy)
+        if getattr(datastore, 'background_context', False) is None:
+            datastore.background_context = app.app_context
+
+        # stores without a db (eg. a MmapAuthStore) have no permission table to list or update
+        if getattr(datastore, 'db_session', None) is not None:
+            group = app.cli.group(name='permissions')(_permissions())
+            group.command(name='list')(_list_permissions(datastore.db_session, datastore.permission_model))
+            group.command(name='update')(_update_permissions(app, datastore.db_session, datastore.permission_model))
 
         if self.auditing.enabled:
             @app.after_request
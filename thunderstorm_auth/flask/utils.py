@@ -1,6 +1,7 @@
 from flask import current_app, request
 
 from thunderstorm_auth.decoder import decode_token
+from thunderstorm_auth.jwks import JWKSProvider
 from thunderstorm_auth import permissions
 from thunderstorm_auth.exceptions import (
     TokenHeaderMissing, AuthJwksNotSet, InsufficientPermissions, Forbidden, Unauthorized
@@ -11,7 +12,13 @@ def _decode_token():
     token = _get_token()
     jwks = _get_jwks()
     leeway = current_app.config['TS_AUTH_LEEWAY']
-    return decode_token(token, jwks, leeway)
+    return decode_token(
+        token,
+        jwks,
+        leeway,
+        cache=current_app.config.get('TS_AUTH_TOKEN_CACHE'),
+        rejected_cache=current_app.config.get('TS_AUTH_REJECTED_TOKEN_CACHE')
+    )
 
 
 def _get_token():
@@ -23,6 +30,8 @@ def _get_token():
 
 
 def _get_jwks():
+    if isinstance(current_app.config['TS_AUTH_JWKS'], JWKSProvider):
+        return current_app.config['TS_AUTH_JWKS']
     try:
         current_app.config['TS_AUTH_JWKS']['keys']
         return current_app.config['TS_AUTH_JWKS']
@@ -1,3 +1,5 @@
+import uuid
+
 from celery import shared_task, group, current_app
 from sqlalchemy import Column
 from sqlalchemy.dialects.postgresql import UUID
@@ -14,7 +16,7 @@ class ComplexGroupAssociationMixin(object):
     complex_uuid = Column(UUID(as_uuid=True), primary_key=True, index=True)
 
 
-def _init_group_tasks(datastore):
+def _init_group_tasks(datastore, bulk_sync=False, coalescer=None, queue=None):
     """
     Create and init shared tasks for handling group associations, no need to register them as they are
     shared_task
@@ -24,6 +26,11 @@ def _init_group_tasks(datastore):
 
     Args:
         datastore (AuthDatastore): datastore object from the thunderstorm-auth library
+        bulk_sync (bool): apply the group memberships in the sync task with a single transaction instead of
+            sending one task per complex added or removed
+        coalescer (SyncCoalescer): skip the memberships identical to the last ones applied for their group
+            and debounce bursts of memberships for the same group
+        queue (kombu.Queue): sync queue of this service, the debounced memberships are sent back to it only
 
     Returns:
         list: tasks needed for handling group associations
@@ -59,7 +66,7 @@ def _init_group_tasks(datastore):
         """
         Request updated groups if none are present in the db
         """
-        if not datastore.have_group_associations():
+        if not datastore.group_associations_exist():
             current_app.send_task(
                 'complex-group.republish',
                 ({},),
@@ -70,7 +77,7 @@ def _init_group_tasks(datastore):
     # TODO @shipperizer: change name on the user service so that this can be standardized
     @shared_task(name='ts_auth.group.complex.sync')
     @statsd.timer('tasks.handle_group_data.time')
-    def handle_group_data(group_uuid, complex_uuids):
+    def handle_group_data(group_uuid, complex_uuids, debounced=False):
         """
         Synchronizes group membership data.
 
@@ -80,17 +87,99 @@ def _init_group_tasks(datastore):
         Args:
             group_uuid (UUID): UUID of group to synchronize.
             complex_uuids (list): list of UUIDs of desired group members (complexes).
+            debounced (bool): the memberships were sent back by this task to wait for the debounce window
         """
-        current_members = {str(gca.complex_uuid) for gca in datastore.get_group_associations([group_uuid])}
-        latest_members = set([str(c) for c in complex_uuids])
+        if coalescer is not None:
+            key, digest = coalescer.group_digest(group_uuid, complex_uuids)
+
+            if coalescer.debounce and not debounced:
+                coalescer.defer(key, digest)
+                handle_group_data.apply_async(
+                    (group_uuid, complex_uuids), {'debounced': True}, countdown=coalescer.debounce, queue=queue
+                )
+                return
+
+            if debounced and not coalescer.is_latest(key, digest):
+                statsd.incr('tasks.handle_group_data.superseded')
+                return
+
+            if not coalescer.claim(key, digest):
+                statsd.incr('tasks.handle_group_data.unchanged')
+                return
+
+        try:
+            removed, added = _group_changes(datastore, group_uuid, complex_uuids)
+
+            if bulk_sync:
+                datastore.update_group_associations(group_uuid, removed, added, commit=True)
+                return
+
+            group([delete_group_association.si(group_uuid, str(complex_uuid)) for complex_uuid in removed])()
+            group([add_group_association.si(group_uuid, str(complex_uuid)) for complex_uuid in added])()
+        except Exception:
+            # let a redelivery of the memberships be applied
+            if coalescer is not None:
+                coalescer.forget(key)
+            raise
 
-        removed = current_members - latest_members
-        added = latest_members - current_members
+    return [handle_group_data, delete_group_association, add_group_association, request_groups_republish]
 
-        group([delete_group_association.si(group_uuid, complex_uuid) for complex_uuid in removed])()
-        group([add_group_association.si(group_uuid, complex_uuid) for complex_uuid in added])()
 
-    return [handle_group_data, delete_group_association, add_group_association, request_groups_republish]
+def _group_changes(datastore, group_uuid, complex_uuids):
+    """
+    Diff the latest complexes of a group with the ones in the datastore, streamed in ascending order
+
+    Args:
+        datastore (AuthDatastore): datastore object from the thunderstorm-auth library
+        group_uuid (uuid): uuid of the group
+        complex_uuids (list): uuids of the latest complexes of the group, or their string representation
+
+    Returns:
+        tuple: lists of the uuids of the complexes removed from and added to the group
+    """
+    current_uuids = datastore.iter_group_complex_uuids(group_uuid)
+    removed, added = _diff_members(current_uuids, _sorted_uuid_ints(complex_uuids))
+    removed = [uuid.UUID(int=complex_int) for complex_int in removed]
+    added = [uuid.UUID(int=complex_int) for complex_int in added]
+    return removed, added
+
+
+def _sorted_uuid_ints(values):
+    """
+    Args:
+        values (list of objects): uuids or their string representation
+
+    Returns:
+        list: unique uuids as 128-bit integers, in ascending order
+    """
+    return sorted({uuid.UUID(str(value)).int for value in values})
+
+
+def _diff_members(current_uuids, latest_ints):
+    """
+    Merge the current members of a group with the latest ones, both sorted, so the current members can be
+    streamed from the database instead of being held in a set
+
+    Args:
+        current_uuids (iterator of uuids): current members, in ascending order
+        latest_ints (list of ints): latest members, see `_sorted_uuid_ints`
+
+    Returns:
+        tuple: lists of the integer uuids removed and added
+    """
+    removed, added = [], []
+    position, end = 0, len(latest_ints)
+    for current_uuid in current_uuids:
+        current_int = current_uuid.int
+        while position < end and latest_ints[position] < current_int:
+            added.append(latest_ints[position])
+            position += 1
+        if position < end and latest_ints[position] == current_int:
+            position += 1
+        else:
+            removed.append(current_int)
+    added.extend(latest_ints[position:])
+    return removed, added
 
 
 def _complex_group_task_routing_key():
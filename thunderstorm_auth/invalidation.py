@@ -0,0 +1,146 @@
+from abc import ABC, abstractmethod
+import json
+import logging
+import os
+import threading
+import uuid
+
+from thunderstorm_auth.exceptions import ThunderstormAuthError
+
+try:
+    import redis
+    HAS_REDIS = True
+except ImportError:
+    HAS_REDIS = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'ts_auth.cache.invalidate'
+
+
+class InvalidationBroadcaster(ABC):
+    """
+    Abstract broadcaster of the cache keys invalidated by datastore writes, so every process drops them
+    """
+
+    @abstractmethod
+    def publish(self, keys):
+        """
+        Args:
+            keys (list of str): cache keys invalidated by this process
+        """
+
+    @abstractmethod
+    def subscribe(self, callback):
+        """
+        Args:
+            callback (callable): function called with the list of keys invalidated by any other process
+        """
+
+    def ensure_listening(self):
+        """
+        Make sure invalidations are received in the current process, eg. after a fork
+        """
+
+
+class RedisInvalidationBroadcaster(InvalidationBroadcaster):
+    """
+    Broadcaster of cache invalidations through a Redis pub/sub channel
+
+    Invalidations are received in a background thread. Threads do not survive a fork, so each (pre-forked)
+    worker process starts its own listener the first time `ensure_listening` is called in it.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', channel=DEFAULT_CHANNEL, client=None, retry_interval=5):
+        """
+        Args:
+            url (str): URL of the Redis server, ignored if a client is passed
+            channel (str): pub/sub channel shared by all the processes of the service
+            client (redis.Redis): Optional Redis client
+            retry_interval (int or float): number of seconds to wait before resubscribing after an error
+
+        Raises:
+            ThunderstormAuthError: If redis is not installed.
+        """
+        if not HAS_REDIS:
+            raise ThunderstormAuthError('Cannot broadcast cache invalidations as redis is not installed.')
+
+        self.client = client or redis.Redis.from_url(url)
+        self.channel = channel
+        self.retry_interval = retry_interval
+
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._origin = None
+        self._pid = None
+        self._thread = None
+
+    def publish(self, keys):
+        if not keys:
+            return
+
+        message = json.dumps({'origin': self._get_origin(), 'keys': list(keys)})
+        try:
+            self.client.publish(self.channel, message)
+        except redis.RedisError as ex:
+            logger.error('Could not publish cache invalidation of {}: {}'.format(keys, ex))
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+        self.ensure_listening()
+
+    def ensure_listening(self):
+        if self._pid == os.getpid() or self._stopped.is_set() or not self._callbacks:
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='ts-auth-invalidation', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        """
+        Stop receiving invalidations
+        """
+        self._stopped.set()
+
+    def _get_origin(self):
+        # processes forked from the same parent must not take each other's messages for their own
+        if self._origin is None or self._origin[0] != os.getpid():
+            self._origin = (os.getpid(), uuid.uuid4().hex)
+        return self._origin[1]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                try:
+                    while not self._stopped.is_set():
+                        message = pubsub.get_message(timeout=1)
+                        if message is not None:
+                            self._handle(message['data'])
+                finally:
+                    pubsub.close()
+            except redis.RedisError as ex:
+                logger.error('Cache invalidation channel {} failed: {}'.format(self.channel, ex))
+                self._stopped.wait(self.retry_interval)
+
+    def _handle(self, data):
+        try:
+            message = json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+            origin, keys = message['origin'], message['keys']
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Ignoring malformed cache invalidation {!r}'.format(data))
+            return
+
+        if origin == self._get_origin():
+            return
+
+        for callback in self._callbacks:
+            try:
+                callback(keys)
+            except Exception:
+                logger.exception('Cache invalidation callback failed')
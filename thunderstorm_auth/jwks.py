@@ -0,0 +1,390 @@
+from abc import ABC, abstractmethod
+from collections.abc import Hashable
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import jwt.algorithms
+
+from thunderstorm_auth.logging import requests
+from thunderstorm_auth.utils import load_jwks_from_file
+
+logger = logging.getLogger(__name__)
+
+# maximum number of distinct JWK sets to keep registries for, in practice a process only ever uses one or two
+_MAX_REGISTRIES = 8
+_REGISTRIES = {}
+
+
+class KeyRegistry(object):
+    """
+    Ready-to-use public keys of a JWK set indexed by key id
+
+    Each key is parsed the first time it is used, so a key which can not be parsed only fails the tokens
+    signed with it instead of the whole set.
+    """
+
+    def __init__(self, jwks, on_missing_key=None):
+        """
+        Args:
+            jwks (dict): JWK Set containing the JWKs to build the public keys from
+            on_missing_key (callable): Optional function called with the key id when it is not in the
+                registry, returns the public key or raises KeyError
+        """
+        self.jwks = jwks
+        self.fingerprint = jwks_fingerprint(jwks)
+        self._jwks = dict(_iter_jwks(jwks))
+        # key id -> parsed public key, or None if the JWK could not be parsed
+        self._keys = {}
+        self._on_missing_key = on_missing_key
+
+    def __len__(self):
+        return len(self._jwks)
+
+    def __contains__(self, key_id):
+        try:
+            return key_id in self._jwks
+        except TypeError:
+            return False
+
+    def get_key(self, key_id):
+        """
+        Args:
+            key_id (str): Unique identifier for the JWK you want to retrieve
+
+        Returns:
+            _RSAPublicKey
+
+        Raises:
+            KeyError: If the key_id is not present in the JWK set or its JWK is not a usable public key.
+        """
+        if key_id not in self:
+            if self._on_missing_key is None:
+                raise KeyError(key_id)
+            return self._on_missing_key(key_id)
+
+        try:
+            public_key = self._keys[key_id]
+        except KeyError:
+            public_key = self._keys[key_id] = self._load_key(key_id)
+
+        if public_key is None:
+            raise KeyError(key_id)
+        return public_key
+
+    def _load_key(self, key_id):
+        try:
+            return load_public_key(self._jwks[key_id])
+        except (ValueError, TypeError, KeyError, jwt.exceptions.InvalidKeyError) as ex:
+            logger.warning('Ignoring unusable JWK {}: {}'.format(key_id, ex))
+            return None
+
+
+class JWKSProvider(ABC):
+    """
+    Abstract source of a JWK set which can change over time
+    """
+
+    @property
+    @abstractmethod
+    def key_registry(self):
+        """
+        Returns:
+            KeyRegistry: registry of the current JWK set
+        """
+
+    @property
+    def jwks(self):
+        """
+        Returns:
+            dict: the current JWK set
+        """
+        return self.key_registry.jwks
+
+
+class JWKSFileProvider(JWKSProvider):
+    """
+    JWK set loaded from a file and reloaded when the file changes, so keys can be rotated without restarts
+    """
+
+    def __init__(self, path, check_interval=30):
+        """
+        Args:
+            path (str): path to the JWK set file
+            check_interval (int or float): minimum number of seconds between two checks of the file mtime
+
+        Raises:
+            ValueError: If the file does not contain a valid JWK set.
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stat = self._get_stat()
+        self._registry = KeyRegistry(load_jwks_from_file(path))
+        self._next_check = time.monotonic() + check_interval
+
+    @property
+    def key_registry(self):
+        if time.monotonic() >= self._next_check:
+            self.reload_if_changed()
+        return self._registry
+
+    def reload_if_changed(self):
+        """
+        Reload the JWK set if the file changed since it was last loaded
+
+        Only one thread checks the file at a time, the others keep using the current registry. A file
+        which can not be loaded (eg. half written) is logged and retried on the next check.
+
+        Returns:
+            bool: True if a new JWK set has been loaded
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            stat = self._get_stat()
+            if stat == self._stat:
+                return False
+
+            try:
+                registry = KeyRegistry(load_jwks_from_file(self.path))
+            except (OSError, ValueError, KeyError, jwt.exceptions.InvalidKeyError) as ex:
+                logger.warning('Could not reload JWK set from {}: {}'.format(self.path, ex))
+                return False
+
+            # swapping the reference is atomic, requests in flight keep the registry they already hold
+            self._registry = registry
+            self._stat = stat
+            return True
+        finally:
+            self._lock.release()
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class RemoteJWKSProvider(JWKSProvider):
+    """
+    JWK set fetched from the user service and refreshed in a background thread before it expires
+
+    The keys are first loaded by the background thread, so building the provider never waits on the user
+    service. A token signed with an unknown key id (including every token received before the first load)
+    waits for a single refetch shared by all the threads, bounded by the request timeout. Refetches triggered
+    by unknown key ids happen at most once per cooldown window so a flood of bad tokens can not stampede the
+    user service. If a refresh fails the current keys are kept and the refresh is retried.
+    """
+
+    def __init__(self, url, ttl=3600, refresh_margin=60, retry_interval=30, unknown_kid_cooldown=60, timeout=5):
+        """
+        Args:
+            url (str): URL of the JWK set, eg. `<user-service>/.well-known/jwks.json`
+            ttl (int or float): number of seconds the fetched keys are considered fresh
+            refresh_margin (int or float): number of seconds before the end of the ttl to refresh the keys
+            retry_interval (int or float): number of seconds to wait before retrying a failed refresh
+            unknown_kid_cooldown (int or float): minimum number of seconds between two refetches triggered
+                by unknown key ids
+            timeout (int or float): timeout in seconds of the HTTP requests to the user service
+        """
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.unknown_kid_cooldown = unknown_kid_cooldown
+        self.timeout = timeout
+
+        self._registry = KeyRegistry({'keys': []}, on_missing_key=self._fetch_missing_key)
+        self._lock = threading.Lock()
+        # set while a fetch is in flight, the threads needing its result wait on it instead of fetching
+        self._fetching = None
+        self._next_unknown_kid_fetch = 0
+        self._next_refresh = 0
+        self._loaded = threading.Event()
+        self._stopped = threading.Event()
+        self._pid = None
+        self._thread = None
+
+        self._ensure_refresher()
+
+    @property
+    def key_registry(self):
+        self._ensure_refresher()
+        return self._registry
+
+    def refresh(self):
+        """
+        Fetch the JWK set and swap in a new registry
+
+        Returns:
+            bool: True if the keys have been refreshed
+        """
+        try:
+            response = requests.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            jwks = response.json()
+            if not jwks['keys']:
+                raise ValueError('Empty JWK Set')
+            registry = KeyRegistry(jwks, on_missing_key=self._fetch_missing_key)
+        except (requests.RequestException, ValueError, KeyError, TypeError, jwt.exceptions.InvalidKeyError) as ex:
+            logger.error('Could not fetch JWK set from {}: {}'.format(self.url, ex))
+            self._next_refresh = time.monotonic() + self.retry_interval
+            return False
+
+        self._registry = registry
+        self._next_refresh = time.monotonic() + max(self.ttl - self.refresh_margin, 0)
+        self._loaded.set()
+        return True
+
+    def wait_until_loaded(self, timeout=None):
+        """
+        Wait for the first fetch of the keys, eg. before serving traffic or in tests
+
+        Args:
+            timeout (int or float): maximum number of seconds to wait, None waits until the keys are loaded
+
+        Returns:
+            bool: True if the keys have been loaded
+        """
+        self._ensure_refresher()
+        return self._loaded.wait(timeout)
+
+    def stop(self):
+        """
+        Stop the background refresh
+        """
+        self._stopped.set()
+
+    def _ensure_refresher(self):
+        # threads do not survive a fork, so each (pre-forked) worker process starts its own refresher
+        if self._pid == os.getpid() or self._stopped.is_set():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='jwks-refresher', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stopped.wait(max(self._next_refresh - time.monotonic(), 0)):
+            self._refresh_once()
+
+    def _refresh_once(self):
+        """
+        Refresh the keys, or wait for the refresh already in flight in another thread
+
+        The lock is never held during the request, only while electing the thread doing it.
+        """
+        with self._lock:
+            fetching = self._fetching
+            leader = fetching is None
+            if leader:
+                fetching = self._fetching = threading.Event()
+
+        if not leader:
+            fetching.wait(self.timeout)
+            return
+
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._fetching = None
+            fetching.set()
+
+    def _fetch_missing_key(self, key_id):
+        with self._lock:
+            # another thread may have fetched the key since this one looked it up
+            if key_id in self._registry:
+                refetch = False
+            # a fetch in flight is joined without spending the cooldown
+            elif self._fetching is not None:
+                refetch = True
+            elif time.monotonic() < self._next_unknown_kid_fetch:
+                raise KeyError(key_id)
+            else:
+                self._next_unknown_kid_fetch = time.monotonic() + self.unknown_kid_cooldown
+                refetch = True
+
+        if refetch:
+            self._refresh_once()
+
+        registry = self._registry
+        if key_id not in registry:
+            raise KeyError(key_id)
+        return registry.get_key(key_id)
+
+
+def get_key_registry(jwks):
+    """
+    Return the key registry for a JWK set, building it only the first time the JWK set object is seen
+
+    Args:
+        jwks (dict, KeyRegistry or JWKSProvider): JWK Set, an already built registry or a JWK set provider
+
+    Returns:
+        KeyRegistry
+    """
+    if isinstance(jwks, KeyRegistry):
+        return jwks
+    if isinstance(jwks, JWKSProvider):
+        return jwks.key_registry
+
+    registry = _REGISTRIES.get(id(jwks))
+    # the registry holds a reference to its JWK set so the id can not be reused while it is stored
+    if registry is None or registry.jwks is not jwks:
+        registry = KeyRegistry(jwks)
+        if len(_REGISTRIES) >= _MAX_REGISTRIES:
+            _REGISTRIES.clear()
+        _REGISTRIES[id(jwks)] = registry
+
+    return registry
+
+
+def jwks_fingerprint(jwks):
+    """
+    Args:
+        jwks (dict): JWK Set
+
+    Returns:
+        bytes: sha256 digest of the content of the JWK set, changing whenever a key is added or removed
+    """
+    content = json.dumps(jwks, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(content.encode('utf-8')).digest()
+
+
+def load_public_key(jwk):
+    """
+    Create an _RSAPublicKey object using the contents of a JWK
+
+    Args:
+        jwk (dict): JWK representing a public key
+
+    Returns:
+        _RSAPublicKey
+    """
+    return jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+
+
+def _iter_jwks(jwks):
+    """JWKs of a JWK set by key id, skipping the entries which can not be indexed"""
+    keys = jwks.get('keys', [])
+
+    if isinstance(keys, dict):  # @will-norris: Invalid format - deprecate
+        items = keys.items()
+    else:
+        items = ((jwk.get('kid'), jwk) for jwk in keys if isinstance(jwk, dict))
+
+    for key_id, jwk in items:
+        if key_id is None or not isinstance(key_id, Hashable):
+            logger.warning('Ignoring JWK without a usable kid: {!r}'.format(key_id))
+            continue
+        yield key_id, jwk
@@ -199,5 +199,8 @@ def _init_permission_tasks(datastore):
             permission.is_sent = True
             datastore.commit()
 
+            # drop any stale (or negative) string->uuid entry cached before the permission was synced
+            datastore.invalidate_permission_uuids([permission.permission])
+
 
     return [handle_sync_permissions]
@@ -51,7 +51,7 @@ class RoleMixin(object):
         return relationship('Permission', secondary='role_permission_association', backref='roles')
 
 
-def _init_role_tasks(datastore):
+def _init_role_tasks(datastore, bulk_sync=False, coalescer=None, queue=None):
     """
     Create and init shared task for handling roles, no need to register them as they are
     shared_task
@@ -61,6 +61,11 @@ def _init_role_tasks(datastore):
 
     Args:
         datastore (AuthDatastore): datastore object from the thunderstorm-auth library
+        bulk_sync (bool): apply the role payloads in the sync task with a single transaction instead of
+            chaining tasks fanning out into one task per permission
+        coalescer (SyncCoalescer): skip the payloads identical to the last one applied for their role and
+            debounce bursts of payloads for the same role
+        queue (kombu.Queue): sync queue of this service, the debounced payloads are sent back to it only
 
     Returns:
         list: tasks needed for handling roles and role associations
@@ -127,49 +132,92 @@ def _init_role_tasks(datastore):
             role_uuid (uuid): primary identifier of a role
             permissions (dict): dictionary of permission objects
         """
-        permission_uuids = {str(permission['uuid']) for permission in permissions}
+        permission_uuids = [permission['uuid'] for permission in permissions]
 
-        role_permission_uuids = {str(p.uuid) for p in datastore.get_role_permissions(role_uuid)}
+        orphan_uuids = datastore.replace_role_permissions(role_uuid, permission_uuids, commit=True)
 
-        orphan_uuids = role_permission_uuids - permission_uuids
-
-        return [
-            datastore.delete_role_permission_association(role_uuid, orphan_uuid, commit=True)
-            for orphan_uuid in orphan_uuids
-        ]
+        return [(role_uuid, orphan_uuid) for orphan_uuid in orphan_uuids]
 
     # TODO @shipperizer restructure tasks.py and put this into it
     # TODO @shipperizer make this a ts_task from thunderstorm-messagging
     @shared_task(name='handle_role_data')
     @statsd.timer('tasks.handle_role_data.time')
-    def handle_role_data(payload):
-        # TODO @shipperizer remove this when using ts_task decorator
-        payload = payload.get('data')
-        if not payload:
-            raise NotImplementedError
-
-        # TODO @ship[perizer backwards compat - remove
-        if MARSHMALLOW_2:
-            data, errors = RoleSchema().load(payload)
-            if errors:
-                # TODO @shipperizer raise a proper exception
-                raise NotImplementedError
-        else:
-            try:
-                data = RoleSchema().load(payload)
-            except ValidationError:
-                # TODO @shipperizer raise a proper exception
-                raise NotImplementedError
-
-        chain(
-            create_role_if_not_exists.si(data['uuid'], data['type']),
-            remove_role_orphan_permission_associations.si(data['uuid'], data['permissions']),
-            create_role_permission_associations_if_not_exist.si(data['uuid'], data['permissions'])
-        )()
+    def handle_role_data(payload, debounced=False):
+        data = _load_role_data(payload)
+
+        if coalescer is not None:
+            key, digest = coalescer.role_digest(data)
+
+            if coalescer.debounce and not debounced:
+                coalescer.defer(key, digest)
+                handle_role_data.apply_async(
+                    (payload,), {'debounced': True}, countdown=coalescer.debounce, queue=queue
+                )
+                return
+
+            if debounced and not coalescer.is_latest(key, digest):
+                statsd.incr('tasks.handle_role_data.superseded')
+                return
+
+            if not coalescer.claim(key, digest):
+                statsd.incr('tasks.handle_role_data.unchanged')
+                return
+
+        try:
+            datastore.learn_permissions(data['permissions'])
+
+            if bulk_sync:
+                datastore.apply_role(
+                    data['uuid'], data['type'], [permission['uuid'] for permission in data['permissions']], commit=True
+                )
+                return
+
+            chain(
+                create_role_if_not_exists.si(data['uuid'], data['type']),
+                remove_role_orphan_permission_associations.si(data['uuid'], data['permissions']),
+                create_role_permission_associations_if_not_exist.si(data['uuid'], data['permissions'])
+            )()
+        except Exception:
+            # let a redelivery of the payload be applied
+            if coalescer is not None:
+                coalescer.forget(key)
+            raise
 
     return [handle_role_data, create_role_if_not_exists, remove_role_orphan_permission_associations, create_role_permission_associations_if_not_exist, create_role_permission_association_if_not_exists]
 
 
+def _load_role_data(message):
+    """
+    Args:
+        message (dict): role sync message, the role is under its 'data' key
+
+    Returns:
+        dict: role loaded with `RoleSchema`
+
+    Raises:
+        NotImplementedError: If the message has no role or the role is invalid.
+    """
+    # TODO @shipperizer remove this when using ts_task decorator
+    payload = message.get('data')
+    if not payload:
+        raise NotImplementedError
+
+    # TODO @ship[perizer backwards compat - remove
+    if MARSHMALLOW_2:
+        data, errors = RoleSchema().load(payload)
+        if errors:
+            # TODO @shipperizer raise a proper exception
+            raise NotImplementedError
+    else:
+        try:
+            data = RoleSchema().load(payload)
+        except ValidationError:
+            # TODO @shipperizer raise a proper exception
+            raise NotImplementedError
+
+    return data
+
+
 def _role_task_routing_key():
     """
     Routing key for role tasks
@@ -1,17 +1,27 @@
 from kombu import Exchange, Queue, binding
 
+from thunderstorm_auth.consumer import _init_batch_consumer
 from thunderstorm_auth.roles import _init_role_tasks, _role_task_routing_key
 from thunderstorm_auth.groups import _init_group_tasks, _complex_group_task_routing_key
 from thunderstorm_auth.permissions import _init_permission_tasks
+from thunderstorm_auth.shared_index import _init_shared_index_writer
 
 
-def init_ts_auth_tasks(celery_app, datastore):
+def init_ts_auth_tasks(celery_app, datastore, bulk_sync=False, coalescer=None, batch_size=0, batch_wait=0.2):
     """
     Initialize a Celery app with a queue and sync tasks for auth group models and roles.
 
     Args:
         celery_app (Celery): Celery app to register the sync tasks with.
         datastore (AuthStore): a datastore
+        bulk_sync (bool): apply each sync message in a single transaction instead of fanning it out into one
+            task per association
+        coalescer (SyncCoalescer): skip the sync messages identical to the last one applied and debounce
+            bursts of messages for the same role or group, see `thunderstorm_auth.coalescing.SyncCoalescer`
+        batch_size (int): consume the sync messages with a worker consumer step applying up to that many
+            messages in one transaction instead of the sync tasks, 0 to disable
+        batch_wait (int or float): number of seconds the consumer step waits for more messages before
+            applying a batch
     """
     messaging_exchange = Exchange('ts.messaging')
     bindings = (
@@ -21,12 +31,18 @@ def init_ts_auth_tasks(celery_app, datastore):
 
     celery_app.conf.task_queues = celery_app.conf.task_queues or []
 
-    celery_app.conf.task_queues.append(
-        Queue('{}.ts_auth.group'.format(celery_app.main), list(bindings))
-    )
+    queue = Queue('{}.ts_auth.group'.format(celery_app.main), list(bindings))
+
+    if batch_size:
+        _init_batch_consumer(
+            celery_app, datastore, queue, batch_size=batch_size, batch_wait=batch_wait, coalescer=coalescer
+        )
+    else:
+        celery_app.conf.task_queues.append(queue)
 
-    _init_group_tasks(datastore)
-    _init_role_tasks(datastore)
+    # the debounced messages go back to this queue only, not to the queues of every service bound to ts.messaging
+    _init_group_tasks(datastore, bulk_sync=bulk_sync, coalescer=coalescer, queue=queue)
+    _init_role_tasks(datastore, bulk_sync=bulk_sync, coalescer=coalescer, queue=queue)
 
 
 def init_permissions(datastore):
@@ -39,3 +55,19 @@ def init_permissions(datastore):
         permission_model (Permission): SQLAlchemy declarative permissions model
     """
     _init_permission_tasks(datastore)
+
+
+def init_shared_index_writer(datastore, path, delay=1):
+    """
+    Write the auth index file shared by the workers of a host when the Celery worker is ready, and rewrite
+    it after the datastore committed changes to the roles or groups
+
+    Args:
+        datastore (SQLAlchemySessionAuthStore): datastore the index is loaded from
+        path (str): path to the index file, read by `thunderstorm_auth.datastore.MmapAuthStore`
+        delay (int or float): number of seconds to wait for more changes before rewriting the file
+
+    Returns:
+        SharedIndexWriter
+    """
+    return _init_shared_index_writer(datastore, path, delay=delay)
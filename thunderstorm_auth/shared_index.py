@@ -0,0 +1,335 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import uuid
+
+from celery import signals
+from statsd.defaults.env import statsd
+
+from thunderstorm_auth.snapshot import AuthSnapshot
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TSAI'
+VERSION = 1
+
+# magic, version, reserved, then (entries offset, entries count) of the permission->roles,
+# permission string->uuid and group->complexes sections
+_HEADER = struct.Struct('<4sHH6I')
+# key, values offset, values count: entries are sorted by key and the values of an entry by value
+_ENTRY = struct.Struct('<16sII')
+_UUID_SIZE = 16
+
+
+class SharedIndex(object):
+    """
+    Read-only view of an auth index file mapped in memory
+
+    Lookups binary search the mapped file directly, nothing is loaded into Python objects, so every process
+    opening the file shares the same page cache and opening it is free.
+    """
+
+    def __init__(self, buffer):
+        """
+        Args:
+            buffer (mmap.mmap or bytes): content of an index file, see `write_shared_index`
+
+        Raises:
+            ValueError: If the buffer is not an index file.
+        """
+        if len(buffer) < _HEADER.size:
+            raise ValueError('Auth index file too short')
+
+        magic, version, _, *sections = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not an auth index file or unsupported version')
+
+        self._buffer = buffer
+        self._permission_roles = (sections[0], sections[1])
+        self._permission_uuids = (sections[2], sections[3])
+        self._group_complexes = (sections[4], sections[5])
+
+    @classmethod
+    def open(cls, path):
+        """
+        Args:
+            path (str): path to the index file
+
+        Returns:
+            SharedIndex
+        """
+        with open(path, 'rb') as index_file:
+            return cls(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @property
+    def permission_count(self):
+        return self._permission_roles[1]
+
+    def is_permission_in_roles(self, permission_uuid, role_uuids):
+        """
+        Args:
+            permission_uuid (object): primary identifier of a permission
+            role_uuids (list of objects): primary identifiers of roles
+
+        Returns:
+            bool: permission belongs to at least one role
+        """
+        values = self._find(self._permission_roles, _uuid_bytes(permission_uuid))
+        if values is None:
+            return False
+        return any(self._contains(values, role_key) for role_key in _uuid_keys(role_uuids))
+
+    def get_roles_with_permission(self, role_uuids, permission_uuid):
+        """
+        Args:
+            role_uuids (list of objects): primary identifiers of roles
+            permission_uuid (object): primary identifier of a permission
+
+        Returns:
+            set: string uuids of the roles holding the permission
+        """
+        values = self._find(self._permission_roles, _uuid_bytes(permission_uuid))
+        if values is None:
+            return set()
+        return {
+            str(uuid.UUID(bytes=role_key)) for role_key in _uuid_keys(role_uuids) if self._contains(values, role_key)
+        }
+
+    def get_permission_uuid(self, permission_string):
+        """
+        Args:
+            permission_string (str): permission name and definition
+
+        Returns:
+            str: primary identifier of the permission
+            None: no permission found with that string
+        """
+        values = self._find(self._permission_uuids, _string_key(permission_string))
+        if values is None:
+            return None
+        offset, _ = values
+        return str(uuid.UUID(bytes=self._buffer[offset:offset + _UUID_SIZE]))
+
+    def get_complex_uuids(self, group_uuid):
+        """
+        Args:
+            group_uuid (object): primary identifier of a group
+
+        Returns:
+            list: uuids of the complexes of the group
+        """
+        values = self._find(self._group_complexes, _uuid_bytes(group_uuid))
+        if values is None:
+            return []
+        offset, count = values
+        return [
+            uuid.UUID(bytes=self._buffer[position:position + _UUID_SIZE])
+            for position in range(offset, offset + count * _UUID_SIZE, _UUID_SIZE)
+        ]
+
+    def has_group_complexes(self):
+        return self._group_complexes[1] > 0
+
+    def _find(self, section, key):
+        """
+        Returns:
+            tuple: offset and count of the values of the key
+            None: key not in the section
+        """
+        entries_offset, count = section
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = entries_offset + middle * _ENTRY.size
+            entry_key = self._buffer[position:position + _UUID_SIZE]
+            if entry_key < key:
+                low = middle + 1
+            elif entry_key > key:
+                high = middle
+            else:
+                return _ENTRY.unpack_from(self._buffer, position)[1:]
+        return None
+
+    def _contains(self, values, key):
+        offset, count = values
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = offset + middle * _UUID_SIZE
+            value = self._buffer[position:position + _UUID_SIZE]
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return True
+        return False
+
+
+def write_shared_index(path, permission_roles, permission_uuids, group_complexes):
+    """
+    Write an index file, atomically replacing the previous one so readers never see a partial file
+
+    Args:
+        path (str): path to the index file
+        permission_roles (dict): permission uuid -> iterable of role uuids
+        permission_uuids (dict): permission string -> permission uuid
+        group_complexes (dict): group uuid -> iterable of complex uuids
+
+    Returns:
+        int: size of the index file in bytes
+    """
+    sections = [
+        {_uuid_bytes(key): {_uuid_bytes(value) for value in values} for key, values in permission_roles.items()},
+        {_string_key(key): {_uuid_bytes(value)} for key, value in permission_uuids.items()},
+        {_uuid_bytes(key): {_uuid_bytes(value) for value in values} for key, values in group_complexes.items()},
+    ]
+
+    entries_offsets = []
+    offset = _HEADER.size
+    for section in sections:
+        entries_offsets.append(offset)
+        offset += len(section) * _ENTRY.size
+
+    entries = bytearray()
+    values = bytearray()
+    for section in sections:
+        for key in sorted(section):
+            section_values = sorted(section[key])
+            entries += _ENTRY.pack(key, offset + len(values), len(section_values))
+            values += b''.join(section_values)
+
+    header = _HEADER.pack(
+        MAGIC, VERSION, 0,
+        entries_offsets[0], len(sections[0]), entries_offsets[1], len(sections[1]), entries_offsets[2], len(sections[2])
+    )
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.auth-index-')
+    try:
+        with os.fdopen(descriptor, 'wb') as index_file:
+            index_file.write(header)
+            index_file.write(entries)
+            index_file.write(values)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return len(header) + len(entries) + len(values)
+
+
+class SharedIndexWriter(object):
+    """
+    Writes the index file from a SQLAlchemy datastore, rewriting it shortly after the datastore committed
+    changes to the roles of a permission or the complexes of a group
+
+    The rewrite is delayed so a burst of sync messages (eg. a role republish) produces a single write.
+    """
+
+    def __init__(self, datastore, path, delay=1):
+        """
+        Args:
+            datastore (SQLAlchemySessionAuthStore): datastore the index is loaded from
+            path (str): path to the index file
+            delay (int or float): number of seconds to wait for more changes before rewriting the file
+        """
+        self.datastore = datastore
+        self.path = path
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._timer = None
+        self._timer_pid = None
+
+    @statsd.timer('shared_index.write.time')
+    def write(self):
+        """
+        Returns:
+            int: size of the index file in bytes
+        """
+        with self._lock:
+            self._timer = None
+
+        snapshot = AuthSnapshot.load(self.datastore)
+        size = write_shared_index(
+            self.path, snapshot.permission_roles, snapshot.permission_uuids, snapshot.group_complexes
+        )
+        logger.info('Auth index written to {} ({} permissions, {} bytes)'.format(
+            self.path, len(snapshot.permission_roles), size
+        ))
+        return size
+
+    def schedule(self):
+        """
+        Rewrite the file after the delay, unless a rewrite is already scheduled
+        """
+        with self._lock:
+            # threads do not survive a fork, a rewrite scheduled by the parent process never runs in this one
+            if self._timer is not None and self._timer_pid == os.getpid():
+                return
+            self._timer = threading.Timer(self.delay, self._write_scheduled)
+            self._timer.daemon = True
+            self._timer.start()
+            self._timer_pid = os.getpid()
+
+    def _write_scheduled(self):
+        try:
+            # in the datastore's background context, the scoped session of the timer thread is removed afterwards
+            with self.datastore._background_session():
+                self.write()
+        except Exception:
+            logger.exception('Could not write auth index to {}'.format(self.path))
+
+
+def _init_shared_index_writer(datastore, path, delay=1):
+    """
+    Connect a writer of the shared index file to the commits of the datastore and write the file when the
+    worker is ready
+
+    The commits are listened to rather than the sync tasks, so the writes of the batch consumer and of any
+    other code path going through the datastore rewrite the file too.
+
+    Args:
+        datastore (SQLAlchemySessionAuthStore): datastore the index is loaded from
+        path (str): path to the index file
+        delay (int or float): number of seconds to wait for more changes before rewriting the file
+
+    Returns:
+        SharedIndexWriter
+    """
+    writer = SharedIndexWriter(datastore, path, delay=delay)
+
+    @signals.worker_ready.connect(weak=False)
+    def write_on_ready(sender, **kwargs):
+        writer.schedule()
+
+    datastore.add_commit_listener(writer.schedule)
+    return writer
+
+
+def _uuid_bytes(value):
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    return uuid.UUID(str(value)).bytes
+
+
+def _uuid_keys(values):
+    """Keys of the values which are uuids, the others can not match anything"""
+    keys = []
+    for value in values:
+        try:
+            keys.append(_uuid_bytes(value))
+        except ValueError:
+            pass
+    return keys
+
+
+def _string_key(value):
+    return hashlib.sha256(value.encode('utf-8')).digest()[:_UUID_SIZE]
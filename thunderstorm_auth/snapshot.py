@@ -0,0 +1,124 @@
+import gc
+import sys
+import time
+
+
+class AuthSnapshot(object):
+    """
+    Immutable snapshot of the roles of each permission, the permission uuids and the complexes of each group
+
+    Meant to be loaded in the master process of a prefork server (eg. gunicorn --preload) so the workers
+    share it. Nothing mutates it once built, the uuids are interned strings and the role and complex
+    sets are frozensets, so its pages stay shared after the fork once `freeze` has been called.
+    Updates are picked up by loading a new snapshot and swapping it in.
+
+    The group complexes are only loaded for the shared index file, a datastore snapshot is loaded without them.
+    """
+
+    __slots__ = ('permission_roles', 'permission_uuids', 'group_complexes', 'loaded_at')
+
+    def __init__(self, permission_roles, permission_uuids, group_complexes):
+        """
+        Args:
+            permission_roles (dict): string permission uuid -> frozenset of string role uuids
+            permission_uuids (dict): permission string -> string permission uuid
+            group_complexes (dict): string group uuid -> frozenset of string complex uuids, None if the groups
+                are not loaded
+        """
+        self.permission_roles = permission_roles
+        self.permission_uuids = permission_uuids
+        self.group_complexes = group_complexes
+        self.loaded_at = time.time()
+
+    @classmethod
+    def load(cls, datastore, with_groups=True):
+        """
+        Load a snapshot of the auth data of a SQLAlchemy datastore
+
+        Args:
+            datastore (SQLAlchemySessionAuthStore): datastore to load the snapshot from
+            with_groups (bool): load the complexes of each group as well
+
+        Returns:
+            AuthSnapshot
+        """
+        db_session = datastore.db_session
+        permission_model = datastore.permission_model
+        association_model = datastore.association_model
+        group_association_model = datastore.group_association_model
+
+        query = db_session.query(
+            permission_model.uuid, permission_model.permission, association_model.role_uuid
+        ).outerjoin(association_model, association_model.permission_uuid == permission_model.uuid)
+
+        permission_roles = {}
+        permission_uuids = {}
+        for permission_uuid, permission_string, role_uuid in query:
+            roles = permission_roles.setdefault(_intern(permission_uuid), [])
+            if role_uuid is not None:
+                roles.append(_intern(role_uuid))
+            permission_uuids[sys.intern(permission_string)] = _intern(permission_uuid)
+
+        group_complexes = None
+        if with_groups:
+            group_complexes = {}
+            query = db_session.query(group_association_model.group_uuid, group_association_model.complex_uuid)
+            for group_uuid, complex_uuid in query:
+                group_complexes.setdefault(_intern(group_uuid), []).append(_intern(complex_uuid))
+            group_complexes = {group_uuid: frozenset(complexes) for group_uuid, complexes in group_complexes.items()}
+
+        return cls(
+            {permission_uuid: frozenset(roles) for permission_uuid, roles in permission_roles.items()},
+            permission_uuids,
+            group_complexes,
+        )
+
+    def get_permission_roles(self, permission_uuid):
+        """
+        Args:
+            permission_uuid (object): primary identifier of a permission
+
+        Returns:
+            frozenset: string uuids of the roles holding the permission
+            None: permission not in the snapshot
+        """
+        return self.permission_roles.get(str(permission_uuid))
+
+    def get_permission_uuid(self, permission_string):
+        """
+        Args:
+            permission_string (str): permission name and definition
+
+        Returns:
+            str: primary identifier of the permission
+            None: permission not in the snapshot
+        """
+        return self.permission_uuids.get(permission_string)
+
+    def get_complex_uuids(self, group_uuid):
+        """
+        Args:
+            group_uuid (object): primary identifier of a group
+
+        Returns:
+            frozenset: string uuids of the complexes of the group, empty if the group is unknown
+            None: groups not loaded
+        """
+        if self.group_complexes is None:
+            return None
+        return self.group_complexes.get(str(group_uuid), frozenset())
+
+
+def freeze():
+    """
+    Move every object tracked by the garbage collector to a permanent generation, so collections in forked
+    workers do not write to (and copy) the pages shared with the master process
+
+    Only available from Python 3.7, a no-op before.
+    """
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def _intern(value):
+    return sys.intern(str(value))